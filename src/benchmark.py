@@ -0,0 +1,559 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from helper.utils import *
+from classes.tcp_segment import TCPSegment
+from classes.tcp_base import TCPBaseSocket
+from classes.tcp_server import TCPServerSocket
+from classes.tcp_client import TCPClientSocket
+from classes.console_renderer import ConsoleRenderer
+from classes.tcp_timer_wheel import TimerWheel
+from sharded_server import reuseport_socket
+
+def legacy_checksum(data: bytes) -> int:
+    # Word-at-a-time loop kept as the baseline for the benchmark
+    if len(data) % 2 == 1:
+        data += b'\x00'  # pad to even length
+
+    checksum = 0
+    for i in range(0, len(data), 2):
+        word = (data[i] << 8) + data[i + 1]  # big-endian
+        checksum += word
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)  # wrap
+
+    return ~checksum & 0xFFFF
+
+def bench_checksum(sizes=(40, 104, 512, 1440, 8192, 65536), repeat=5):
+    print("---------------- CHECKSUM ----------------")
+    print(f"{'bytes':>8} {'loop (us)':>12} {'bulk (us)':>12} {'speedup':>9}")
+    for size in sizes:
+        data = os.urandom(size)
+        assert legacy_checksum(data) == calculate_checksum(data)
+        number = max(1, 200000 // size)
+        loop = min(timeit.repeat(lambda: legacy_checksum(data), number=number, repeat=repeat)) / number
+        bulk = min(timeit.repeat(lambda: calculate_checksum(data), number=number, repeat=repeat)) / number
+        print(f"{size:>8} {loop * 1e6:>12.2f} {bulk * 1e6:>12.2f} {loop / bulk:>8.1f}x")
+
+def legacy_pack(segment):
+    # Two struct.pack calls and a concatenation, as the codec used to do
+    fields = [segment.src_port, segment.dest_port, segment.seq_num, segment.ack_num, segment.flags, 0,
+              segment.windowsize, segment.payloadlength, segment.timestamp, segment.messagetype, segment.padding]
+    checksum = calculate_checksum(struct.pack(TCPSegment.FORMAT, *fields) + segment.payload)
+    fields[5] = checksum
+    return struct.pack(TCPSegment.FORMAT, *fields) + segment.payload
+
+def legacy_unpack(data):
+    header = data[:TCPSegment.HEADER_SIZE]
+    payload = data[TCPSegment.HEADER_SIZE:]
+    unpacked = struct.unpack(TCPSegment.FORMAT, header)
+    temp_header = struct.pack(TCPSegment.FORMAT, *unpacked[:5], 0, *unpacked[6:])
+    if calculate_checksum(temp_header + payload) != unpacked[5]:
+        return None
+    return TCPSegment(src_port=unpacked[0], dest_port=unpacked[1], seq_num=unpacked[2], ack_num=unpacked[3],
+                      flags=unpacked[4], checksum=unpacked[5], windowsize=unpacked[6], payloadlength=unpacked[7],
+                      timestamp=unpacked[8], messagetype=unpacked[9], padding=unpacked[10], payload=payload)
+
+def bench_codec(sizes=(0, 64, 512, 1400), repeat=5):
+    print("----------------- CODEC ------------------")
+    # One checksum pass per encode and per decode is the floor, at a full MSS it is most of the time
+    print(f"{'bytes':>8} {'old enc':>9} {'new enc':>9} {'speedup':>8} {'old dec':>9} {'new dec':>9} {'speedup':>8} {'checksum':>9}")
+    buffer = bytearray(TCPSegment.HEADER_SIZE + max(sizes))
+    for size in sizes:
+        segment = TCPSegment(1234, 8932, 1 << 40, 0, 0, windowsize=520, payloadlength=size, timestamp=1,
+                             messagetype=1, payload=os.urandom(size))
+        data = bytes(segment.pack())
+        assert legacy_pack(segment) == data
+        number = 20000
+        old_enc = min(timeit.repeat(lambda: legacy_pack(segment), number=number, repeat=repeat)) / number
+        new_enc = min(timeit.repeat(lambda: segment.pack_into(buffer), number=number, repeat=repeat)) / number
+        old_dec = min(timeit.repeat(lambda: legacy_unpack(data), number=number, repeat=repeat)) / number
+        new_dec = min(timeit.repeat(lambda: TCPSegment.unpack(data), number=number, repeat=repeat)) / number
+        checksum = min(timeit.repeat(lambda: calculate_checksum(data), number=number, repeat=repeat)) / number
+        print(f"{size:>8} {old_enc * 1e6:>8.2f}u {new_enc * 1e6:>8.2f}u {old_enc / new_enc:>7.1f}x "
+              f"{old_dec * 1e6:>8.2f}u {new_dec * 1e6:>8.2f}u {old_dec / new_dec:>7.1f}x {checksum * 1e6:>8.2f}u")
+
+class ThreadedServerSocket(TCPServerSocket):
+    """Thread per datagram and threading.Timer timers, as accept used to dispatch"""
+
+    def dispatch(self, data, client):
+        threading.Thread(target=TCPServerSocket.dispatch, args=(self, data, client), daemon=True).start()
+
+    def call_handler(self, *args):
+        self.handler(*args)
+
+    def call_later(self, delay, callback, *args):
+        return TCPBaseSocket.call_later(self, delay, callback, *args)
+
+def raw_client(server_addr):
+    # Handshake as a legacy peer (no options), returns the socket and the next seq_num
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2.0)
+    port = sock.getsockname()[1]
+    sock.sendto(TCPSegment(port, server_addr[1], 100, 0, FLAG_SYN, messagetype=2, payload=b'bench').pack(), server_addr)
+    synack = TCPSegment.unpack(sock.recv(2048))
+    sock.sendto(TCPSegment(port, server_addr[1], 101, synack.seq_num + 1, FLAG_ACK, windowsize=0xFFFF,
+                           messagetype=2, payload=b'bench').pack(), server_addr)
+    sock.setblocking(False)
+    return sock, 101
+
+def drive_clients(server_addr, clients, rounds, payload):
+    # Every round each client sends one message and waits for its ACK, returns (latencies, elapsed)
+    conns = [list(raw_client(server_addr)) for _ in range(clients)]
+    time.sleep(0.2)
+
+    selector = selectors.DefaultSelector()
+    for i, conn in enumerate(conns):
+        selector.register(conn[0], selectors.EVENT_READ, i)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        sent_at = {}
+        for i, conn in enumerate(conns):
+            sock, seq = conn
+            port = sock.getsockname()[1]
+            sock.sendto(TCPSegment(port, port, seq, 0, 0, payloadlength=len(payload), messagetype=1,
+                                   payload=payload).pack(), server_addr)
+            conn[1] = seq + len(payload)
+            sent_at[i] = time.perf_counter()
+        deadline = time.perf_counter() + 2.0
+        while sent_at and time.perf_counter() < deadline:
+            for key, _ in selector.select(0.1):
+                i = key.data
+                ack = TCPSegment.unpack(key.fileobj.recv(2048))
+                if ack and ack.flags == FLAG_ACK and ack.ack_num == conns[i][1] and i in sent_at:
+                    latencies.append(time.perf_counter() - sent_at.pop(i))
+    elapsed = time.perf_counter() - start
+
+    selector.close()
+    for sock, _ in conns:
+        sock.close()
+    return latencies, elapsed
+
+def run_dispatch(server_class, clients, rounds, payload):
+    port = random.randrange(20000, 60000)
+    server = server_class(port, ip_address="127.0.0.1", handler=lambda *args: None, delayed_ack=False)
+    server.listen()
+    accept_thread = threading.Thread(target=server.accept, daemon=True)
+    accept_thread.start()
+    latencies, elapsed = drive_clients(("127.0.0.1", port), clients, rounds, payload)
+
+    server.loop.stop()
+    accept_thread.join(1.0)
+    server.udp.close()
+    return len(latencies) / elapsed, latencies
+
+def bench_dispatch(client_counts=(10, 100, 200), rounds=30, payload=b'x' * 32):
+    print("---------------- DISPATCH ----------------")
+    print(f"{'clients':>8} {'server':>10} {'msg/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'lost':>6}")
+    for clients in client_counts:
+        for name, server_class in (("threads", ThreadedServerSocket), ("loop", TCPServerSocket)):
+            with contextlib.redirect_stdout(io.StringIO()):
+                rate, latencies = run_dispatch(server_class, clients, rounds, payload)
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+            p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+            lost = clients * rounds - len(latencies)
+            print(f"{clients:>8} {name:>10} {rate:>9.0f} {p50 * 1e3:>9.2f} {p99 * 1e3:>9.2f} {lost:>6}")
+
+def serve_shard(port):
+    server = TCPServerSocket(port, ip_address="127.0.0.1", udp_socket=reuseport_socket(), handler=lambda *args: None,
+                             delayed_ack=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.listen()
+        server.accept()
+
+def drive_shard_clients(port, clients, rounds, payload):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return drive_clients(("127.0.0.1", port), clients, rounds, payload)
+
+def bench_broadcast(client_counts=(10, 100, 500), sizes=(512, 8192, 65000), mss=DEFAULT_MSS, repeat=3):
+    # CPU spent turning one chat log into every recipient's datagrams, sockets left out
+    print("---------------- BROADCAST ---------------")
+    print(f"{'clients':>8} {'bytes':>8} {'per client (ms)':>16} {'template (ms)':>14} {'speedup':>9}")
+    for size in sizes:
+        payload = os.urandom(size - 1) + b'\x00'
+        chunks = [payload[offset:offset + mss] for offset in range(0, size, mss)]
+        for clients in client_counts:
+            ports = [random.randrange(1024, 65536) for _ in range(clients)]
+
+            def per_client():
+                return [TCPSegment(8932, port, i * mss, 7, FLAG_ACK | FLAG_PSH, windowsize=520, payloadlength=size,
+                                   timestamp=1, messagetype=1, payload=chunk).pack()
+                        for port in ports for i, chunk in enumerate(chunks)]
+
+            def template():
+                templates = [TCPSegment(8932, 0, 0, 0, 0, payloadlength=size, timestamp=1, messagetype=1, payload=chunk).pack()
+                             for chunk in chunks]
+                return [TCPSegment.patch(packed, port, i * mss, 7, FLAG_ACK | FLAG_PSH, 520)
+                        for port in ports for i, packed in enumerate(templates)]
+
+            assert per_client() == template()
+            old = min(timeit.repeat(per_client, number=1, repeat=repeat))
+            new = min(timeit.repeat(template, number=1, repeat=repeat))
+            print(f"{clients:>8} {size:>8} {old * 1e3:>16.2f} {new * 1e3:>14.2f} {old / new:>8.1f}x")
+
+def legacy_print(lines):
+    # Shell clear and full reprint per update, as the consoles used to draw
+    os.system("cls" if os.name == "nt" else "clear")
+    print("---------------- SERVER CONSOLE ----------------")
+    for line in lines:
+        print(line)
+    print("------------------------------------------------")
+
+def bench_console(bursts=(10, 100, 500), history=MAX_MESSAGES):
+    # A burst of chat lines arriving back to back, terminal output thrown away
+    print("---------------- CONSOLE -----------------")
+    print(f"{'updates':>8} {'clear (ms)':>11} {'ansi (ms)':>10} {'frames':>7}")
+    lines = [f"user{i} [12:00:00]: message {i}" for i in range(history)]
+    with open(os.devnull, "w") as devnull:
+        stdout_fd = os.dup(1)
+        try:
+            os.dup2(devnull.fileno(), 1) # the shell clear writes to the real stdout
+            for burst in bursts:
+                frames = [lines[i % history:] + lines[:i % history] for i in range(burst)]
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(devnull):
+                    for frame in frames:
+                        legacy_print(frame)
+                legacy = time.perf_counter() - start
+
+                renderer = ConsoleRenderer("SERVER CONSOLE", stream=devnull)
+                start = time.perf_counter()
+                for frame in frames:
+                    renderer.update(frame)
+                renderer.close()
+                renderer.flush() # the coalesced last frame
+                ansi = time.perf_counter() - start
+                os.write(stdout_fd, f"{burst:>8} {legacy * 1e3:>11.2f} {ansi * 1e3:>10.2f} {renderer.frames:>7}\n".encode())
+        finally:
+            os.dup2(stdout_fd, 1)
+            os.close(stdout_fd)
+
+def bench_timers(counts=(100, 1000, 5000), delay=HEARTBEAT_INTERVAL):
+    # One heartbeat timeout per client: start them all, restart them all once, then cancel them
+    print("----------------- TIMERS -----------------")
+    print(f"{'timers':>8} {'threads (ms)':>13} {'wheel (ms)':>11} {'threads used':>13}")
+    for count in counts:
+        before = threading.active_count()
+        start = time.perf_counter()
+        timers = []
+        for _ in range(count):
+            timer = threading.Timer(delay, lambda: None)
+            timer.daemon = True
+            timer.start()
+            timers.append(timer)
+        peak = threading.active_count() - before
+        for timer in timers:
+            timer.cancel()
+        for _ in range(count):
+            timer = threading.Timer(delay, lambda: None)
+            timer.daemon = True
+            timer.start()
+            timer.cancel()
+        threaded = time.perf_counter() - start
+
+        wheel = TimerWheel()
+        start = time.perf_counter()
+        handles = [wheel.schedule(delay, lambda: None) for _ in range(count)]
+        for handle in handles:
+            handle.cancel()
+        for _ in range(count):
+            wheel.schedule(delay, lambda: None).cancel()
+        wheeled = time.perf_counter() - start
+        print(f"{count:>8} {threaded * 1e3:>13.2f} {wheeled * 1e3:>11.2f} {peak:>13}")
+
+def bench_connections(counts=(100, 1000, 5000), lookups=20000):
+    # Connections opened through the real handshake: memory against the budget, lookups, teardown
+    print("--------------- CONNECTIONS --------------")
+    print(f"budget {TCB_MEMORY_BUDGET} bytes per idle connection")
+    print(f"{'conns':>8} {'TCB (B)':>8} {'traced (B)':>11} {'list lookup (us)':>17} {'dict lookup (us)':>17} {'left (B)':>9}")
+    for count in counts:
+        server = TCPServerSocket(0, ip_address="127.0.0.1", handler=lambda *args: None)
+        server.call_handler = lambda *args: None
+        server.state = LISTEN # accepts SYNs without binding
+        addrs = [("127.0.0.1", 1024 + i) for i in range(count)]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for addr in addrs:
+                syn = TCPSegment(addr[1], 1, 1000, 0, FLAG_SYN, timestamp=1, messagetype=2,
+                                 padding=server.handshake_options(), payload=b'user')
+                server.dispatch(syn.pack(), addr)
+                tcb = server.connections[addr]
+                ack = TCPSegment(addr[1], 1, 1001, tcb.send_base, FLAG_ACK, windowsize=0xFFFF, timestamp=1,
+                                 messagetype=2, payload=b'user')
+                server.dispatch(ack.pack(), addr)
+                server.get_congestion(tcb) # as after the first send
+        opened = tracemalloc.get_traced_memory()[0]
+        per_tcb = sum(tcb.memory() for tcb in server.connections.values()) / count
+
+        # Membership test of every datagram, the old remote_addr list against the TCB index
+        probes = [random.choice(addrs) for _ in range(lookups)]
+        remote_list = list(server.connections)
+        listed = timeit.timeit(lambda: [addr in remote_list for addr in probes], number=1) / lookups
+        indexed = timeit.timeit(lambda: [addr in server.connections for addr in probes], number=1) / lookups
+
+        del probes, remote_list, tcb
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            for addr in addrs:
+                server.cleanup_connection(addr)
+        left = tracemalloc.get_traced_memory()[0] - before # the index's hash table, dicts keep it after deletes
+        tracemalloc.stop()
+        server.udp.close()
+        print(f"{count:>8} {per_tcb:>8.0f} {(opened - before) / count:>11.0f} {listed * 1e6:>17.3f} {indexed * 1e6:>17.3f} {left:>9}")
+
+def bench_connection_churn(counts=(100, 1000), loss=0.0):
+    # One client socket opening and closing connections back to back, as a load test would
+    print("------------ CONNECTION CHURN ------------")
+    print(f"{'conns':>8} {'loss':>5} {'conn/s':>8} {'failed':>7} {'server left':>12} {'threads':>8}")
+    for count in counts:
+        server = TCPServerSocket(0, ip_address="127.0.0.1", handler=lambda *args: None)
+        client = TCPClientSocket(0, "127.0.0.1", 0, ip_address="127.0.0.1")
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.listen()
+            server.local_addr = server.udp.getsockname()
+            client.server_addr = server.local_addr
+            client.bind()
+            client.local_addr = client.udp.getsockname()
+            threading.Thread(target=server.accept, daemon=True).start()
+            if loss:
+                drop_datagrams(server, loss)
+                drop_datagrams(client, loss)
+
+            failed = 0
+            start = time.perf_counter()
+            for _ in range(count):
+                if not (client.connect("user") and client.disconnect(timeout=10.0)):
+                    failed += 1
+            elapsed = time.perf_counter() - start
+            deadline = time.monotonic() + 5.0 # the server's LAST_ACK may still wait for a resent final ACK
+            while server.connections and time.monotonic() < deadline:
+                time.sleep(0.01)
+            left = len(server.connections)
+            threads = threading.active_count()
+            client.close()
+            server.close()
+        print(f"{count:>8} {loss:>5.0%} {count / elapsed:>8.0f} {failed:>7} {left:>12} {threads:>8}")
+
+def bench_drain(clients=50, size=64000, timeouts=(0.0, DRAIN_TIMEOUT), loss=0.05):
+    # A broadcast still in flight when the server shuts down: cut off at once, or drained under a deadline
+    print("------------------ DRAIN -----------------")
+    print(f"{'deadline':>8} {'drained':>8} {'cut off':>8} {'undelivered (B)':>16} {'segments':>9} {'received (B)':>13} {'shutdown (s)':>13}")
+    for timeout in timeouts:
+        server = TCPServerSocket(0, ip_address="127.0.0.1", handler=lambda *args: None, drain_timeout=timeout)
+        received = []
+        sockets = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.listen()
+            server.local_addr = server.udp.getsockname()
+            accept_thread = threading.Thread(target=server.accept, daemon=True)
+            accept_thread.start()
+            for _ in range(clients):
+                client = TCPClientSocket(0, *server.local_addr, ip_address="127.0.0.1",
+                                         handler=lambda payload, length, type=1: received.append(len(payload)))
+                client.bind()
+                client.local_addr = client.udp.getsockname()
+                client.connect("user")
+                drop_datagrams(client, loss) # lost ACKs keep data in flight
+                sockets.append(client)
+
+            server.broadcast(list(server.connections), b'x' * size, 1)
+            start = time.perf_counter()
+            server.shutdown()
+            accept_thread.join(timeout + 10)
+            elapsed = time.perf_counter() - start
+            for client in sockets:
+                client.close()
+        stats = server.drain_stats
+        print(f"{timeout:>8.1f} {stats['drained']:>8} {stats['cut_off']:>8} {stats['undelivered_bytes']:>16} "
+              f"{stats['undelivered_segments']:>9} {sum(received):>13} {elapsed:>13.2f}")
+
+def bench_syn_flood(duration=2.0, modes=((None, False), (SYN_BACKLOG, False), (SYN_BACKLOG, True))):
+    # SYNs from ever new loopback addresses that never finish the handshake, while one real client connects
+    print("---------------- SYN FLOOD ---------------")
+    print(f"{'backlog':>9} {'cookies':>8} {'SYNs/s':>8} {'accepts/s':>10} {'failed':>7} {'half-open':>10} {'memory (kB)':>12}")
+    for backlog, cookies in modes:
+        server = TCPServerSocket(0, ip_address="127.0.0.1", handler=lambda *args: None,
+                                 syn_backlog=backlog if backlog is not None else 1 << 30, syn_cookies=cookies)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            server.listen()
+            server.local_addr = server.udp.getsockname()
+            threading.Thread(target=server.accept, daemon=True).start()
+
+            stop = threading.Event()
+            sent = [0]
+            def flood():
+                # A fresh socket per SYN, the server sees a new address each time like with spoofed sources
+                while not stop.is_set():
+                    syn = TCPSegment(0, server.local_addr[1], random.getrandbits(31), 0, FLAG_SYN, timestamp=1,
+                                     messagetype=2, padding=server.handshake_options(), payload=b'flood')
+                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                        sock.bind((f"127.0.{2 + sent[0] % 200}.{1 + sent[0] // 200 % 250}", 0))
+                        sock.sendto(syn.pack(), server.local_addr)
+                    sent[0] += 1
+            flood_thread = threading.Thread(target=flood, daemon=True)
+            flood_start = time.perf_counter()
+            flood_thread.start()
+            time.sleep(0.5) # fills the backlog
+
+            client = TCPClientSocket(0, *server.local_addr, ip_address="127.0.0.1")
+            client.bind()
+            client.local_addr = client.udp.getsockname()
+            accepted = failed = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                if client.connect("user", timeout=0.5) and client.disconnect(timeout=0.5):
+                    accepted += 1
+                else:
+                    failed += 1
+            elapsed = time.perf_counter() - start
+            stop.set()
+            flood_thread.join()
+            syn_rate = sent[0] / (time.perf_counter() - flood_start)
+            half_open = len(server.half_open)
+            memory = sum(server.connection_memory().values())
+            client.close()
+            server.close()
+        print(f"{backlog if backlog is not None else 'unbound':>9} {'on' if cookies else 'off':>8} {syn_rate:>8.0f} "
+              f"{accepted / elapsed:>10.1f} {failed:>7} {half_open:>10} {memory / 1024:>12.0f}")
+
+def drop_datagrams(sock, loss):
+    # Lossy link on the sending side of sock
+    udp = sock.udp
+    sendto = udp.sendto
+    class LossySocket:
+        def __getattr__(self, name):
+            return getattr(udp, name)
+        def sendto(self, data, addr):
+            return len(data) if random.random() < loss else sendto(data, addr)
+    sock.udp = LossySocket()
+
+def drop_segments(sock, indices, log):
+    # Drop the first transmission of the data segments at indices, log every data segment sent as (seq, time)
+    udp = sock.udp
+    sendto = udp.sendto
+    first_sent = {}
+    class DroppingSocket:
+        def __getattr__(self, name):
+            return getattr(udp, name)
+        def sendto(self, data, addr):
+            segment = TCPSegment.unpack(data)
+            seq = segment.seq_num
+            if segment.payload and segment.flags != FLAG_ACK: # data, not an ACK carrying SACK blocks
+                log.append((seq, time.monotonic()))
+                if seq not in first_sent:
+                    first_sent[seq] = len(first_sent)
+                    if first_sent[seq] in indices:
+                        return len(data)
+            return sendto(data, addr)
+    sock.udp = DroppingSocket()
+
+def bench_loss_recovery(drop_sets=((5,), (8, 10), (8, 10, 12)), segments=24):
+    # One message of segments MSS sized segments from the server, with chosen first transmissions lost.
+    # Duplicate ACKs and SACK should resend exactly the lost ones long before the first retransmission timeout.
+    print("------------- LOSS RECOVERY --------------")
+    print(f"{'dropped':>10} {'resent':>10} {'only lost':>10} {'RTOs':>5} {'recovery (ms)':>14} {'RTO (ms)':>9} {'delivered':>10}")
+    for drops in drop_sets:
+        received = []
+        server = TCPServerSocket(0, ip_address="127.0.0.1", handler=lambda *args: None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.listen()
+            server.local_addr = server.udp.getsockname()
+            threading.Thread(target=server.accept, daemon=True).start()
+            client = TCPClientSocket(0, *server.local_addr, ip_address="127.0.0.1",
+                                     handler=lambda payload, length, type=1: received.append(len(payload)))
+            client.bind()
+            client.local_addr = client.udp.getsockname()
+            client.connect("user")
+            # a receive buffer as auto-tuning would have grown it, so flow control does not hide the losses
+            client_tcb = client.connections[server.local_addr]
+            with client_tcb.lock:
+                client_tcb.recv_window_limit = client_tcb.recv_window_size = segments * client_tcb.send_mss
+
+            tcb = server.connections[client.local_addr]
+            server.wait_for_state(tcb, (ESTABLISHED,), 5.0)
+            congestion = server.get_congestion(tcb)
+            timeouts = []
+            on_timeout = congestion.on_timeout
+            def count_timeout(flight_size):
+                timeouts.append(time.monotonic())
+                on_timeout(flight_size)
+            congestion.on_timeout = count_timeout
+            rto = tcb.rto.rto
+            log = []
+            drop_segments(server, drops, log)
+
+            size = segments * tcb.send_mss - 1 # the terminating NUL fills the last segment
+            server.send_data(client.local_addr, b'x' * size, 1)
+            deadline = time.monotonic() + 30.0
+            while sum(received) < size and time.monotonic() < deadline:
+                time.sleep(0.01)
+            client.close()
+            server.close()
+
+        first = {}
+        resent = []
+        for seq, sent_at in log:
+            if seq in first:
+                resent.append((seq, sent_at))
+            else:
+                first[seq] = sent_at
+        order = sorted(first)
+        lost = {order[index] for index in drops if index < len(order)}
+        only_lost = {seq for seq, _ in resent} == lost and len(resent) == len(lost)
+        recovery = max(sent_at - first[seq] for seq, sent_at in resent) if resent else float("nan")
+        indices = sorted(order.index(seq) for seq, _ in resent)
+        print(f"{','.join(map(str, drops)):>10} {','.join(map(str, indices)):>10} {'yes' if only_lost else 'no':>10} "
+              f"{len(timeouts):>5} {recovery * 1e3:>14.1f} {rto * 1e3:>9.0f} {sum(received):>10}")
+
+def bench_sharding(shard_counts=(1, 2, 4), clients=200, rounds=30, payload=b'x' * 32):
+    print("---------------- SHARDING ----------------")
+    print(f"{os.cpu_count()} cpus, {clients} clients split over one driver process per shard")
+    if reuseport_socket() is None:
+        print("SO_REUSEPORT is not available")
+        return
+    print(f"{'shards':>8} {'msg/s':>9} {'p99 (ms)':>9} {'lost':>6}")
+    for shards in shard_counts:
+        port = random.randrange(20000, 60000)
+        servers = [multiprocessing.Process(target=serve_shard, args=(port,), daemon=True) for _ in range(shards)]
+        for server in servers:
+            server.start()
+        time.sleep(0.3)
+        with multiprocessing.Pool(shards) as pool:
+            results = pool.starmap(drive_shard_clients, [(port, clients // shards, rounds, payload)] * shards)
+        for server in servers:
+            server.terminate()
+        latencies = sorted(latency for result, _ in results for latency in result)
+        rate = len(latencies) / max(elapsed for _, elapsed in results)
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+        lost = (clients // shards) * shards * rounds - len(latencies)
+        print(f"{shards:>8} {rate:>9.0f} {p99 * 1e3:>9.2f} {lost:>6}")
+
+if __name__ == "__main__":
+    bench_checksum()
+    bench_codec()
+    bench_dispatch()
+    bench_broadcast()
+    bench_console()
+    bench_timers()
+    bench_connections()
+    bench_connection_churn()
+    bench_connection_churn(counts=(20,), loss=0.05)
+    bench_drain()
+    bench_syn_flood()
+    bench_loss_recovery()
+    bench_sharding()
@@ -0,0 +1,132 @@
+import time
+import sys
+import os
+from collections import deque
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+from helper.utils import *
+
+class ChatRecord:
+    """One line of the chat room, rendered only when it is shown"""
+    __slots__ = ('id', 'author', 'timestamp', 'text', 'kind', 'line')
+
+    def __init__(self, id, author, timestamp, text, kind):
+        self.id = id                # increasing over the life of the room
+        self.author = author        # key of ChatHistory.authors
+        self.timestamp = timestamp  # as sent by the client (ms, or seconds for legacy peers)
+        self.text = text            # message body, empty for server notices
+        self.kind = kind            # CHAT_MESSAGE, CHAT_JOIN, CHAT_LEAVE or CHAT_FAILED_KILL
+        self.line = None            # rendered text, dropped when the author is renamed
+
+class ChatHistory:
+    """Fixed capacity ring of ChatRecord. Names and colours live in an author table, so a rename
+    touches one entry instead of every stored line"""
+
+    def __init__(self, capacity=MAX_MESSAGES):
+        self.capacity = capacity
+        self.records = [None] * capacity    # record id lives at index id % capacity
+        self.first_id = 1                   # oldest record still held
+        self.next_id = 1
+        self.authors = {}                   # author id -> [name, colour]
+        self.by_author = {}                 # author id -> deque of its record ids still held, oldest first
+        self.sessions = {}                  # client address -> author id while the client is connected
+        self.connected = set()              # author ids in sessions
+        self.next_author = 1
+        self.version = 0                    # bumped on every change, invalidates the rendered log
+        self.rendered = (-1, "")            # (version, log)
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+    def __iter__(self):
+        for id in self.ids():
+            yield self.records[id % self.capacity]
+
+    def ids(self):
+        return range(self.first_id, self.next_id)
+
+    def get(self, id):
+        if self.first_id <= id < self.next_id:
+            return self.records[id % self.capacity]
+        return None
+
+    def join(self, client, name, colour):
+        # Every connection is a new author, records of an earlier session keep their own name
+        author = self.next_author
+        self.next_author += 1
+        self.authors[author] = [name, colour]
+        self.by_author[author] = deque()
+        self.sessions[client] = author
+        self.connected.add(author)
+        return author
+
+    def leave(self, client):
+        author = self.sessions.pop(client, None)
+        if author is not None:
+            self.connected.discard(author)
+            self.forget_author(author)
+        return author
+
+    def author_of(self, client):
+        return self.sessions.get(client)
+
+    def rename(self, client, name):
+        """O(1) rename, returns the ids of the records that render differently now"""
+        author = self.sessions.get(client)
+        if author is None:
+            return []
+        self.authors[author][0] = name
+        self.version += 1
+        ids = list(self.by_author[author])
+        for id in ids:
+            self.records[id % self.capacity].line = None
+        return ids
+
+    def append(self, author, kind, timestamp, text=""):
+        if len(self) == self.capacity:
+            self.evict()
+        record = ChatRecord(self.next_id, author, timestamp, text, kind)
+        self.records[record.id % self.capacity] = record
+        self.by_author[author].append(record.id)
+        self.next_id += 1
+        self.version += 1
+        return record
+
+    def evict(self):
+        record = self.records[self.first_id % self.capacity]
+        self.records[self.first_id % self.capacity] = None
+        self.first_id += 1
+        self.by_author[record.author].popleft() # the oldest record is also its author's oldest
+        self.forget_author(record.author)
+
+    def forget_author(self, author):
+        # Authors stay while a connected client or a held record still refers to them
+        if not self.by_author[author] and author not in self.connected:
+            del self.authors[author]
+            del self.by_author[author]
+
+    def render(self, record):
+        if record.line is None:
+            record.line = self.format(record)
+        return record.line
+
+    def format(self, record):
+        name, colour = self.authors[record.author]
+        stamp = time.strftime('%H:%M:%S', time.localtime(timestamp_to_time(record.timestamp)))
+        if record.kind == CHAT_JOIN:
+            return f"{BRIGHT_GREEN_COLOR}SERVER [{stamp}]: {name} has joined the chatroom!{RESET_COLOR}"
+        if record.kind == CHAT_LEAVE:
+            return f"{GREEN_COLOR}SERVER [{stamp}]: {name} has left the chat!{RESET_COLOR}"
+        if record.kind == CHAT_FAILED_KILL:
+            return f"{RED_COLOR}SERVER [{stamp}]: Nice try {name}... {RESET_COLOR}"
+        return f"{colour}{name}{RESET_COLOR} [{stamp}]: {record.text}"
+
+    def render_log(self):
+        # Whole room, one line per record, rebuilt only after a change
+        version, log = self.rendered
+        if version != self.version:
+            log = '\n'.join(self.render(record) for record in self)
+            self.rendered = (self.version, log)
+        return log
@@ -0,0 +1,94 @@
+import threading
+import time
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+from classes.tcp_timer_wheel import TimerService
+
+class ConsoleRenderer:
+    """Draws a framed block of lines with ANSI escapes instead of clearing the screen through a shell.
+    Only rows that changed are rewritten, and bursts of updates are folded into at most fps frames a second"""
+    CLEAR_SCREEN = "\033[2J"
+    CLEAR_LINE = "\033[K"       # from the cursor to the end of the row
+    CLEAR_BELOW = "\033[J"      # from the cursor to the end of the screen
+    RULE = "------------------------------------------------"
+
+    def __init__(self, title, prompt="", fps=CONSOLE_FPS, headless=False, stream=None):
+        self.title = title
+        self.prompt = prompt        # last row, the cursor is left after it
+        self.interval = 1 / fps
+        self.headless = headless    # servers and bots without a terminal, nothing is drawn
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.lines = []             # body of the latest update
+        self.shown = None           # rows on screen, None until the first full draw
+        self.timer = None           # pending frame, it draws whatever update came last
+        self.last_draw = 0.0
+        self.updates = 0
+        self.frames = 0
+        if not headless and os.name == "nt":
+            os.system("") # once, turns on escape sequence processing in the Windows console
+
+    def update(self, lines):
+        if self.headless:
+            return
+        with self.lock:
+            self.lines = list(lines)
+            self.updates += 1
+            if self.timer is not None:
+                return
+            wait = self.last_draw + self.interval - time.monotonic()
+            if wait > 0:
+                self.timer = TimerService.default().call_later(wait, self.flush)
+                return
+            self.draw()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            self.draw()
+
+    def invalidate(self):
+        # Something else wrote to the terminal, the next frame redraws every row
+        with self.lock:
+            self.shown = None
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def frame(self):
+        rows = [f"---------------- {self.title} ----------------", *self.lines, self.RULE]
+        if self.prompt:
+            rows.append(self.prompt)
+        return rows
+
+    def draw(self):
+        # Called with the lock held
+        rows = self.frame()
+        out = []
+        if self.shown is None:
+            out.append(self.CLEAR_SCREEN)
+            self.shown = []
+        for i, row in enumerate(rows):
+            if i >= len(self.shown) or self.shown[i] != row:
+                out.append(f"\033[{i + 1};1H{row}{self.CLEAR_LINE}")
+        if len(rows) < len(self.shown):
+            out.append(f"\033[{len(rows) + 1};1H{self.CLEAR_BELOW}")
+
+        # Park the cursor after the prompt, or below the frame so other output does not overwrite it
+        if self.prompt:
+            out.append(f"\033[{len(rows)};{len(self.prompt) + 1}H")
+        else:
+            out.append(f"\033[{len(rows) + 1};1H")
+        self.stream.write(''.join(out))
+        self.stream.flush()
+
+        self.shown = rows
+        self.last_draw = time.monotonic()
+        self.frames += 1
@@ -0,0 +1,501 @@
+import asyncio
+import random
+import socket
+import sys
+import os
+from collections import namedtuple
+from abc import abstractmethod
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from .tcp_segment import *
+from .tcp_transport import *
+from helper.constants import *
+from helper.utils import *
+
+# One complete message, the trailing null terminator is stripped from the payload
+Message = namedtuple("Message", ["message_type", "timestamp", "payload"])
+
+# Sequenced message types, acknowledged like chat messages (1: message, 5: other command, 8: delta,
+# 9: snapshot, 10: history request)
+DATA_TYPES = (1, 5, 8, 9, 10)
+
+class AsyncTCPConnection:
+    """Application side of one TCPConnection of an AsyncTCPEndpoint, its segments are handled by TCPTransport"""
+
+    def __init__(self, endpoint, tcb):
+        self.endpoint = endpoint
+        self.tcb = tcb
+        self.remote = tcb.remote
+        self.handshake_payload = b''                # username carried by the SYN and the final ACK
+        self.messages = asyncio.Queue()             # (Message, bytes charged to the window), None once closed
+        self.window_open = asyncio.Event()          # set whenever an ACK may have opened the window
+        self.state_changed = asyncio.Event()        # set on every state change of tcb
+        self.send_lock = asyncio.Lock()             # chunks of two messages never interleave
+
+    def __repr__(self):
+        return f"<AsyncTCPConnection {self.remote} {self.tcb.state}>"
+
+    @property
+    def closed(self):
+        return self.tcb.closed
+
+    # ---------------- Application API ----------------
+
+    async def send(self, payload: bytes, message_type=1):
+        """Send one message, waiting for window space. Returns False if the connection closed first"""
+        payload = bytes(payload) + b'\x00'
+        payload_length = len(payload)
+        endpoint = self.endpoint
+        tcb = self.tcb
+        async with self.send_lock:
+            offset = 0
+            while offset < payload_length:
+                if tcb.state not in SENDING_STATES:
+                    print(f"[!] Connection to {self.remote} closed while sending")
+                    return False
+                size = min(tcb.send_mss, payload_length - offset)
+                space = endpoint.window_space(tcb)
+                if space < size:
+                    if space > 0 and tcb.next_seq_num == tcb.send_base:
+                        size = space # nothing in flight to wait for, fill the small window
+                    else:
+                        self.window_open.clear()
+                        await self.window_open.wait()
+                        continue
+                with tcb.lock:
+                    endpoint.send_chunk(tcb, payload[offset:offset + size], payload_length, message_type)
+                offset += size
+        return True
+
+    def send_control(self, message_type):
+        # Bare command segment (4: heartbeat, 6: kill, 7: failed kill), not sequenced
+        tcb = self.tcb
+        self.endpoint.send_segment(TCPSegment(
+            src_port=self.endpoint.local_port(),
+            dest_port=self.remote[1],
+            seq_num=tcb.next_seq_num,
+            ack_num=tcb.ack_num,
+            flags=0,
+            timestamp=current_timestamp(),
+            messagetype=message_type
+        ), self.remote)
+
+    async def recv(self):
+        """Next complete message, None once the connection is closed"""
+        item = await self.messages.get()
+        if item is None:
+            self.messages.put_nowait(None) # keep later readers from blocking
+            return None
+        message, charged = item
+        tcb = self.tcb
+        with tcb.lock:
+            if not tcb.closed:
+                self.endpoint.recv_drained(tcb, charged)
+                if tcb.recv_window_size - tcb.last_advertised >= min(2 * tcb.send_mss, tcb.recv_window_limit // 2):
+                    self.endpoint.send_ack(tcb) # window update
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.recv()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self, timeout=None):
+        """Client side: FIN (type 3) and wait for FIN-ACK. Server side: FIN (type 6) as the kill command does"""
+        if self.tcb.closed:
+            return
+        timeout = self.endpoint.timeout if timeout is None else timeout
+        if not self.endpoint.send_fin(self.tcb) and self.tcb.state not in (FIN_WAIT_1, FIN_WAIT_2):
+            return # the peer is closing already
+        if await self.wait_for_state((TIME_WAIT,), timeout) != TIME_WAIT:
+            if not self.tcb.closed:
+                print(f"[!] No FIN-ACK from {self.remote}, closing anyway")
+            self.endpoint.close_connection(self.remote, self.tcb)
+
+    async def wait_for_state(self, states, timeout):
+        # Returns the state of the connection once it is in one of states or closed, or timeout ran out
+        tcb = self.tcb
+        deadline = self.endpoint.loop.time() + timeout
+        while tcb.state not in states and tcb.state != CLOSED:
+            remaining = deadline - self.endpoint.loop.time()
+            if remaining <= 0:
+                break
+            self.state_changed.clear()
+            try:
+                await asyncio.wait_for(self.state_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return tcb.state
+
+    def push_control(self, seg):
+        # Heartbeats and commands reach the application as empty messages
+        self.messages.put_nowait((Message(seg.messagetype, seg.timestamp, b''), 0))
+
+    def finish(self):
+        # The connection is gone, wake every waiter
+        self.window_open.set()
+        self.state_changed.set()
+        self.messages.put_nowait(None)
+
+class AsyncTCPEndpoint(TCPTransport, asyncio.DatagramProtocol):
+    """UDP socket shared by every AsyncTCPConnection, speaks the same wire format as TCPBaseSocket"""
+    FIN_TYPE = 3 # message type of the FIN sent by close()
+
+    def __init__(self, mss=DEFAULT_MSS, congestion_control=DEFAULT_CONGESTION_CONTROL, delayed_ack=True, timeout=5.0):
+        super().__init__(mss, congestion_control, delayed_ack)
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.local_addr = None
+        self.timeout = timeout                      # seconds to wait for handshake and teardown replies
+        self.streams = {}                           # addr -> AsyncTCPConnection of connections[addr]
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.local_addr = transport.get_extra_info("sockname")[:2]
+        try:
+            # Room for bursts from many connections between two loop iterations, capped by the kernel
+            transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECV_BUFFER)
+        except OSError:
+            pass
+
+    def local_port(self):
+        return self.local_addr[1]
+
+    def open_stream(self, remote, iss, irs, state):
+        tcb = self.open_connection(remote, iss, irs, state)
+        stream = AsyncTCPConnection(self, tcb)
+        self.streams[remote] = stream
+        return stream
+
+    # ---------------- TCPTransport hooks ----------------
+
+    def send_datagram(self, data, remote):
+        self.transport.sendto(data, remote)
+
+    def call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    def on_state_change(self, tcb):
+        stream = self.streams.get(tcb.remote)
+        if stream is None or stream.tcb is not tcb:
+            return
+        if tcb.closed:
+            del self.streams[tcb.remote]
+            stream.finish()
+        else:
+            stream.state_changed.set()
+
+    def on_window_open(self, tcb):
+        stream = self.streams.get(tcb.remote)
+        if stream is not None and stream.tcb is tcb:
+            stream.window_open.set()
+
+    def recv_buffer_controller(self, tcb):
+        # The parts of an unfinished message are not charged to the window, a message may be larger than it.
+        # A complete one is charged until the application reads it
+        parts = tcb.recv_buffer
+        last = parts[-1]
+        length = sum(len(part["payload"]) for part in parts)
+        if length < last["payload_length"] and not last["payload"].endswith(b'\x00'):
+            tcb.recv_window_size += len(last["payload"])
+            return
+        tcb.recv_window_size -= length - len(last["payload"])
+        message = b''.join(part["payload"] for part in parts)
+        tcb.recv_buffer = []
+        if message.endswith(b'\x00'):
+            message = message[:-1]
+        stream = self.streams.get(tcb.remote)
+        if stream is not None:
+            stream.messages.put_nowait((Message(last["message_type"], last["timestamp"], message), length))
+
+    # ---------------- Teardown ----------------
+
+    def send_fin(self, tcb):
+        # Our FIN, resent until the peer answers it. False if the connection is not established
+        with tcb.lock:
+            if tcb.state != ESTABLISHED:
+                return False
+            if tcb.pending_ack is not None: # acknowledge what arrived before leaving
+                self.send_ack(tcb)
+            fin = TCPSegment(
+                src_port=self.local_port(),
+                dest_port=tcb.remote[1],
+                seq_num=tcb.next_seq_num,
+                ack_num=tcb.ack_num,
+                flags=FLAG_FIN,
+                windowsize=self.window_field(tcb),
+                timestamp=current_timestamp(),
+                messagetype=self.FIN_TYPE
+            )
+            # In the new state before the segment leaves, the answer may come back first
+            tcb.next_seq_num += 1
+            self.set_state(tcb, FIN_WAIT_1)
+            self.send_control(tcb, fin)
+        return True
+
+    def handle_fin(self, seg, tcb):
+        # The peer closes. Nothing is queued behind the application's sends, so the FIN-ACK answers at once
+        with tcb.lock:
+            if tcb.state == LAST_ACK and seg.seq_num + 1 == tcb.expected_seq_num: # our FIN-ACK got lost
+                self.repeat_control(tcb)
+                return
+            if tcb.state != ESTABLISHED:
+                return
+            tcb.expected_seq_num = seg.seq_num + 1
+            fin_ack = TCPSegment(
+                src_port=self.local_port(),
+                dest_port=tcb.remote[1],
+                seq_num=tcb.next_seq_num,
+                ack_num=tcb.expected_seq_num,
+                flags=FLAG_FIN_ACK,
+                windowsize=self.window_field(tcb),
+                timestamp=current_timestamp(),
+                messagetype=seg.messagetype
+            )
+            tcb.next_seq_num += 1
+            self.set_state(tcb, LAST_ACK)
+            self.send_control(tcb, fin_ack) # resent until the peer's final ACK
+
+    def handle_fin_ack(self, seg, tcb):
+        # The peer answered our FIN after everything it sent before, linger to repeat the final ACK
+        with tcb.lock:
+            if tcb.state == TIME_WAIT: # our final ACK got lost
+                self.repeat_control(tcb)
+                return
+            if tcb.state not in (FIN_WAIT_1, FIN_WAIT_2) or seg.ack_num != tcb.next_seq_num:
+                return
+            if seg.seq_num != tcb.ack_num: # data sent before the FIN-ACK is missing, wait for its resend
+                return
+            tcb.ack_num = seg.seq_num + 1
+            self.enter_time_wait(tcb, TCPSegment(
+                src_port=self.local_port(),
+                dest_port=tcb.remote[1],
+                seq_num=tcb.next_seq_num,
+                ack_num=tcb.ack_num,
+                flags=FLAG_ACK,
+                timestamp=current_timestamp(),
+                messagetype=self.FIN_TYPE
+            ))
+
+    # ---------------- Datagrams ----------------
+
+    def datagram_received(self, data, addr):
+        seg = TCPSegment.unpack(data)
+        if not seg:
+            print(f"Corrupted/Invalid segment received from {addr}")
+            return
+        self.dispatch(seg, addr)
+        seg.release() # nothing keeps the segment after handling
+
+    def error_received(self, exc):
+        print(f"[!] UDP error: {exc}")
+
+    @abstractmethod
+    def dispatch(self, seg, addr):
+        pass
+
+    def close(self):
+        for tcb in list(self.connections.values()):
+            self.close_connection(tcb.remote, tcb)
+        if self.transport is not None:
+            self.transport.close()
+
+class AsyncTCPServer(AsyncTCPEndpoint):
+    """Server side, await accept() for each established connection"""
+    FIN_TYPE = 6 # close() ends a connection as the kill command does
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.established = asyncio.Queue()
+
+    async def accept(self):
+        return await self.established.get()
+
+    def dispatch(self, seg, client):
+        flag = seg.flags
+        type = seg.messagetype
+        if (flag == FLAG_SYN and type == 2): # SYN Threeway Handshake
+            self.handshake_syn(seg, client)
+            return
+        tcb = self.connections.get(client)
+        if tcb is None:
+            return # not connected, nothing to answer
+        if tcb.state == SYN_RECEIVED and has_flag(flag, FLAG_ACK) and type != 2 and seg.ack_num == tcb.send_base:
+            self.handshake_final_ack(seg, tcb) # final ACK lost, a piggybacked ACK completes the handshake
+
+        if (flag == FLAG_FIN_ACK): # client answered our FIN
+            self.handle_fin_ack(seg, tcb)
+        elif (flag == FLAG_FIN):
+            if (type == 3):
+                self.handle_fin(seg, tcb)
+        elif (flag == FLAG_ACK):
+            if (type in DATA_TYPES):
+                self.receive_ack(seg, client)
+            elif (type == 2): # FINAL ACK Threeway Handshake
+                if tcb.state == SYN_RECEIVED:
+                    self.handshake_final_ack(seg, tcb)
+            elif (type == 3): # FINAL ACK FIN Termination
+                if tcb.state == LAST_ACK and seg.ack_num == tcb.next_seq_num:
+                    self.close_connection(client, tcb)
+        elif tcb.state != SYN_RECEIVED:
+            if (type in DATA_TYPES):
+                self.handle_sender_data(seg, client)
+            elif (type in (4, 6, 7)):
+                self.streams[client].push_control(seg)
+
+    def handshake_syn(self, seg, client):
+        tcb = self.connections.get(client)
+        if tcb is not None:
+            if tcb.state == SYN_RECEIVED and seg.seq_num + 1 == tcb.ack_num: # our SYN-ACK got lost
+                self.repeat_control(tcb)
+            else:
+                print(f"{client} is already connected to server")
+            return
+
+        y = random.randint(1, (1 << 31) - 1)
+        stream = self.open_stream(client, y, seg.seq_num, SYN_RECEIVED)
+        stream.handshake_payload = seg.payload
+        tcb = stream.tcb
+        peer_mss, peer_scale, peer_flags = seg.options()
+        mss = self.negotiate_mss(tcb, peer_mss)
+        self.negotiate_window_scale(tcb, peer_scale, peer_flags)
+        self.negotiate_ack_options(tcb, peer_flags)
+        self.init_recv_window(tcb, mss)
+        synack = TCPSegment(
+            src_port=self.local_port(),
+            dest_port=client[1],
+            seq_num=y,
+            ack_num=tcb.ack_num,
+            flags=FLAG_SYN_ACK,
+            timestamp=current_timestamp(),
+            windowsize=min(0xFFFF, tcb.recv_window_size), # never scaled on SYN-ACK
+            padding=self.handshake_options()
+        )
+        with tcb.lock:
+            self.send_control(tcb, synack) # resent until the final ACK
+
+    def handshake_final_ack(self, seg, tcb):
+        if seg.ack_num != tcb.send_base:
+            print(f"[!] Invalid ACK from {tcb.remote} — handshake rejected.")
+            self.close_connection(tcb.remote, tcb)
+            return
+        stream = self.streams[tcb.remote]
+        with tcb.lock:
+            self.stop_control(tcb)
+            tcb.remote_window_size = self.peer_window(tcb, seg.windowsize)
+            if seg.messagetype == 2:
+                stream.handshake_payload = seg.payload or stream.handshake_payload
+            self.set_state(tcb, ESTABLISHED)
+        self.established.put_nowait(stream)
+
+class AsyncTCPClient(AsyncTCPEndpoint):
+    """Client side, one connection to the server"""
+
+    async def connect(self, server_addr, username):
+        x = random.randint(1, (1 << 31) - 1)
+        stream = self.open_stream(server_addr, x, -1, SYN_SENT)
+        stream.handshake_payload = username.encode()
+        tcb = stream.tcb
+        syn = TCPSegment(
+            src_port=self.local_port(),
+            dest_port=server_addr[1],
+            seq_num=x,
+            ack_num=0,
+            flags=FLAG_SYN,
+            timestamp=current_timestamp(),
+            messagetype=2,
+            padding=self.handshake_options(),
+            payload=stream.handshake_payload
+        )
+        with tcb.lock:
+            self.send_control(tcb, syn) # resent until the SYN-ACK
+
+        if await stream.wait_for_state((ESTABLISHED,), self.timeout) != ESTABLISHED:
+            print("[!] Timeout waiting for SYN-ACK — connection failed.")
+            self.close_connection(server_addr, tcb)
+            return None
+        return stream
+
+    def close_connection(self, remote, tcb=None):
+        # The endpoint exists for this one connection
+        closed = super().close_connection(remote, tcb)
+        if closed is not None and self.transport is not None:
+            self.transport.close()
+        return closed
+
+    def dispatch(self, seg, server):
+        tcb = self.connections.get(server)
+        if tcb is None:
+            return
+        flag = seg.flags
+        type = seg.messagetype
+        if (flag == FLAG_SYN_ACK):
+            self.handle_synack(seg, tcb)
+        elif (flag == FLAG_ACK and type in DATA_TYPES): # acknowledgement of data being sent
+            self.receive_ack(seg, server)
+        elif (flag == FLAG_ACK and type == 3): # the server got our FIN, its FIN-ACK follows the data it still sends
+            with tcb.lock:
+                if tcb.state == FIN_WAIT_1 and seg.ack_num == tcb.next_seq_num:
+                    self.stop_control(tcb)
+                    self.set_state(tcb, FIN_WAIT_2)
+        elif (flag == FLAG_ACK and type == 6): # server shutdown completed
+            if tcb.state != TIME_WAIT:
+                self.close_connection(server, tcb)
+        elif (flag == FLAG_FIN): # server initiated shutdown
+            self.handle_fin(seg, tcb)
+        elif (flag == FLAG_FIN_ACK): # answer to our FIN
+            self.handle_fin_ack(seg, tcb)
+        elif (type in DATA_TYPES and tcb.state != SYN_SENT): # chat log, delta or snapshot
+            self.handle_sender_data(seg, server)
+
+    def handle_synack(self, seg, tcb):
+        with tcb.lock:
+            if tcb.state == ESTABLISHED and seg.seq_num + 1 == tcb.ack_num: # our final ACK got lost
+                self.send_final_ack(tcb)
+                return
+            if tcb.state != SYN_SENT or seg.ack_num != tcb.send_base:
+                return
+            tcb.ack_num = seg.seq_num + 1
+            tcb.remote_window_size = seg.windowsize
+            peer_mss, peer_scale, peer_flags = seg.options()
+            mss = self.negotiate_mss(tcb, peer_mss)
+            self.negotiate_window_scale(tcb, peer_scale, peer_flags)
+            self.negotiate_ack_options(tcb, peer_flags)
+            self.stop_control(tcb)
+            self.init_recv_window(tcb, mss)
+            self.send_final_ack(tcb)
+            self.set_state(tcb, ESTABLISHED)
+
+    def send_final_ack(self, tcb):
+        self.send_segment(TCPSegment(
+            src_port=self.local_port(),
+            dest_port=tcb.remote[1],
+            seq_num=tcb.send_base,
+            ack_num=tcb.ack_num,
+            flags=FLAG_ACK,
+            timestamp=current_timestamp(),
+            messagetype=2,
+            windowsize=self.window_field(tcb),
+            payload=self.streams[tcb.remote].handshake_payload
+        ), tcb.remote)
+
+async def start_server(host, port, **kwargs):
+    """Bind an AsyncTCPServer on (host, port)"""
+    loop = asyncio.get_running_loop()
+    _, server = await loop.create_datagram_endpoint(lambda: AsyncTCPServer(**kwargs), local_addr=(host, port))
+    print(f"Listening on port {(host, port)}...")
+    return server
+
+async def open_connection(server_ip, server_port, username, local_addr=("0.0.0.0", 0), **kwargs):
+    """Connect to a TCPServerSocket or AsyncTCPServer, returns the AsyncTCPConnection or None"""
+    loop = asyncio.get_running_loop()
+    _, client = await loop.create_datagram_endpoint(lambda: AsyncTCPClient(**kwargs), local_addr=local_addr)
+    conn = await client.connect((server_ip, server_port), username)
+    if conn is None:
+        client.close()
+    return conn
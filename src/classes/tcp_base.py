@@ -12,133 +12,141 @@ from abc import ABC, abstractmethod
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
 
 from .tcp_segment import *
+from .tcp_retransmission import *
+from .tcp_congestion import *
+from .tcp_reassembly import *
+from .tcp_timer_wheel import *
+from .tcp_connection import *
+from .tcp_transport import *
 from helper.constants import *
 from helper.utils import *
 
-class TCPBaseSocket:
-    def __init__(self, local_port, ip_address="0.0.0.0", udp_socket=None, handler=None):
+class TCPBaseSocket(TCPTransport):
+    def __init__(self, local_port, ip_address="0.0.0.0", udp_socket=None, handler=None, mss=DEFAULT_MSS,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, delayed_ack=True):
+        super().__init__(mss, congestion_control, delayed_ack)
         self.udp = udp_socket or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.local_addr = (ip_address, local_port)
 
         self.handler = handler
-        self.remote_addr = [] # List of (ip, port) tuples
-
-        # Sequence and ACK tracking
-        self.ack_num = {}                                       # addr -> ack to send to sender                 RECEIVER
-        self.seq_num = {}                                      
-
-        # Sliding window
-        self.recv_window_size = defaultdict(lambda: 5 * 104)    # window size advertised to other sockets       RECEIVER
-        self.remote_window_size = defaultdict(lambda: 5 * 104)  # window size advertised to this socket         SENDER                         
-        self.send_base = {}                                     # base after threeway handshake                 SENDER
-        self.next_seq_num = {}                                  # next seq_num after sending                    SENDER
-        self.unacked_segments = {}                              # seq_num -> remote, segment still in flight/not ACKED  SENDER
-        self.expected_seq_nums = {}                             # addr -> expected seq                      SENDER
-        self.expected_ack_nums = {}                              
-        self.timer_start = {}  
-
-        # Recv buffer
-        self.recv_buffer = {} # addr -> [{seq_num, message_type, timestamp, total_payload_length, payload}]
-
-    def send_segment(self, segment: TCPSegment, remote): 
-        # print(f"Send to remote: {remote}")
-        packed = segment.pack()
-        self.udp.sendto(packed, remote)
-
-    def send_data(self, remote_addr, payload: bytes, message_type):
+
+        self.state_changed = threading.Condition()              # notified on every connection state change
+        self.unsent_bytes = 0                                   # message bytes given up before they were sent
+        self.unsent_segments = 0
+        self.unsent_lock = threading.Lock()
+
+    def send_datagram(self, data, remote):
+        self.udp.sendto(data, remote)
+
+    def on_state_change(self, tcb):
+        with self.state_changed:
+            self.state_changed.notify_all()
+
+    def on_window_open(self, tcb):
+        if tcb.window_available is not None: # nobody waited for this connection yet
+            tcb.window_available.notify_all()
+
+    def wait_for_state(self, tcb, states, timeout=None):
+        # Blocks until the connection is in one of states or closed, returns the state it is in
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: tcb.state in states or tcb.state == CLOSED, timeout)
+            return tcb.state
+
+    def call_later(self, delay, callback, *args):
+        # Run callback after delay seconds on the process wide timer thread, returns a handle with cancel()
+        return TimerService.default().call_later(delay, callback, *args)
+
+    def get_window_condition(self, tcb):
+        # Signalled whenever the send window of the connection may have opened
+        with tcb.lock:
+            if tcb.window_available is None:
+                tcb.window_available = threading.Condition(tcb.lock)
+            return tcb.window_available
+
+    def send_data(self, remote_addr, payload: bytes, message_type, timeout=None):
+        """Send payload, waiting for window space. Returns False if timeout (seconds) ran out first"""
         payload += b'\x00'
-        max_payload = 64
         payload_length = len(payload)
-        self.next_seq_num[remote_addr]
-        chunks = [payload[i:i + max_payload] for i in range(0, len(payload), max_payload)]
-
-        for chunk in chunks:
-            while True:
-                # Check sliding window capacity
-                send_base = self.send_base.get(remote_addr, 0)
-                next_seq = self.next_seq_num.get(remote_addr, 0)
-                window = self.remote_window_size.get(remote_addr, 0)
-                in_flight = next_seq - send_base
-                # print(f"Nextseq: {next_seq}, Sendbase: {send_base}, In-flight: {in_flight}")
-
-                if next_seq >= send_base and in_flight + len(chunk) <= window:
-                    # Can send
-                    segment = TCPSegment(
-                        src_port=self.local_addr[1],
-                        dest_port=remote_addr[1],
-                        seq_num=next_seq,
-                        ack_num=0,
-                        flags=0,
-                        payload=chunk,
-                        payloadlength=payload_length,
-                        timestamp=int(time.time()),
-                        messagetype=message_type
-                    )
-
-                    # Sending
-                    self.send_segment(segment, remote_addr)
-                    # print(f"[SEND] Sent segment {next_seq} to {remote_addr}")
-
-                    # Track unacked
-                    if next_seq not in self.unacked_segments:
-                        self.unacked_segments[next_seq] = []
-                    self.unacked_segments[next_seq].append((remote_addr, segment))
-
-                    # Advance window
-                    self.next_seq_num[remote_addr] = next_seq + len(chunk)
-                    break  
-                else:
-                    # print(f"[WAIT] Window full, waiting to send...")
-                    if (next_seq < send_base):
-                        print(f"Failed to send message, sequence number error lower than base")
-                        return
-                    # print(f"[WAIT] Window full: windowsize = {window}, in_flight = {in_flight}, length = {len(chunk)}, waiting to send...")
-                    time.sleep(0.2)  # Wait before retrying
-    
-    def handle_sender_data(self, segment, sender):
-        seq = segment.seq_num
-        payload = segment.payload
-
-        # Accept and update
-        self.ack_num[sender] = seq + len(payload)
-        self.recv_window_size[sender] -= len(payload) 
-        if sender not in self.recv_buffer:
-            self.recv_buffer[sender] = []
-        self.recv_buffer[sender].append({
-            "seq_num": seq,
-            "message_type": segment.messagetype,
-            "timestamp": segment.timestamp,
-            "payload": segment.payload,
-            "payload_length": segment.payloadlength
-        })
-        self.recv_buffer_controller(sender)
-
-        ack = TCPSegment(
-            src_port=self.local_addr[1],
-            dest_port=sender[1],
-            seq_num=0,
-            ack_num=self.ack_num[sender],
-            flags=FLAG_ACK,
-            timestamp=int(time.time()),
-            windowsize=self.recv_window_size[sender],
-            messagetype=segment.messagetype
-        )
-        # print(f"140 address {client}")
-        # print(f"server address {self.local_addr}")
-        self.udp.sendto(ack.pack(), sender)
-        # print(f"Sent ACK to {sender} for received segment {segment.seq_num} with ACK: {self.ack_num[sender]}")
-    
-    def receive_ack(self, seg, sender):
-        to_remove = []
-        # print(f"[RECEIVE] Received from {sender} ACK: {seg.ack_num}")
-        for seq_num, _ in self.unacked_segments.items():
-            if seq_num + len(seg.payload) <= seg.ack_num:
-                self.send_base[sender] = max(self.send_base.get(sender, 0), seg.ack_num)
-                self.remote_window_size[sender] = seg.windowsize
-                to_remove.append(seq_num)
-        for seq_num in to_remove:
-            del self.unacked_segments[seq_num]
-
-    @abstractmethod
-    def recv_buffer_controller(self, sender):
-        pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        tcb = self.connections.get(remote_addr)
+        if tcb is None:
+            print(f"[!] No connection to {remote_addr}")
+            self.drop_unsent(payload_length, self.mss)
+            return False
+        with tcb.lock: # other connections keep sending and receiving ACKs meanwhile
+            offset = 0
+            while offset < payload_length:
+                size = self.wait_for_window(tcb, min(tcb.send_mss, payload_length - offset), deadline)
+                if size is None:
+                    self.drop_unsent(payload_length - offset, tcb.send_mss)
+                    return False
+                self.send_chunk(tcb, payload[offset:offset + size], payload_length, message_type)
+                offset += size
+        return True
+
+    def send_templates(self, remote_addr, payload: bytes, templates, mss, message_type, timeout=None):
+        """send_data for a message already terminated, segmented by mss and packed into templates (see TCPSegment.patch)"""
+        payload_length = len(payload)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        tcb = self.connections.get(remote_addr)
+        if tcb is None:
+            print(f"[!] Connection to {remote_addr} closed while sending")
+            self.drop_unsent(payload_length, mss)
+            return False
+        with tcb.lock:
+            offset = 0
+            while offset < payload_length:
+                size = self.wait_for_window(tcb, min(mss, payload_length - offset), deadline)
+                if size is None:
+                    self.drop_unsent(payload_length - offset, mss)
+                    return False
+                index, misaligned = divmod(offset, mss)
+                if not misaligned and size == min(mss, payload_length - offset):
+                    self.send_template(tcb, templates[index], size)
+                else: # a small window split a segment, the rest is packed per connection
+                    self.send_chunk(tcb, payload[offset:offset + size], payload_length, message_type)
+                offset += size
+        return True
+
+    def drop_unsent(self, remaining, mss):
+        # Rest of a message that will never go out
+        with self.unsent_lock:
+            self.unsent_bytes += remaining
+            self.unsent_segments += -(-remaining // mss)
+
+    def wait_for_window(self, tcb, size, deadline):
+        # Bytes of the next segment that may go out, sleeps until an ACK opens the window. None on failure
+        window_available = self.get_window_condition(tcb)
+        while True:
+            if tcb.state not in SENDING_STATES:
+                print(f"[!] Connection to {tcb.remote} closed while sending")
+                return None
+            space = self.window_space(tcb)
+            if space >= size:
+                return size
+            if space > 0 and tcb.next_seq_num == tcb.send_base:
+                return space # nothing in flight to wait for, fill the small window
+            # print(f"[WAIT] Window full, waiting to send...")
+            if (tcb.next_seq_num < tcb.send_base):
+                print(f"Failed to send message, sequence number error lower than base")
+                return None
+            if deadline is None:
+                window_available.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"[!] Timed out waiting for window space to {tcb.remote}")
+                    return None
+                window_available.wait(remaining)
+
+    def try_send_data(self, remote_addr, payload: bytes, message_type):
+        """Send payload only if the whole message fits in the window right now, never blocks"""
+        tcb = self.connections.get(remote_addr)
+        if tcb is None:
+            return False
+        with tcb.lock:
+            if self.window_space(tcb) < len(payload) + 1:
+                return False
+            return self.send_data(remote_addr, payload, message_type)
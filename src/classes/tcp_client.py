@@ -11,16 +11,18 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
 from helper.constants import *
 from helper.utils import *
 from classes.tcp_base import *
+from classes.tcp_worker_pool import *
 
 class TCPClientSocket(TCPBaseSocket):
-    def __init__(self, local_port, server_ip, server_port, ip_address="127.0.0.1", udp_socket=None, handler=None):
-        super().__init__(local_port, ip_address, udp_socket, handler=handler)
+    def __init__(self, local_port, server_ip, server_port, ip_address="127.0.0.1", udp_socket=None, handler=None, mss=DEFAULT_MSS,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, delayed_ack=True):
+        super().__init__(local_port, ip_address, udp_socket, handler=handler, mss=mss, congestion_control=congestion_control,
+                         delayed_ack=delayed_ack)
         self.server_addr = (server_ip, server_port)
-        self.remote_addr.append(self.server_addr)  
         self.running = True
-        self.lock = threading.Lock()
-        self.termination_state = {}  # Track termination state
-        self.TIMEOUT_DURATION = 10.0  # seconds for termination timeout
+        self.receiver = None        # thread reading the socket, started by connect
+        self.username = None        # sent again with the final ACK when the server repeats its SYN-ACK
+        self.workers = SerialWorkerPool(workers=CLIENT_WORKER_THREADS, name="client-worker") # segments from the server, in order
 
     def bind(self):
         if self.local_addr is None:
@@ -28,13 +30,23 @@ class TCPClientSocket(TCPBaseSocket):
         self.udp.bind(self.local_addr)
         print(f"Running on {self.local_addr}...")
 
-    def connect(self, username):
-        print(f"Client {self.local_addr} is connecting to server ip: {self.remote_addr[0][0]}, server port: {self.remote_addr[0][1]}")
-        remote = self.remote_addr[0]
+    def start_receiving(self):
+        # One receive thread for the socket's lifetime, shared by every connection made through it
+        if self.receiver is None:
+            self.receiver = threading.Thread(target=self.receive_loop, name="client-receiver", daemon=True)
+            self.receiver.start()
+
+    def connect(self, username, timeout=5.0):
+        print(f"Client {self.local_addr} is connecting to server ip: {self.server_addr[0]}, server port: {self.server_addr[1]}")
+        remote = self.server_addr
+        self.username = username
+        self.start_receiving()
 
         x = random.randint(1, (1 << 31) - 1)
         seq_num = x
-        
+        # send_base = next_seq_num = x + 1, ack_num is set by the SYN-ACK
+        tcb = self.open_connection(remote, x, -1, SYN_SENT)
+
         # SENDING SYN
         syn_seg = TCPSegment(
             src_port=self.local_addr[1],
@@ -42,218 +54,233 @@ class TCPClientSocket(TCPBaseSocket):
             seq_num=seq_num,
             ack_num=0,
             flags=FLAG_SYN,
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=2,
+            padding=self.handshake_options(),
             payload=username.encode()
         )
         print(f"Remote: {remote}")
-        self.udp.sendto(syn_seg.pack(), remote)
+        with tcb.lock:
+            self.send_control(tcb, syn_seg) # resent until the SYN-ACK
         print("\u2192 Sent SYN")
 
-        # RECEIVING SYN-ACK
-        synack_seg = None
-        try:
-            self.udp.settimeout(5.0)
-            while True:
-                data, _ = self.udp.recvfrom(128)
-                synack_seg = TCPSegment.unpack(data)
-                if not synack_seg:
-                    print("[!] Corrupted SYN-ACK segment — retrying...")
-                    continue
-                if synack_seg.flags != FLAG_SYN_ACK or synack_seg.ack_num != seq_num + 1:
-                    print(f"[!] Invalid SYN-ACK received: ")
-                    print(f"Is SYN-ACK: {synack_seg.flags == FLAG_SYN_ACK}")
-                    print(f"Expected ACK: {seq_num + 1}")
-                    print(f"Received ACK: {synack_seg.ack_num}")
-                    continue
-                break # success
-        except socket.timeout:
+        # RECEIVING SYN-ACK, handled on the receive thread
+        if self.wait_for_state(tcb, (ESTABLISHED,), timeout) != ESTABLISHED:
             print("[!] Timeout waiting for SYN-ACK — connection failed.")
+            self.close_connection(remote, tcb)
             return False
-        finally:
-            self.udp.settimeout(None)
+        print("Connection established.")
+        return True
 
-        # Setting the trio and window size
-        self.send_base[remote] = x + 1
-        self.next_seq_num[remote] = x + 1
-        self.ack_num[remote] = synack_seg.seq_num + 1 # y + 1
-        self.remote_window_size[remote] = synack_seg.windowsize
+    def handle_synack(self, synack_seg):
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None:
+            return
+        with tcb.lock:
+            if tcb.state == ESTABLISHED and synack_seg.seq_num + 1 == tcb.ack_num: # our final ACK got lost
+                self.send_final_ack(tcb)
+                return
+            if tcb.state != SYN_SENT:
+                return
+            if synack_seg.ack_num != tcb.send_base:
+                print(f"[!] Invalid SYN-ACK received: ")
+                print(f"Expected ACK: {tcb.send_base}")
+                print(f"Received ACK: {synack_seg.ack_num}")
+                return
+
+            # Setting the trio and window size, ack_num = y + 1
+            tcb.ack_num = synack_seg.seq_num + 1
+            tcb.remote_window_size = synack_seg.windowsize
+            peer_mss, peer_scale, peer_flags = synack_seg.options()
+            mss = self.negotiate_mss(tcb, peer_mss)
+            self.negotiate_window_scale(tcb, peer_scale, peer_flags)
+            self.negotiate_ack_options(tcb, peer_flags)
+            self.stop_control(tcb)
 
-        print("\u2190 Received SYN-ACK")
+            print("\u2190 Received SYN-ACK")
 
-        # SENDING FINAL ACK
-        self.recv_window_size[self.server_addr] = 5*104
+            # SENDING FINAL ACK
+            self.init_recv_window(tcb, mss)
+            self.send_final_ack(tcb)
+            print("\u2192 Sent final ACK")
+            self.set_state(tcb, ESTABLISHED)
 
+    def send_final_ack(self, tcb):
         ack_seg = TCPSegment(
             src_port=self.local_addr[1],
-            dest_port=remote[1],
-            seq_num=self.next_seq_num[remote],
-            ack_num=self.ack_num[remote],
+            dest_port=tcb.remote[1],
+            seq_num=tcb.send_base,
+            ack_num=tcb.ack_num,
             flags=FLAG_ACK,
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=2,
-            windowsize=self.recv_window_size[self.server_addr],
-            payload=username.encode()
+            windowsize=self.window_field(tcb),
+            payload=self.username.encode()
         )
-
-        self.udp.sendto(ack_seg.pack(), remote)
-        print("\u2192 Sent final ACK")
-        print("Connection established.")
-        return True
+        self.send_segment(ack_seg, tcb.remote)
 
     def initiate_termination(self):
-        """Initiate connection termination (client side)"""
+        """Initiate connection termination (client side). Returns False if there is nothing to close"""
         print("[CLIENT] Initiating connection termination...")
         
-        with self.lock:
-            if self.server_addr in self.termination_state:
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None:
+            print("[CLIENT] Not connected")
+            return False
+        with tcb.lock:
+            if tcb.state != ESTABLISHED:
                 print("[CLIENT] Termination already in progress")
-                return
-                
-            # Set termination state
-            self.termination_state[self.server_addr] = "FIN_WAIT_1"
-            
-            current_seq = self.next_seq_num.get(self.server_addr, 0)
+                return False
+
+            current_seq = tcb.next_seq_num
             fin_segment = TCPSegment(
                 src_port=self.local_addr[1],
                 dest_port=self.server_addr[1],
                 seq_num=current_seq,
-                ack_num=self.ack_num.get(self.server_addr, 0),
+                ack_num=tcb.ack_num,
                 flags=FLAG_FIN,
-                windowsize=self.recv_window_size.get(self.server_addr, 0),
-                timestamp=int(time.time()),
+                windowsize=self.window_field(tcb),
+                timestamp=current_timestamp(),
                 messagetype=3  # Leave message type
             )
             
+            # Update sequence number, before sending as the answer may come back first
+            tcb.next_seq_num = current_seq + 1
+            self.set_state(tcb, FIN_WAIT_1)
             try:
-                self.udp.sendto(fin_segment.pack(), self.server_addr)
+                self.send_control(tcb, fin_segment) # resent until the server acknowledges it
                 print(f"→ Sent FIN (seq={current_seq}) to server")
-                
-                # Update sequence number
-                self.next_seq_num[self.server_addr] = current_seq + 1
-                
             except Exception as e:
                 print(f"[ERROR] Failed to send FIN: {e}")
                 traceback.print_exc()
-            
-
-                    
-
+                return False
+            return True
+
+    def disconnect(self, timeout=None):
+        """Close the connection with the server and wait for the close handshake, the socket stays usable
+        for the next connect. Returns False if the server did not finish it in time. The handler is told
+        once TIME_WAIT is over"""
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None or not self.initiate_termination():
+            return False
+        return self.wait_for_state(tcb, (TIME_WAIT,), timeout) == TIME_WAIT
 
     def handle_termination_segment(self, segment):
-        current_state = self.termination_state.get(self.server_addr)
-        
-        if current_state == "FIN_WAIT_1":
-            if has_flag(segment.flags, FLAG_FIN_ACK):
-                expected_ack = self.next_seq_num.get(self.server_addr, 0)
-                print(f"← Received FIN-ACK (ack={segment.ack_num})")
-                
-                self.send_final_termination_ack(segment)
-                self.termination_state[self.server_addr] = "TIME_WAIT"
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None:
+            return False
+        with tcb.lock:
+            if tcb.state == TIME_WAIT and segment.flags == FLAG_FIN_ACK: # our final ACK got lost
+                self.repeat_control(tcb)
+                return True
+            if tcb.state not in (FIN_WAIT_1, FIN_WAIT_2) or segment.ack_num != tcb.next_seq_num:
+                return False
+
+            if segment.flags == FLAG_ACK:
+                # The server got our FIN and may still send, its FIN-ACK comes after that data
+                self.stop_control(tcb)
+                self.set_state(tcb, FIN_WAIT_2)
                 return True
-        return False
+            if segment.seq_num != tcb.ack_num: # data sent before the FIN-ACK is missing, wait for its resend
+                return False
+
+            print(f"← Received FIN-ACK (ack={segment.ack_num})")
+            self.send_final_termination_ack(tcb, segment)
+        return True
 
-    def send_final_termination_ack(self, received_segment):
+    def send_final_termination_ack(self, tcb, received_segment):
+        tcb.ack_num = received_segment.seq_num + 1
         ack_segment = TCPSegment(
             src_port=self.local_addr[1],
             dest_port=self.server_addr[1],
-            seq_num=self.next_seq_num.get(self.server_addr, 0),
-            ack_num=received_segment.seq_num + 1,
+            seq_num=tcb.next_seq_num,
+            ack_num=tcb.ack_num,
             flags=FLAG_ACK,
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=3  # Leave message type
         )
         
         try:
-            self.udp.sendto(ack_segment.pack(), self.server_addr)
+            self.enter_time_wait(tcb, ack_segment)
             print(f"→ Sent final ACK (ack={ack_segment.ack_num})")
-            self.disconnect()  
         except Exception as e:
             print(f"[ERROR] Failed to send final ACK: {e}")
 
+    def time_wait_done(self, tcb):
+        # The application hears of the close once TIME_WAIT is over, disconnect() has returned by then
+        if super().time_wait_done(tcb) is not None:
+            self.connection_closed(3)
+
     def handle_server_shutdown(self, segment):
         """Handle server-initiated connection termination"""
-        print("[CLIENT] Server initiated shutdown")
-        
-        with self.lock:
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None:
+            return
+        with tcb.lock:
+            if tcb.closed:
+                return
+            if tcb.state == LAST_ACK: # our FIN-ACK got lost
+                self.repeat_control(tcb)
+                return
+            print("[CLIENT] Server initiated shutdown")
+
             # Update expected sequence numbers
-            if self.server_addr not in self.expected_seq_nums:
-                self.expected_seq_nums[self.server_addr] = segment.seq_num
+            tcb.expected_seq_num = segment.seq_num + 1
                 
             # Send FIN-ACK response
             fin_ack_segment = TCPSegment(
                 src_port=self.local_addr[1],
                 dest_port=self.server_addr[1],
-                seq_num=self.next_seq_num.get(self.server_addr, 0),
+                seq_num=tcb.next_seq_num,
                 ack_num=segment.seq_num + 1,
                 flags=FLAG_FIN_ACK,
-                timestamp=int(time.time()),
+                timestamp=current_timestamp(),
                 messagetype=6  # Shutdown response
             )
             
+            # Update sequence number
+            tcb.next_seq_num = fin_ack_segment.seq_num + 1
+            self.set_state(tcb, LAST_ACK)
             try:
-                self.udp.sendto(fin_ack_segment.pack(), self.server_addr)
+                self.send_control(tcb, fin_ack_segment) # resent until the server's ACK
                 print(f"→ Sent FIN-ACK (seq={fin_ack_segment.seq_num}, ack={fin_ack_segment.ack_num})")
-                
-                # Update sequence number
-                self.next_seq_num[self.server_addr] = fin_ack_segment.seq_num + 1
-                self.termination_state[self.server_addr] = "LAST_ACK"
-
-                # Wait for final ACK
-                # self.wait_for_final_ack()
-
             except Exception as e:
                 print(f"[ERROR] Failed to send FIN-ACK: {e}")
-                
 
-    def wait_for_final_ack(self):
-        try:
-            self.udp.settimeout(self.TIMEOUT_DURATION)
-            start_time = time.time()
-
-            while time.time() - start_time < self.TIMEOUT_DURATION:
-                try:
-                    data, addr = self.udp.recvfrom(128)
-                    if addr != self.server_addr:
-                        continue
- 
-                    segment = TCPSegment.unpack(data)
-                    if not segment:
-                        continue
- 
-                    # Check for final ACK
-                    if has_flag(segment.flags, FLAG_ACK):
-                        expected_ack = self.next_seq_num.get(self.server_addr, 0)
-                        if segment.ack_num == expected_ack:
-                            print(f"← Received final ACK (ack={segment.ack_num})")
-                            print("[CLIENT] Connection terminated by server")
-                            break
-
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    print(f"[ERROR] During final ACK wait: {e}")
-                    break
-
-        except Exception as e:
-            print(f"[ERROR] Final ACK timeout: {e}")
-        finally:
-            self.udp.settimeout(None)
+    def handle_server_closed(self):
+        # The server shuts down and drops every connection
+        tcb = self.connections.get(self.server_addr)
+        if tcb is None or tcb.state == TIME_WAIT:
+            return
+        print("[CLIENT] Server closed the connection")
+        if self.close_connection(self.server_addr, tcb) is not None:
+            self.connection_closed(6)
+
+    def drop_connection(self, tcb):
+        # connect() reports a failed handshake itself
+        state = tcb.state
+        if self.close_connection(tcb.remote, tcb) is not None and state != SYN_SENT:
+            self.connection_closed(3)
+
+    def connection_closed(self, message_type):
+        # The application hears of the end of the connection as a message without payload
+        if self.handler is not None:
+            self.handler(b'', 0, message_type)
 
     def send_kill_signal(self, remote_addr):
         # Send a kill signal to the server
         kill_segment = TCPSegment(
             src_port=self.local_addr[1],
             dest_port=remote_addr[1],
-            seq_num=self.next_seq_num.get(remote_addr, 0),
-            ack_num=self.ack_num.get(remote_addr, 0),
+            seq_num=self.next_seq(remote_addr),
+            ack_num=self.next_ack(remote_addr),
             flags=0, # No flags for kill signal
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=6  # Kill message type
         )
         
         try:
-            self.udp.sendto(kill_segment.pack(), remote_addr)
+            self.send_segment(kill_segment, remote_addr)
             print(f"→ Sent KILL signal to {remote_addr}")
         except Exception as e:
             print(f"[ERROR] Failed to send KILL signal: {e}")
@@ -263,15 +290,15 @@ class TCPClientSocket(TCPBaseSocket):
         failed_kill_segment = TCPSegment(
             src_port=self.local_addr[1],
             dest_port=remote_addr[1],
-            seq_num=self.next_seq_num.get(remote_addr, 0),
-            ack_num=self.ack_num.get(remote_addr, 0),
+            seq_num=self.next_seq(remote_addr),
+            ack_num=self.next_ack(remote_addr),
             flags=0, # No flags for failed kill signal
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=7  # Failed kill message type
         )
         
         try:
-            self.udp.sendto(failed_kill_segment.pack(), remote_addr)
+            self.send_segment(failed_kill_segment, remote_addr)
             print(f"→ Sent FAILED KILL signal to {remote_addr}")
         except Exception as e:
             print(f"[ERROR] Failed to send FAILED KILL signal: {e}")
@@ -299,35 +326,57 @@ class TCPClientSocket(TCPBaseSocket):
             print(f"[ERROR] Sending message: {e}")
 
     def receive_message_tcp(self):
+        # Blocks until the socket is closed
+        self.start_receiving()
+        self.receiver.join()
+
+    def receive_loop(self):
         while self.running:
             try:
-                data, receive_addr = self.udp.recvfrom(128)
+                data, receive_addr = self.udp.recvfrom(self.recv_size)
+                if not self.running: # woken up by close()
+                    break
                 segment = TCPSegment.unpack(data)
+                if not segment:
+                    print(f"Corrupted/Invalid segment received from {receive_addr}")
+                    continue
                 
-                if receive_addr not in self.remote_addr:
-                    self.remote_addr.append(receive_addr)
-                    
-                if (segment.flags == FLAG_ACK and segment.messagetype == 1): # acknowledgement of data being sent 
-                    threading.Thread(target=self.receive_ack(segment, receive_addr), daemon=True).start()
-                elif (segment.flags == FLAG_ACK and segment.messagetype == 6): 
-                    self.disconnect()  # Handle server shutdown
-                elif (segment.flags != FLAG_ACK and segment.messagetype == 1): # message
-                    threading.Thread(target=self.handle_sender_data(segment, receive_addr), daemon=True).start()
-                elif (segment.flags == FLAG_FIN):
-                    self.handle_server_shutdown(segment)
-                elif segment.flags == FLAG_FIN_ACK:
-                    self.handle_termination_segment(segment)
+                if receive_addr not in self.connections: # not the server, or not connected
+                    segment.release()
+                    continue
+
+                # Handled in arrival order off the receive thread, a full queue drops it like the network would
+                if not self.workers.submit(receive_addr, self.dispatch, segment, receive_addr):
+                    segment.release()
             except Exception as e:
                 if self.running:
                     print(f"[CLIENT] Receive port lost connection. Error: {e}")
                     traceback.print_exc()
                 self.running = False
 
-    def recv_buffer_controller(self, server):
-        server_buffer = self.recv_buffer[server]
+    def dispatch(self, segment, receive_addr):
+        if (segment.flags == FLAG_SYN_ACK):
+            self.handle_synack(segment)
+        elif (segment.flags == FLAG_ACK and segment.messagetype in (1, 5, 10)): # acknowledgement of data being sent 
+            self.receive_ack(segment, receive_addr)
+        elif (segment.flags == FLAG_ACK and segment.messagetype == 3): # the server got our FIN
+            self.handle_termination_segment(segment)
+        elif (segment.flags == FLAG_ACK and segment.messagetype == 6): 
+            self.handle_server_closed()  # Handle server shutdown
+        elif (segment.flags != FLAG_ACK and segment.messagetype in (1, 8, 9)): # chat log, delta or snapshot
+            self.handle_sender_data(segment, receive_addr)
+        elif (segment.flags == FLAG_FIN):
+            self.handle_server_shutdown(segment)
+        elif segment.flags == FLAG_FIN_ACK:
+            self.handle_termination_segment(segment)
+        segment.release() # nothing keeps the segment after handling
+
+    def recv_buffer_controller(self, tcb):
+        server_buffer = tcb.recv_buffer
         message_parts = [] 
         current_payload_length = 0
         current_total_length = 0
+        current_messagetype = 0
 
         ends_with_null = False
 
@@ -335,18 +384,28 @@ class TCPClientSocket(TCPBaseSocket):
             message_parts.append(part["payload"])
             current_payload_length += len(part["payload"])
             current_total_length = part["payload_length"]
+            current_messagetype = part["message_type"]
 
             if part["payload"].endswith(b'\x00'):
                 ends_with_null = True
 
         is_message_complete = current_payload_length == current_total_length
-        force_flush = self.recv_window_size[server] < 104 or (self.next_seq_num.get(server, 0) - self.send_base.get(server, 0) + 64) > self.recv_window_size[server]
+        mss = tcb.send_mss
+        force_flush = tcb.recv_window_size < TCPSegment.HEADER_SIZE + mss or (tcb.next_seq_num - tcb.send_base + mss) > tcb.recv_window_size
 
         if is_message_complete or ends_with_null or force_flush:
             full_payload = b''.join(message_parts)
-            self.recv_window_size[server] += current_payload_length
-            self.recv_buffer[server].clear() 
-            self.handler(full_payload, current_total_length)
+            self.recv_drained(tcb, current_payload_length)
+            tcb.recv_buffer.clear() 
+            self.handler(full_payload, current_total_length, current_messagetype)
+
+    def next_seq(self, remote):
+        tcb = self.connections.get(remote)
+        return tcb.next_seq_num if tcb is not None else 0
+
+    def next_ack(self, remote):
+        tcb = self.connections.get(remote)
+        return tcb.ack_num if tcb is not None else 0
 
     def network_heartbeat(self):
         heartbeat_seg = TCPSegment(
@@ -355,13 +414,23 @@ class TCPClientSocket(TCPBaseSocket):
             seq_num=0,
             ack_num=0,
             flags=0,  # No flags for heartbeat
-            timestamp=int(time.time()),
+            timestamp=current_timestamp(),
             messagetype=4  # Heartbeat message type
         )
-        self.udp.sendto(heartbeat_seg.pack(), self.server_addr)
+        self.send_segment(heartbeat_seg, self.server_addr)
 
-    def disconnect(self):
+    def close(self):
+        """Drop the connections without a close handshake and stop receiving. The process keeps running"""
         self.running = False
-        print("[CLIENT] Disconnecting...")
+        for remote in list(self.connections):
+            self.close_connection(remote)
+        receiver = self.receiver
+        if receiver is not None and receiver is not threading.current_thread():
+            try:
+                self.udp.sendto(b'', self.udp.getsockname()) # wakes up the receive thread
+            except OSError:
+                pass
+            receiver.join(1.0)
+        self.workers.shutdown(wait=False)
         self.udp.close()
-        os._exit(0)
+        print("[CLIENT] Disconnecting...")
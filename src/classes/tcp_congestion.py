@@ -0,0 +1,139 @@
+import time
+import sys
+import os
+from abc import ABC, abstractmethod
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+
+class CongestionControl(ABC):
+    """Congestion window of one connection, driven by the sender"""
+    name = None
+
+    def __init__(self, mss):
+        self.mss = mss
+        self.cwnd = INITIAL_CWND_SEGMENTS * mss    # bytes the sender may have in flight
+        self.ssthresh = INITIAL_SSTHRESH            # slow start below, congestion avoidance above
+        self.dup_acks = 0
+        self.in_recovery = False
+        self.recover = 0                            # highest seq sent when recovery started (NewReno)
+
+    def in_slow_start(self):
+        return self.cwnd < self.ssthresh
+
+    def stats(self):
+        return {"algorithm": self.name, "cwnd": self.cwnd, "ssthresh": self.ssthresh, "in_recovery": self.in_recovery}
+
+    def on_new_ack(self, acked_bytes, ack_num, flight_size):
+        """ACK advancing send_base. Returns True when a partial ACK asks to resend the next hole"""
+        self.dup_acks = 0
+        if self.in_recovery:
+            if ack_num >= self.recover: # full ACK, leave fast recovery
+                self.in_recovery = False
+                self.cwnd = min(self.ssthresh, max(flight_size, self.mss) + self.mss)
+                return False
+            # partial ACK: deflate by the acknowledged data and retransmit the next hole (RFC 6582)
+            self.cwnd = max(self.mss, self.cwnd - acked_bytes + self.mss)
+            return True
+        if self.in_slow_start():
+            # appropriate byte counting (RFC 3465), a delayed ACK covers up to two segments
+            self.cwnd += min(acked_bytes, DELAYED_ACK_SEGMENTS * self.mss)
+        else:
+            self.increase(acked_bytes)
+        return False
+
+    def on_dup_ack(self, flight_size, highest_sent):
+        """Duplicate ACK. Returns True when the oldest segment should be fast retransmitted"""
+        self.dup_acks += 1
+        if self.in_recovery:
+            self.cwnd += self.mss # every duplicate means one more segment left the network
+            return False
+        if self.dup_acks == DUP_ACK_THRESHOLD:
+            self.ssthresh = self.loss_ssthresh(flight_size)
+            self.cwnd = self.ssthresh + DUP_ACK_THRESHOLD * self.mss
+            self.in_recovery = True
+            self.recover = highest_sent
+            return True
+        return False
+
+    def on_timeout(self, flight_size):
+        self.ssthresh = self.loss_ssthresh(flight_size)
+        self.cwnd = self.mss # back to slow start
+        self.dup_acks = 0
+        self.in_recovery = False
+
+    def loss_ssthresh(self, flight_size):
+        return max(flight_size // 2, 2 * self.mss)
+
+    @abstractmethod
+    def increase(self, acked_bytes):
+        """Congestion avoidance growth for acked_bytes"""
+        pass
+
+class RenoCongestionControl(CongestionControl):
+    """NewReno (RFC 5681, RFC 6582)"""
+    name = "reno"
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.acked_in_round = 0
+
+    def increase(self, acked_bytes):
+        # one MSS per window worth of ACKed data
+        self.acked_in_round += acked_bytes
+        if self.acked_in_round >= self.cwnd:
+            self.acked_in_round -= self.cwnd
+            self.cwnd += self.mss
+
+class CubicCongestionControl(CongestionControl):
+    """CUBIC (RFC 9438)"""
+    name = "cubic"
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.w_max = 0              # cwnd before the last reduction, in segments
+        self.k = 0.0                # seconds to climb back to w_max
+        self.epoch_start = None     # start of the current congestion avoidance epoch
+        self.w_est = 0.0            # Reno-friendly estimate, in segments
+
+    def loss_ssthresh(self, flight_size):
+        segments = self.cwnd / self.mss
+        # fast convergence, release bandwidth when the plateau keeps dropping
+        if segments < self.w_max:
+            self.w_max = segments * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = segments
+        self.epoch_start = None
+        return max(int(self.cwnd * CUBIC_BETA), 2 * self.mss)
+
+    def increase(self, acked_bytes):
+        now = time.monotonic()
+        segments = self.cwnd / self.mss
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if segments < self.w_max:
+                self.k = ((self.w_max - segments) / CUBIC_C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = segments
+            self.w_est = segments
+
+        t = now - self.epoch_start
+        target = CUBIC_C * (t - self.k) ** 3 + self.w_max
+        self.w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * (acked_bytes / self.mss) / segments
+        target = max(target, self.w_est)
+        if target > segments:
+            # approach the cubic target within one window worth of ACKs
+            self.cwnd += int(self.mss * (target - segments) / segments * (acked_bytes / self.mss)) or 1
+
+CONGESTION_CONTROLS = {
+    "reno": RenoCongestionControl,
+    "newreno": RenoCongestionControl,
+    "cubic": CubicCongestionControl,
+}
+
+def create_congestion_control(name, mss):
+    if name not in CONGESTION_CONTROLS:
+        raise ValueError(f"Unknown congestion control: {name}")
+    return CONGESTION_CONTROLS[name](mss)
@@ -0,0 +1,106 @@
+import threading
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from .tcp_retransmission import *
+from helper.constants import *
+
+class TCPConnection:
+    """Transmission control block, every piece of state of one connection of a TCPTransport.
+    Sockets index them by peer address, so a lookup is one dict access and closing drops the whole block"""
+    __slots__ = ('remote', 'state', 'closed', 'lock',
+                 'send_mss', 'send_wscale', 'recv_wscale', 'sack_permitted', 'piggyback_ack',
+                 'send_base', 'next_seq_num', 'remote_window_size', 'unacked_segments', 'congestion', 'rto',
+                 'retransmit_deadline', 'retransmit_timer', 'retransmit_count', 'window_available',
+                 'ack_num', 'expected_seq_num', 'recv_window_size', 'recv_window_limit', 'drain_start', 'drained',
+                 'recv_buffer', 'reassembly', 'pending_ack', 'ack_timer', 'last_advertised',
+                 'state_timer', 'control_segment', 'control_retries')
+
+    def __init__(self, remote, iss, irs, window, state):
+        self.remote = remote
+        self.state = state                  # SYN_SENT ... TIME_WAIT, see helper.constants
+        self.closed = False                 # set once the socket dropped the block, late callers back off
+        self.lock = threading.RLock()       # guards the sender, ACK and close state, held across a whole message
+
+        # Negotiated in the handshake, legacy values until then
+        self.send_mss = LEGACY_MSS          # payload size the peer accepts
+        self.send_wscale = 0                # shift the peer applies to its windows
+        self.recv_wscale = 0                # shift we apply to our windows
+        self.sack_permitted = False         # both sides offered SACK
+        self.piggyback_ack = False          # peer reads ACKs carried on data segments
+
+        # Sender
+        self.send_base = iss + 1            # oldest unacknowledged seq
+        self.next_seq_num = iss + 1         # seq of the next byte sent
+        self.remote_window_size = window    # window advertised to us
+        self.unacked_segments = None        # RetransmissionQueue, created by the first send
+        self.congestion = None              # CongestionControl, created once the MSS is known
+        self.rto = RTOEstimator()
+        self.retransmit_deadline = 0        # monotonic time the oldest segment expires
+        self.retransmit_timer = None
+        self.retransmit_count = 0           # expiries since the last new ACK
+        self.window_available = None        # Condition on lock (threaded sockets), notified when the window opens
+
+        # Receiver
+        self.ack_num = irs + 1              # next seq expected from the peer
+        self.expected_seq_num = None        # seq after the peer's FIN
+        self.recv_window_size = window      # window advertised to the peer
+        self.recv_window_limit = window     # receive buffer size, grows with auto-tuning
+        self.drain_start = None             # start of the drain-rate interval
+        self.drained = 0                    # bytes the application took out during it
+        self.recv_buffer = []               # in-order parts of the message being assembled
+        self.reassembly = None              # ReassemblyBuffer of segments ahead of a gap, created by the first one
+        self.pending_ack = None             # [in-order bytes not acknowledged yet, message type]
+        self.ack_timer = None               # armed delayed ACK timer
+        self.last_advertised = 0            # receive window sent with the last ACK
+
+        # Handshake and teardown
+        self.state_timer = None             # resends control_segment, or ends TIME_WAIT
+        self.control_segment = None         # packed SYN, FIN, FIN-ACK or final ACK of the current state
+        self.control_retries = 0
+
+    def __repr__(self):
+        return f"<TCPConnection {self.remote} {self.state}>"
+
+    def close(self):
+        # Called by the socket with lock held
+        self.closed = True
+        self.state = CLOSED
+        for timer in (self.ack_timer, self.retransmit_timer, self.state_timer):
+            if timer is not None:
+                timer.cancel()
+        self.ack_timer = self.retransmit_timer = self.state_timer = None
+        self.control_segment = None
+        self.pending_ack = None
+        self.unacked_segments = None
+        self.reassembly = None
+        self.recv_buffer = []
+        if self.window_available is not None:
+            self.window_available.notify_all() # senders waiting for this peer give up
+
+    def memory(self):
+        """Bytes held by the connection: the block, what it owns and the data it buffers"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.lock) + sys.getsizeof(self.rto) + sys.getsizeof(self.recv_buffer)
+        for part in self.recv_buffer:
+            size += sys.getsizeof(part) + len(part["payload"])
+        if self.congestion is not None:
+            size += sys.getsizeof(self.congestion) + sys.getsizeof(self.congestion.__dict__)
+        if self.unacked_segments is not None:
+            size += sys.getsizeof(self.unacked_segments) + sys.getsizeof(self.unacked_segments.segments)
+            for entry in self.unacked_segments.segments:
+                size += sys.getsizeof(entry) + len(entry.data)
+        if self.reassembly is not None:
+            size += sys.getsizeof(self.reassembly) + sys.getsizeof(self.reassembly.heap) + sys.getsizeof(self.reassembly.segments)
+            size += self.reassembly.buffered_bytes
+        if self.pending_ack is not None:
+            size += sys.getsizeof(self.pending_ack)
+        if self.window_available is not None:
+            size += sys.getsizeof(self.window_available) + sys.getsizeof(self.window_available.__dict__)
+        if self.control_segment is not None:
+            size += sys.getsizeof(self.control_segment)
+        for timer in (self.ack_timer, self.retransmit_timer, self.state_timer):
+            if timer is not None:
+                size += sys.getsizeof(timer)
+        return size
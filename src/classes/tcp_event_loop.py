@@ -0,0 +1,100 @@
+import selectors
+import socket
+import threading
+import traceback
+from collections import deque
+from classes.tcp_timer_wheel import *
+
+class EventLoop:
+    """Selector (epoll/kqueue/select) loop running socket callbacks and timers on a single thread"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel()              # thread safe on its own
+        self.ready = deque()                    # (callback, args) queued from other threads
+        self.lock = threading.Lock()            # guards ready, filled from any thread
+        self.running = False
+        self.thread = None                      # thread inside run_forever
+
+        # Self-pipe, other threads write a byte to wake the loop from select
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self.drain_wakeup)
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def add_reader(self, fileobj, callback):
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def call_later(self, delay, callback, *args):
+        # Thread safe, returns a handle with cancel()
+        timer = self.timers.schedule(delay, callback, *args)
+        if not self.in_loop_thread():
+            self.wakeup()
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self.lock:
+            self.ready.append((callback, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # already has a pending wakeup, or the loop is closed
+
+    def drain_wakeup(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"[!] Error in event loop callback {getattr(callback, '__name__', callback)}: {e}")
+            traceback.print_exc()
+
+    def next_timeout(self):
+        with self.lock:
+            if self.ready:
+                return 0
+        return self.timers.next_timeout()
+
+    def run_ready(self):
+        with self.lock:
+            ready, self.ready = self.ready, deque()
+        for callback, args in ready:
+            self.run_callback(callback, args)
+
+    def run_timers(self):
+        for timer in self.timers.expire():
+            if not timer.cancelled:
+                self.run_callback(timer.callback, timer.args)
+
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            for key, _ in self.selector.select(self.next_timeout()):
+                self.run_callback(key.data, (key.fileobj,))
+            self.run_ready()
+            self.run_timers()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+    def close(self):
+        self.stop()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
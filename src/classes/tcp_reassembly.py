@@ -0,0 +1,55 @@
+import heapq
+
+class ReassemblyBuffer:
+    """Out-of-order segments of one connection waiting for the gap before them to fill"""
+    __slots__ = ('heap', 'segments', 'buffered_bytes', 'last_added')
+
+    def __init__(self):
+        self.heap = []              # seq_nums, smallest first
+        self.segments = {}          # seq_num -> (length, part)
+        self.buffered_bytes = 0
+        self.last_added = None      # most recent arrival, reported first in SACK blocks
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add(self, seq_num, length, part):
+        # O(log n), returns False for a segment that is already buffered
+        if seq_num in self.segments:
+            return False
+        self.segments[seq_num] = (length, part)
+        heapq.heappush(self.heap, seq_num)
+        self.buffered_bytes += length
+        self.last_added = seq_num
+        return True
+
+    def sack_blocks(self, max_blocks):
+        # Buffered ranges merged into (left, right) blocks, the block holding the latest arrival first (RFC 2018)
+        blocks = []
+        for seq_num in sorted(self.segments):
+            end = seq_num + self.segments[seq_num][0]
+            if blocks and seq_num <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            else:
+                blocks.append([seq_num, end])
+        for i, (left, right) in enumerate(blocks):
+            if left <= (self.last_added or 0) < right:
+                blocks.insert(0, blocks.pop(i))
+                break
+        return [tuple(block) for block in blocks[:max_blocks]]
+
+    def pop_contiguous(self, next_seq):
+        # Yield (seq_num, length, part) starting at or before next_seq, O(log n) each.
+        # The caller advances next_seq, entries it already covers come out too and are skipped by it.
+        while self.heap and self.heap[0] <= next_seq:
+            seq_num = heapq.heappop(self.heap)
+            length, part = self.segments.pop(seq_num)
+            self.buffered_bytes -= length
+            yield seq_num, length, part
+            next_seq = max(next_seq, seq_num + length)
+
+    def clear(self):
+        self.heap.clear()
+        self.segments.clear()
+        self.buffered_bytes = 0
+        self.last_added = None
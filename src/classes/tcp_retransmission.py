@@ -0,0 +1,109 @@
+import time
+import sys
+import os
+from collections import deque
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+
+class InFlightSegment:
+    """A sent segment waiting for its acknowledgement"""
+    __slots__ = ('seq_num', 'length', 'data', 'sent_at', 'retransmitted', 'sacked')
+
+    def __init__(self, seq_num, length, data, sent_at):
+        self.seq_num = seq_num              # first byte of the segment
+        self.length = length                # payload bytes covered by the segment
+        self.data = data                    # packed segment, resent as is
+        self.sent_at = sent_at              # monotonic time of the last transmission
+        self.retransmitted = False          # Karn's rule: no RTT sample from retransmitted segments
+        self.sacked = False                 # already held by the receiver, never resent
+
+    @property
+    def end_seq(self):
+        return self.seq_num + self.length
+
+class RetransmissionQueue:
+    """In-flight segments of one connection, oldest first"""
+    __slots__ = ('segments', 'highest_sacked')
+
+    def __init__(self):
+        self.segments = deque() # sent in sequence order, so the deque stays sorted
+        self.highest_sacked = 0 # right edge of the highest SACK block seen
+
+    def __len__(self):
+        return len(self.segments)
+
+    def push(self, entry):
+        self.segments.append(entry)
+
+    def oldest(self):
+        return self.segments[0] if self.segments else None
+
+    def acknowledge(self, ack_num):
+        # Pop the prefix covered by a cumulative ACK, O(k) for k acknowledged segments
+        acked = []
+        segments = self.segments
+        while segments and segments[0].end_seq <= ack_num:
+            acked.append(segments.popleft())
+        return acked
+
+    def mark_sacked(self, blocks):
+        # Returns how many segments these blocks SACKed for the first time
+        newly = 0
+        for left, right in blocks:
+            for entry in self.segments:
+                if entry.seq_num >= right:
+                    break
+                if not entry.sacked and entry.seq_num >= left and entry.end_seq <= right:
+                    entry.sacked = True
+                    newly += 1
+            self.highest_sacked = max(self.highest_sacked, right)
+        return newly
+
+    def first_unsacked(self):
+        for entry in self.segments:
+            if not entry.sacked:
+                return entry
+        return None
+
+    def next_hole(self):
+        # Oldest segment the receiver is missing below its highest SACK block, not resent yet
+        for entry in self.segments:
+            if entry.seq_num >= self.highest_sacked:
+                break
+            if not entry.sacked and not entry.retransmitted:
+                return entry
+        return None
+
+    def clear(self):
+        self.segments.clear()
+        self.highest_sacked = 0
+
+class RTOEstimator:
+    """Retransmission timeout of one connection (RFC 6298)"""
+    __slots__ = ('srtt', 'rttvar', 'rto', 'backoff_count')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.backoff_count = 0
+
+    def sample(self, rtt):
+        if self.srtt is None: # first measurement
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTO_BETA) * self.rttvar + RTO_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTO_ALPHA) * self.srtt + RTO_ALPHA * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(CLOCK_GRANULARITY, RTO_K * self.rttvar)))
+        self.backoff_count = 0
+
+    def backoff(self):
+        # Double the timeout after every expiry until a fresh sample arrives
+        self.rto = min(MAX_RTO, self.rto * 2)
+        self.backoff_count += 1
+
+    def deadline(self):
+        return time.monotonic() + self.rto
@@ -11,9 +11,67 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
 from helper.constants import *
 from helper.utils import *
 
+UNDECODED = object() # marks a lazy header field not yet read from the raw datagram
+
+class LazyField:
+    """Header field decoded from the raw datagram the first time it is read"""
+    def __init__(self, fmt, offset):
+        self.struct = struct.Struct(fmt) if fmt else None
+        self.offset = offset
+
+    def __set_name__(self, owner, name):
+        self.slot = getattr(owner, "_" + name) # backing slot of the field
+
+    def __get__(self, segment, owner=None):
+        if segment is None:
+            return self
+        value = self.slot.__get__(segment)
+        if value is UNDECODED:
+            raw = segment._raw
+            if self.struct is None: # payload, everything after the header
+                value = bytes(raw[self.offset:])
+            else:
+                value = self.struct.unpack_from(raw, self.offset)[0]
+            self.slot.__set__(segment, value)
+        return value
+
+    def __set__(self, segment, value):
+        self.slot.__set__(segment, value)
+
 class TCPSegment:
     FORMAT = '!HHQQBH H H Q B 4s' # Total = 40 bytes
-    HEADER_SIZE = struct.calcsize(FORMAT)
+    STRUCT = struct.Struct(FORMAT)
+    HEADER_SIZE = STRUCT.size
+    CHECKSUM_OFFSET = struct.calcsize('!HHQQB') # = 21
+
+    # Handshake options carried in the padding of SYN and SYN-ACK, all zero for legacy peers
+    OPTIONS_STRUCT = struct.Struct('!HBB') # mss, window scale, option flags
+
+    # SACK blocks carried as the payload of a pure ACK once SACK is permitted
+    SACK_BLOCK_STRUCT = struct.Struct('!QQ') # left edge, right edge (exclusive)
+
+    # Per-connection fields a broadcast fills into a shared template: dest_port, seq_num, ack_num, flags, then windowsize
+    ROUTE_STRUCT = struct.Struct('!HQQB')
+    ROUTE_OFFSET = 2
+    WINDOW_STRUCT = struct.Struct('!H')
+    WINDOW_OFFSET = 23
+
+    # Fields read for every segment, the rest are skipped until accessed
+    HOT_STRUCT = struct.Struct('!HHQQB 2x 2x 2x 8x B 4x')
+    UNDECODED_FIELDS = (UNDECODED,) * 6
+
+    FREE_LIST_SIZE = 256
+    free_list = []
+
+    __slots__ = ('src_port', 'dest_port', 'seq_num', 'ack_num', 'flags', 'messagetype',
+                 '_checksum', '_windowsize', '_payloadlength', '_timestamp', '_padding', '_payload', '_raw')
+
+    checksum = LazyField('!H', CHECKSUM_OFFSET)
+    windowsize = LazyField('!H', 23)
+    payloadlength = LazyField('!H', 25)
+    timestamp = LazyField('!Q', 27)
+    padding = LazyField('!4s', 36)
+    payload = LazyField(None, HEADER_SIZE)
 
     def __init__(self, src_port, dest_port, seq_num, ack_num, flags, checksum=0, windowsize=0, payloadlength=0, timestamp=None, messagetype=0,
                  padding=b'\x00\x00\x00\x00', payload=b''):
@@ -23,96 +81,147 @@ class TCPSegment:
         self.seq_num = seq_num              # 64 bit (8 byte)
         self.ack_num = ack_num              # 64 bit (8 byte)
         self.flags = flags                  # 8 bit (CWR, ECE, URG, ACK, PSH, RST, SYN, FIN) (1 byte)
-        self.checksum = checksum            # 16 bit (2 byte)
-        self.windowsize = windowsize        # 16 bit (2 byte)
-        self.payloadlength = payloadlength  # 16 bit (2 byte)
-        self.timestamp = timestamp          # 64 bit (8 byte)
-        self.messagetype = messagetype      # 8 bit (1 byte) -> (0: other, 1: message, 2: join, 3: leave, 4: heartbeat, 5: other_command, 6: kill)
-        self.padding = padding              # 8 bit (4 byte)
+        self._checksum = checksum           # 16 bit (2 byte)
+        self._windowsize = windowsize       # 16 bit (2 byte)
+        self._payloadlength = payloadlength # 16 bit (2 byte)
+        self._timestamp = timestamp         # 64 bit (8 byte)
+        self.messagetype = messagetype      # 8 bit (1 byte) -> (0: other, 1: message, 2: join, 3: leave, 4: heartbeat, 5: other_command, 6: kill,
+                                            #                   7: failed kill, 8: chat delta, 9: chat snapshot, 10: history request)
+        self._padding = padding             # 8 bit (4 byte) -> handshake options on SYN / SYN-ACK
 
         # === Field Normalization Logic ===
-        if self.timestamp is None:
-            self.timestamp = int(time.time())
-        if self.payloadlength is None and payload is not None:
-            self.payloadlength = len(payload)
+        if self._timestamp is None:
+            self._timestamp = current_timestamp()
+        if self._payloadlength is None and payload is not None:
+            self._payloadlength = len(payload)
 
         # PAYLOAD 
-        self.payload = payload              # <= 64 byte
+        self._payload = payload             # <= negotiated MSS
+        self._raw = None
 
-    def pack(self): # get checksum
-        temp_header = struct.pack(
-            self.FORMAT,
+    def size(self):
+        return self.HEADER_SIZE + len(self.payload)
+
+    def pack_into(self, buffer, offset=0): # encode into buffer, return the encoded length
+        if self._raw is not None:
+            self.decode() # re-encoding a received segment, read every lazy field first
+        payload = self._payload
+        end = offset + self.HEADER_SIZE + len(payload)
+        self.STRUCT.pack_into(
+            buffer,
+            offset,
             self.src_port,
             self.dest_port,
             self.seq_num,
             self.ack_num,
             self.flags,
             0, # initial checksum
-            self.windowsize,
-            self.payloadlength,
-            self.timestamp,
+            self._windowsize,
+            self._payloadlength,
+            self._timestamp,
             self.messagetype,
-            self.padding
+            self._padding
         )
+        if payload:
+            buffer[offset + self.HEADER_SIZE:end] = payload
 
-        segment = temp_header + self.payload
-        self.checksum = calculate_checksum(segment)
+        # checksum the segment in place, then patch the field
+        if offset == 0 and end == len(buffer):
+            checksum = calculate_checksum(buffer)
+        else:
+            checksum = calculate_checksum(buffer[offset:end])
+        buffer[offset + self.CHECKSUM_OFFSET] = checksum >> 8
+        buffer[offset + self.CHECKSUM_OFFSET + 1] = checksum & 0xFF
+        self._checksum = checksum
+        return end - offset
 
-        header = struct.pack(
-            self.FORMAT,
-            self.src_port,
-            self.dest_port,
-            self.seq_num,
-            self.ack_num,
-            self.flags,
-            self.checksum,
-            self.windowsize,
-            self.payloadlength,
-            self.timestamp,
-            self.messagetype,
-            self.padding
-        )
+    def pack(self): # get checksum
+        buffer = bytearray(self.size())
+        self.pack_into(buffer)
+        return buffer
+
+    def decode(self):
+        # Read every lazy field so the segment no longer depends on the raw datagram
+        if self._raw is not None:
+            self.checksum, self.windowsize, self.payloadlength, self.timestamp, self.padding, self.payload
+            self._raw = None
+        return self
+
+    @staticmethod
+    def route_sum(dest_port, seq_num, ack_num, flags, windowsize):
+        # What the per-connection fields add to the ones' complement sum, modulo 0xFFFF (2^16 = 1).
+        # flags is the high byte of its word, windowsize starts on an odd offset so its bytes swap halves.
+        return dest_port + seq_num + ack_num + (flags << 8) + (windowsize >> 8) + ((windowsize & 0xFF) << 8)
+
+    @classmethod
+    def patch(cls, template, dest_port, seq_num, ack_num=0, flags=0, windowsize=0):
+        # Copy of a packed segment addressed to another connection. The checksum is updated from the
+        # changed header fields only (RFC 1624) instead of summing the payload again.
+        data = bytearray(template)
+        offset = cls.CHECKSUM_OFFSET
+        old = cls.route_sum(*cls.ROUTE_STRUCT.unpack_from(data, cls.ROUTE_OFFSET),
+                            *cls.WINDOW_STRUCT.unpack_from(data, cls.WINDOW_OFFSET))
+        cls.ROUTE_STRUCT.pack_into(data, cls.ROUTE_OFFSET, dest_port, seq_num, ack_num, flags)
+        cls.WINDOW_STRUCT.pack_into(data, cls.WINDOW_OFFSET, windowsize)
+
+        new = cls.route_sum(dest_port, seq_num, ack_num, flags, windowsize)
+        total = (0xFFFF - ((data[offset] << 8) | data[offset + 1]) - old + new) % 0xFFFF
+        checksum = ~(total or 0xFFFF) & 0xFFFF # a packed segment is never all zero, so its sum is never +0
+        data[offset] = checksum >> 8
+        data[offset + 1] = checksum & 0xFF
+        return data
+
+    @classmethod
+    def pack_options(cls, mss, window_scale=0, option_flags=0):
+        return cls.OPTIONS_STRUCT.pack(mss, window_scale, option_flags)
 
-        return header + self.payload
+    def options(self):
+        # (mss, window scale, option flags) advertised by the peer, all 0 when the peer did not negotiate
+        return self.OPTIONS_STRUCT.unpack(self.padding)
+
+    @classmethod
+    def pack_sack_blocks(cls, blocks):
+        return b''.join(cls.SACK_BLOCK_STRUCT.pack(left, right) for left, right in blocks)
+
+    def sack_blocks(self):
+        # [(left, right)] reported by the peer on a pure ACK
+        payload = self.payload
+        size = self.SACK_BLOCK_STRUCT.size
+        return [self.SACK_BLOCK_STRUCT.unpack_from(payload, i) for i in range(0, len(payload) - size + 1, size)]
+
+    @classmethod
+    def acquire(cls):
+        # Reuse a released segment when possible, fields are overwritten by the caller
+        free_list = cls.free_list
+        return free_list.pop() if free_list else cls.__new__(cls) # no exception raised while the list is empty
+
+    def release(self):
+        # Hand the segment back once nothing refers to it anymore
+        self._raw = None
+        self._payload = b''
+        if len(self.free_list) < self.FREE_LIST_SIZE:
+            self.free_list.append(self)
 
     @classmethod
     def unpack(cls, data):
         if len(data) < cls.HEADER_SIZE: # data is shorter than header
             return None
 
-        header = data[:cls.HEADER_SIZE] # get header
-        payload = data[cls.HEADER_SIZE:] # get payload
-        unpacked = struct.unpack(cls.FORMAT, header) # return python tuple of FORMAT
-
-        temp_header = struct.pack(
-            cls.FORMAT,
-            unpacked[0],  # src_port
-            unpacked[1],  # dest_port
-            unpacked[2],  # seq_num
-            unpacked[3],  # ack_num
-            unpacked[4],  # flags
-            0,            # checksum replaced with zero
-            unpacked[6],  # windowsize
-            unpacked[7],  # payloadlength
-            unpacked[8],  # timestamp
-            unpacked[9],  # messagetype
-            unpacked[10]  # padding
-        )
-        computed_checksum = calculate_checksum(temp_header + payload)
-        if computed_checksum != unpacked[5]: # check if checksum is same from the one that is sent
+        # The checksum sits on an odd offset, so it adds its byte-swapped value to the sum of the
+        # received segment. Take it back out of that sum instead of rebuilding a zeroed header.
+        offset = cls.CHECKSUM_OFFSET
+        checksum = (data[offset] << 8) | data[offset + 1]
+        total = int.from_bytes(data, "big") % 0xFFFF # reduced first, no second big integer is built
+        if len(data) % 2 == 1:
+            total = (total << 8) % 0xFFFF  # pad to even length
+        swapped = ((checksum & 0xFF) << 8) | (checksum >> 8)
+        if (swapped - total) % 0xFFFF != checksum: # check if checksum is same from the one that is sent
             return None
 
-        return cls(
-            src_port=unpacked[0],
-            dest_port=unpacked[1],
-            seq_num=unpacked[2],
-            ack_num=unpacked[3],
-            flags=unpacked[4],
-            checksum=unpacked[5],
-            windowsize=unpacked[6],
-            payloadlength=unpacked[7],
-            timestamp=unpacked[8],
-            messagetype=unpacked[9],
-            padding=unpacked[10],
-            payload=payload
-        )
+        segment = cls.acquire()
+        (segment.src_port, segment.dest_port, segment.seq_num, segment.ack_num, segment.flags,
+         segment.messagetype) = cls.HOT_STRUCT.unpack_from(data)
+        (segment._checksum, segment._windowsize, segment._payloadlength, segment._timestamp, segment._padding,
+         segment._payload) = cls.UNDECODED_FIELDS
+        segment._raw = data
+        return segment
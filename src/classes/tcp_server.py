@@ -11,237 +11,460 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
 from helper.constants import *
 from helper.utils import *
 from classes.tcp_base import *
+from classes.tcp_event_loop import *
+from classes.tcp_worker_pool import *
+from classes.tcp_syn_cookie import *
 
 class TCPServerSocket(TCPBaseSocket):
-    def __init__(self, local_port, ip_address="0.0.0.0", udp_socket=None, handler=None):
-        super().__init__(local_port, ip_address, udp_socket, handler=handler)
+    RECV_FLAGS = getattr(socket, "MSG_DONTWAIT", 0) # non-blocking reads without changing the socket mode
+
+    def __init__(self, local_port, ip_address="0.0.0.0", udp_socket=None, handler=None, mss=DEFAULT_MSS,
+                 congestion_control=DEFAULT_CONGESTION_CONTROL, delayed_ack=True, drain_timeout=DRAIN_TIMEOUT,
+                 syn_backlog=SYN_BACKLOG, syn_cookies=True):
+        super().__init__(local_port, ip_address, udp_socket, handler=handler, mss=mss, congestion_control=congestion_control,
+                         delayed_ack=delayed_ack)
         self.over_recv = False
         self.lock = threading.Lock()
-        self.termination_state = {}  # Track termination state for each connection
-        self.TIMEOUT_DURATION = 10.0  # seconds for termination timeout
-
-    def disconnect(self):
-        self.udp.close()
-        os._exit(0)
+        self.state = CLOSED           # LISTEN while new connections are accepted
+        self.loop = EventLoop()       # drives protocol handling and timers for every connection
+        self.workers = SerialWorkerPool(name="server-worker") # application work, ordered per client
+        self.shutdown_handler = None  # called before the server closes on a kill command
+        self.drain_timeout = drain_timeout # seconds shutdown() waits for in-flight data
+        self.draining = False
+        self.drain_stats = None       # outcome of the last shutdown, see drain()
+        self.syn_backlog = syn_backlog # most connections in SYN_RECEIVED at once
+        self.half_open = set()        # addrs of the connections in SYN_RECEIVED
+        self.cookies = SynCookies() if syn_cookies else None # answers SYNs beyond the backlog without state
+
+    def close(self):
+        """Stop serving, connections are dropped without a close handshake. accept() returns, the process keeps running"""
+        self.state = CLOSED
+        for client in list(self.connections):
+            self.close_connection(client)
+        self.workers.shutdown(wait=False)
+        if self.loop.running:
+            self.loop.stop() # accept() closes the socket once the loop is out of its callbacks
+        else:
+            self.udp.close()
 
     def listen(self):
         if self.local_addr is None:
             raise ValueError("No port specified for listening.")
         self.udp.bind(self.local_addr)
+        self.state = LISTEN
         print(f"Listening on port {self.local_addr}...")
 
     def accept(self):
         print(f"[SERVER] Chat room started on {self.local_addr}")
-        while True:
-            data, client = self.udp.recvfrom(128)
-            seg = TCPSegment.unpack(data)
-            # print(f"Payload: {seg.payload.decode()}, Message type: {seg.messagetype}, Flags: {seg.flags}")
-            if (not seg):
-                print(f"Corrupted/Invalid segment received from {client}")
-                continue
-            
-            flag = seg.flags
-            type = seg.messagetype
-            if (flag == FLAG_SYN and type == 2): # SYN Threeway Handshake
-                if (client in self.remote_addr):
-                    print(f"{client} is already connected to server")
-                    continue
-                threading.Thread(target=self.threeway_handshake_syn, args=(seg, client), daemon=True).start()
-            elif (flag == FLAG_FIN_ACK):
-                threading.Thread(target=self.handle_killing_signal_ack, daemon=True).start()
-            elif (flag == FLAG_FIN):
-                if (type == 3):
-                    threading.Thread(target=self.handle_client_disconnect, args=(seg, client), daemon=True).start()
-            elif (flag == FLAG_ACK): 
-                if (type == 1): # Confirmation of chatroom segments
-                    if (client not in self.remote_addr): 
-                        print(f"{client} tried to ack chat log, but is not in server!")
-                        continue 
-                    threading.Thread(target=self.receive_ack, args=(seg, client), daemon=True).start()
-                elif(type == 2): # FINAL ACK Threeway Handshake
-                    if (client not in self.remote_addr):
-                        print(f"{client} tried to do threeway handshake out of order")
-                        continue
-                    threading.Thread(target=self.threeway_handshake_final_ack, args=(seg, client), daemon=True).start()
-                elif (type == 3): # FINAL ACK FIN Termination
-                    threading.Thread(target=self.handle_termination_ack, args=(seg, client), daemon=True).start()
-            elif (flag != FLAG_ACK): # MESSAGE OR OTHER COMMAND
-                if (type == 1 or type == 5):
-                    if (client not in self.remote_addr):
-                        print(f"{client} tried to message, but is not in server!")
-                        continue
-                    threading.Thread(target=self.handle_sender_data, args=(seg, client), daemon=True).start()
-                if (type == 4):
-                    threading.Thread(target=self.handler, args=(client, 4, seg.timestamp, b'', 0), daemon=True).start()
-                if (type == 6):
-                    threading.Thread(target=self.handle_killing_signal, args=(client,), daemon=True).start()
-                if (type == 7):
-                    threading.Thread(target=self.handler, args=(client, 7, seg.timestamp, b'', 0), daemon=True).start()
+        self.loop.add_reader(self.udp, self.on_readable)
+        self.loop.run_forever()
+        self.loop.close()
+        self.udp.close()
 
+    def call_later(self, delay, callback, *args):
+        # Protocol timers run on the event loop, next to the segment handlers
+        return self.loop.call_later(delay, callback, *args)
+
+    def call_handler(self, client, *args):
+        # The application handler may block or be slow, keep it off the event loop.
+        # Calls for one client stay in order, different clients are handled in parallel.
+        if not self.workers.submit(client, self.handler, client, *args):
+            print(f"[!] Handler queue for {client} is full, dropping message type {args[0]}")
+
+    def broadcast(self, clients, payload: bytes, message_type, timeout=None):
+        """send_data of one payload to many clients, segmented and checksummed once per negotiated MSS.
+        Returns the clients whose send queue was full"""
+        payload += b'\x00'
+        payload_length = len(payload)
+        timestamp = current_timestamp()
+        templates = {} # mss -> packed segments, per-connection fields left zero
+        skipped = []
+        for client in clients:
+            mss = self.get_mss(client)
+            if mss not in templates:
+                templates[mss] = [TCPSegment(self.local_addr[1], 0, 0, 0, 0, payloadlength=payload_length, timestamp=timestamp,
+                                             messagetype=message_type, payload=payload[offset:offset + mss]).pack()
+                                  for offset in range(0, payload_length, mss)]
+            # Queued behind earlier sends to the same client, a slow client never holds up the others
+            if not self.workers.submit(client, self.send_templates, client, payload, templates[mss], mss, message_type, timeout):
+                skipped.append(client)
+        return skipped
+
+    def on_readable(self, sock):
+        # Drain a batch of datagrams per wakeup, one per wakeup where MSG_DONTWAIT is missing
+        for _ in range(RECV_BATCH):
+            try:
+                data, client = self.udp.recvfrom(self.recv_size, self.RECV_FLAGS)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError: # ICMP port unreachable from an earlier send (Windows)
+                continue
+            self.dispatch(data, client)
+            if not self.RECV_FLAGS:
+                break
+
+    def dispatch(self, data, client):
+        seg = TCPSegment.unpack(data)
+        # print(f"Payload: {seg.payload.decode()}, Message type: {seg.messagetype}, Flags: {seg.flags}")
+        if (not seg):
+            print(f"Corrupted/Invalid segment received from {client}")
+            return
 
-    def handle_killing_signal_ack(self):
-        ack_seg = TCPSegment(
-            src_port=self.local_addr[1],
-            dest_port=0,
-            seq_num=0,
-            ack_num=0,
-            flags=FLAG_ACK,
-            windowsize=0,
-            timestamp=int(time.time()),
-            messagetype=6 # Kill command ACK
-        )
+        flag = seg.flags
+        type = seg.messagetype
+        if (flag == FLAG_SYN and type == 2): # SYN Threeway Handshake
+            self.handle_syn(seg, client)
+        elif (flag == FLAG_FIN_ACK):
+            tcb = self.connections.get(client)
+            if (type == 6 and tcb is not None and tcb.state == FIN_WAIT_1): # the client confirmed its kill command
+                with tcb.lock:
+                    self.stop_control(tcb) # our FIN arrived, stop resending it
+                self.handle_killing_signal_ack()
+        elif (flag == FLAG_FIN):
+            if (type == 3):
+                self.handle_client_disconnect(seg, client)
+        elif (flag == FLAG_ACK): 
+            if (type in (1, 8, 9)): # Confirmation of chatroom segments (full log, delta, snapshot)
+                if (client not in self.connections): 
+                    print(f"{client} tried to ack chat log, but is not in server!")
+                else:
+                    self.receive_ack(seg, client)
+            elif(type == 2): # FINAL ACK Threeway Handshake
+                tcb = self.connections.get(client) or self.accept_syn_cookie(seg, client)
+                if (tcb is None):
+                    print(f"{client} tried to do threeway handshake out of order")
+                elif (tcb.state == SYN_RECEIVED): # a repeated final ACK finds the connection established
+                    self.threeway_handshake_final_ack(seg, tcb)
+            elif (type == 3): # FINAL ACK FIN Termination
+                self.handle_termination_ack(seg, client)
+        elif (flag != FLAG_ACK): # MESSAGE OR OTHER COMMAND
+            if (type == 1 or type == 5 or type == 10):
+                if (client not in self.connections):
+                    print(f"{client} tried to message, but is not in server!")
+                else:
+                    self.handle_sender_data(seg, client)
+            if (type == 4):
+                self.call_handler(client, 4, seg.timestamp, b'', 0)
+            if (type == 6):
+                self.handle_killing_signal(client)
+            if (type == 7):
+                self.call_handler(client, 7, seg.timestamp, b'', 0)
+        seg.release() # nothing keeps the segment after handling
 
-        for client in self.remote_addr:
-            self.udp.sendto(ack_seg.pack(), client)
 
-        self.disconnect()
+    def handle_killing_signal_ack(self):
+        # The kill command is confirmed
+        self.shutdown()
 
-    
+    def shutdown(self, timeout=None):
+        """Graceful close: new connections are refused, then every client gets what was sent to it before its
+        connection ends, for at most timeout seconds (drain_timeout by default). accept() returns once it is done"""
+        with self.lock:
+            if self.draining:
+                return
+            self.draining = True
+        self.state = CLOSED # SYNs are ignored from now on
+        if self.shutdown_handler is not None:
+            self.shutdown_handler()
+        if not self.loop.running: # nothing would handle the ACKs
+            self.drain(0)
+            return
+        timeout = self.drain_timeout if timeout is None else timeout
+        threading.Thread(target=self.drain, args=(timeout,), name="server-drain", daemon=True).start()
+
+    def drain(self, timeout):
+        # Each client is flushed on its worker, behind the sends already queued for it, so they drain in parallel
+        deadline = time.monotonic() + timeout
+        clients = list(self.connections)
+        self.drain_stats = {"clients": len(clients), "drained": 0, "cut_off": 0, "undelivered_bytes": 0, "undelivered_segments": 0}
+        print(f"[SERVER] Shutting down, draining {len(clients)} connections for up to {timeout:.1f}s")
+
+        unsent_bytes, unsent_segments = self.unsent_bytes, self.unsent_segments
+        drained = threading.Semaphore(0)
+        queued = 0
+        if timeout > 0:
+            for client in clients:
+                queued += self.workers.submit(client, self.drain_connection, client, deadline, drained)
+        for _ in range(queued):
+            if not drained.acquire(timeout=max(0, deadline - time.monotonic())):
+                break
+
+        # Whatever is left missed the deadline, a send still waiting for window space gives up
+        for tcb in list(self.connections.values()):
+            self.end_connection(tcb, False)
+        self.workers.shutdown(wait=True) # sends still queued find their connection gone and count as unsent
+
+        stats = self.drain_stats
+        stats["undelivered_bytes"] += self.unsent_bytes - unsent_bytes
+        stats["undelivered_segments"] += self.unsent_segments - unsent_segments
+        print(f"[SERVER] Drained {stats['drained']}/{stats['clients']} connections, "
+              f"{stats['undelivered_bytes']} bytes in {stats['undelivered_segments']} segments undelivered")
+        if self.loop.running:
+            self.loop.call_soon_threadsafe(self.close)
+        else:
+            self.close()
+
+    def drain_connection(self, client, deadline, drained):
+        try:
+            tcb = self.connections.get(client)
+            if tcb is None:
+                return
+            with tcb.lock:
+                window_available = self.get_window_condition(tcb) # notified by every ACK
+                while tcb.unacked_segments and not tcb.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    window_available.wait(remaining)
+                self.end_connection(tcb, True)
+        finally:
+            drained.release()
+
+    def end_connection(self, tcb, flushed):
+        # Count what the client never acknowledged, then tell it the server is gone
+        with tcb.lock:
+            if tcb.closed:
+                return
+            queue = tcb.unacked_segments
+            undelivered = list(queue.segments) if queue else []
+            with self.lock:
+                self.drain_stats["drained" if flushed else "cut_off"] += 1
+                self.drain_stats["undelivered_segments"] += len(undelivered)
+                self.drain_stats["undelivered_bytes"] += sum(entry.length for entry in undelivered)
+
+            ack_seg = TCPSegment(
+                src_port=self.local_addr[1],
+                dest_port=tcb.remote[1],
+                seq_num=0,
+                ack_num=0,
+                flags=FLAG_ACK,
+                windowsize=0,
+                timestamp=current_timestamp(),
+                messagetype=6 # Kill command ACK
+            )
+            try:
+                self.udp.sendto(ack_seg.pack(), tcb.remote)
+            except OSError:
+                pass # socket already closed
+            self.close_connection(tcb.remote, tcb)
 
     def handle_killing_signal(self, client):
-        """Handle the kill command from a client"""
+        """Handle the kill command from a client, which confirms it by answering our FIN"""
+        tcb = self.connections.get(client)
+        if tcb is None or tcb.state != ESTABLISHED:
+            return
         fin_seg = TCPSegment(
             src_port=self.local_addr[1],
             dest_port=client[1],
-            seq_num=self.next_seq_num.get(client, 0),
-            ack_num=self.ack_num.get(client, 0),
+            seq_num=tcb.next_seq_num,
+            ack_num=tcb.ack_num,
             flags=FLAG_FIN,
-            windowsize=self.recv_window_size.get(client, 0),
-            timestamp=int(time.time()),
+            windowsize=self.window_field(tcb),
+            timestamp=current_timestamp(),
             messagetype=6 # Kill command
         )
 
-        self.udp.sendto(fin_seg.pack(), client)
+        with tcb.lock:
+            # In the new state before the segment leaves, the answer may come back before send_control returns
+            tcb.next_seq_num += 1
+            self.set_state(tcb, FIN_WAIT_1)
+            self.send_control(tcb, fin_seg)
         # print(f"[!] Sent FIN to {client} for termination")
     
     def handle_client_disconnect(self, segment, client):
-        """Handle client-initiated connection termination"""
-        with self.lock:
-            if client not in self.remote_addr:
-                print(f"[!] FIN from unconnected client {client}")
+        """Handle client-initiated connection termination. Data already queued for the client is still
+        sent (half-close), our FIN-ACK follows it"""
+        tcb = self.connections.get(client)
+        if tcb is None:
+            print(f"[!] FIN from unconnected client {client}")
+            return
+        with tcb.lock:
+            if tcb.state in (CLOSE_WAIT, LAST_ACK) and segment.seq_num + 1 == tcb.expected_seq_num:
+                # Repeated FIN, our answer got lost
+                if tcb.state == CLOSE_WAIT:
+                    self.acknowledge_fin(tcb)
+                else:
+                    self.repeat_control(tcb)
+                return
+            if tcb.state != ESTABLISHED:
                 return
 
             # print(f"← Received FIN (seq={segment.seq_num}) from {client}")
-            
-            self.expected_seq_nums[client] = segment.seq_num + 1
-            
-            current_seq = self.next_seq_num.get(client, 0)
+            tcb.expected_seq_num = segment.seq_num + 1
+            self.set_state(tcb, CLOSE_WAIT)
+            self.acknowledge_fin(tcb)
+
+        # The application hears of the leave now, the FIN-ACK goes out behind whatever it queued before
+        self.call_handler(client, 3, current_timestamp(), b"", 0)
+        if not self.workers.submit(client, self.close_wait_done, tcb):
+            self.close_wait_done(tcb)
+
+    def acknowledge_fin(self, tcb):
+        # Acknowledges the FIN alone, the client stops resending it and keeps receiving
+        ack_seg = TCPSegment(
+            src_port=self.local_addr[1],
+            dest_port=tcb.remote[1],
+            seq_num=tcb.next_seq_num,
+            ack_num=tcb.expected_seq_num,
+            flags=FLAG_ACK,
+            windowsize=self.window_field(tcb),
+            timestamp=current_timestamp(),
+            messagetype=3
+        )
+        self.send_segment(ack_seg, tcb.remote)
+
+    def close_wait_done(self, tcb):
+        # Our half of the close, after the data sent before it
+        with tcb.lock:
+            if tcb.state != CLOSE_WAIT:
+                return
             fin_ack_seg = TCPSegment(
                 src_port=self.local_addr[1],
-                dest_port=client[1],
-                seq_num=current_seq,
-                ack_num=segment.seq_num + 1,
+                dest_port=tcb.remote[1],
+                seq_num=tcb.next_seq_num,
+                ack_num=tcb.expected_seq_num,
                 flags=FLAG_FIN_ACK,
-                windowsize=self.recv_window_size.get(client, 0),
-                timestamp=int(time.time()),
+                windowsize=self.window_field(tcb),
+                timestamp=current_timestamp(),
                 messagetype=3
             )
-            
-        successful_termination = False
-        self.udp.sendto(fin_ack_seg.pack(), client)
-        # print(f"→ Sent FIN-ACK (seq={current_seq}, ack={segment.seq_num + 1}) to {client}")
-        self.next_seq_num[client] = current_seq + 1
+            tcb.next_seq_num += 1
+            self.set_state(tcb, LAST_ACK)
+            self.send_control(tcb, fin_ack_seg)
+            # print(f"→ Sent FIN-ACK (seq={fin_ack_seg.seq_num}, ack={tcb.expected_seq_num}) to {tcb.remote}")
 
     def handle_termination_ack(self, ack_seg, client):
-        try:
-            print("line 108")
-            if ack_seg.src_port != client[1]:
-                print(f"[!] Received ACK from unexpected address {ack_seg.src_port}, expected {client[1]}")
-                return
-
-            # Validate final ACK
-            if has_flag(ack_seg.flags, FLAG_ACK):
-                expected_ack = self.next_seq_num.get(client, 0)
-                if ack_seg.ack_num == expected_ack:
-                    # print(f"← Received final ACK (ack={ack_seg.ack_num}) from {client}")
-                    successful_termination = True
-                    self.handler(client, 3, int(time.time()), b"", 0)
-                    
-                    # Clean up connection state
-                    print(f"[✓] Successfully handled disconnect from {client}")
-                    self.cleanup_connection(client)
-                else:
-                    print(f"[!] Invalid final ACK: expected {expected_ack}, got {ack_seg.ack_num}")
-                    print(f"[!] Failed to complete disconnect handshake with {client}")
-
-        except Exception as e:
-            print(f"[!] Error waiting for final ACK: {e}")
-            traceback.print_exc()
-
+        if ack_seg.src_port != client[1]:
+            print(f"[!] Received ACK from unexpected address {ack_seg.src_port}, expected {client[1]}")
+            return
 
+        tcb = self.connections.get(client)
+        if tcb is None or tcb.state != LAST_ACK:
+            return
+        # Validate final ACK
+        if ack_seg.ack_num == tcb.next_seq_num:
+            # print(f"← Received final ACK (ack={ack_seg.ack_num}) from {client}")
+            print(f"[✓] Successfully handled disconnect from {client}")
+            self.cleanup_connection(client)
+        else:
+            print(f"[!] Invalid final ACK: expected {tcb.next_seq_num}, got {ack_seg.ack_num}")
+
+    def drop_connection(self, tcb):
+        # The application already heard of the leave when the client's FIN came
+        if tcb.state not in (SYN_RECEIVED, CLOSE_WAIT, LAST_ACK):
+            self.call_handler(tcb.remote, 3, current_timestamp(), b"", 0)
+        if self.close_connection(tcb.remote, tcb) is not None:
+            print(f"[✓] Cleaned up connection state for {tcb.remote}")
+
+    def close_connection(self, remote, tcb=None):
+        closed = super().close_connection(remote, tcb)
+        if closed is not None:
+            self.half_open.discard(remote)
+        return closed
 
     def cleanup_connection(self, client):
         """Clean up all connection state for a client"""
-        try:
-            # Remove from remote address list
-            if client in self.remote_addr:
-                self.remote_addr.remove(client)
-            
-            # Clean up all tracking dictionaries
-            self.seq_num.pop(client, None)
-            self.send_base.pop(client, None)
-            self.next_seq_num.pop(client, None)
-            self.ack_num.pop(client, None)
-            self.expected_ack_nums.pop(client, None)
-            self.expected_seq_nums.pop(client, None)
-            self.recv_window_size.pop(client, None)
-            self.remote_window_size.pop(client, None)
-            self.unacked_segments.pop(client, None)
-            self.timer_start.pop(client, None)
-            
-            # Clean up receive buffers
-                
+        if self.close_connection(client) is not None:
             print(f"[✓] Cleaned up connection state for {client}")
-            
-        except Exception as e:
-            print(f"[!] Error during cleanup: {str(e)}")
-            traceback.print_exc()
-    
+
+    def handle_syn(self, segment, client):
+        if self.state != LISTEN:
+            return
+        tcb = self.connections.get(client)
+        if tcb is not None:
+            if tcb.state == SYN_RECEIVED and segment.seq_num + 1 == tcb.ack_num: # our SYN-ACK got lost
+                self.repeat_control(tcb)
+                return
+            if tcb.state not in (CLOSE_WAIT, LAST_ACK):
+                print(f"{client} is already connected to server")
+                return
+            # The client reuses its address while our final ACK wait is still open
+            self.drop_connection(tcb)
+        elif len(self.half_open) >= self.syn_backlog:
+            # Backlog full, e.g. a SYN flood. Without cookies the SYN is dropped and the client resends it
+            if self.cookies is not None:
+                self.send_syn_cookie(segment, client)
+            return
+        self.threeway_handshake_syn(segment, client)
+
     def threeway_handshake_syn(self, segment, client):
         print(f"← Received SYN from {client}")
         y = random.randint(1, (1 << 31) - 1)
-        self.remote_addr.append(client)
 
-        # Setting initial values
+        # Setting initial values, send_base = next_seq_num = y + 1 and ack_num = x + 1
         seq_num = y
-        self.send_base[client] = y + 1
-        self.next_seq_num[client] = y + 1
-        self.ack_num[client] = segment.seq_num + 1 # x + 1
-        self.recv_window_size[client] = 5 * 104
+        tcb = self.open_connection(client, y, segment.seq_num, SYN_RECEIVED)
+        self.half_open.add(client)
+        peer_mss, peer_scale, peer_flags = segment.options()
+        mss = self.negotiate_mss(tcb, peer_mss)
+        self.negotiate_window_scale(tcb, peer_scale, peer_flags)
+        self.negotiate_ack_options(tcb, peer_flags)
+        self.init_recv_window(tcb, mss)
 
         synack_seg = TCPSegment(
             src_port=self.local_addr[1],
             dest_port=client[1],
             seq_num=seq_num,
-            ack_num=self.ack_num[client], 
+            ack_num=tcb.ack_num, 
             flags=FLAG_SYN_ACK,
-            timestamp=int(time.time()),
-            windowsize = self.recv_window_size[client]
+            timestamp=current_timestamp(),
+            windowsize = min(0xFFFF, tcb.recv_window_size), # never scaled on SYN-ACK
+            padding=self.handshake_options()
         )
-        self.udp.sendto(synack_seg.pack(), client)
+        self.send_control(tcb, synack_seg) # resent until the final ACK
         print("→ Sent SYN-ACK")
     
-    def threeway_handshake_final_ack(self, segment, client):
-        if segment.ack_num != self.send_base[client]:
-            self.remote_addr.remove(client)
-            self.send_base.pop(client, None)
-            self.next_seq_num.pop(client, None)
-            self.ack_num.pop(client, None)
-            self.recv_window_size.pop(client, None)
-            self.remote_window_size.pop(client, None)
-            self.unacked_segments.pop(client, None)
-
+    def send_syn_cookie(self, segment, client):
+        # SYN-ACK carrying the handshake in its seq_num, not resent: a lost one makes the client resend its SYN
+        peer_mss, peer_scale, peer_flags = segment.options()
+        mss = min(self.mss, peer_mss) if peer_mss else LEGACY_MSS
+        synack_seg = TCPSegment(
+            src_port=self.local_addr[1],
+            dest_port=client[1],
+            seq_num=self.cookies.encode(client, segment.seq_num, peer_mss, peer_scale, peer_flags),
+            ack_num=segment.seq_num + 1,
+            flags=FLAG_SYN_ACK,
+            timestamp=current_timestamp(),
+            windowsize=min(0xFFFF, self.default_window(mss)), # never scaled on SYN-ACK
+            padding=self.handshake_options()
+        )
+        self.send_segment(synack_seg, client)
+
+    def accept_syn_cookie(self, segment, client):
+        # Final ACK without a connection, rebuilt from its cookie. None if it does not carry a valid one
+        if self.cookies is None or self.state != LISTEN:
+            return None
+        y, x = segment.ack_num - 1, segment.seq_num - 1
+        offered = self.cookies.decode(client, x, y)
+        if offered is None:
+            return None
+        peer_mss, peer_scale, peer_flags = offered
+        tcb = self.open_connection(client, y, x, SYN_RECEIVED)
+        mss = self.negotiate_mss(tcb, peer_mss)
+        self.negotiate_window_scale(tcb, peer_scale, peer_flags)
+        self.negotiate_ack_options(tcb, peer_flags)
+        self.init_recv_window(tcb, mss)
+        return tcb
+
+    def threeway_handshake_final_ack(self, segment, tcb):
+        client = tcb.remote
+        if segment.ack_num != tcb.send_base:
+            self.close_connection(client)
             print(f"[!] Invalid ACK from {client} — handshake rejected.")
             return
 
-        self.remote_window_size[client] = segment.windowsize
+        self.stop_control(tcb)
+        self.half_open.discard(client)
+        tcb.remote_window_size = self.peer_window(tcb, segment.windowsize)
+        self.set_state(tcb, ESTABLISHED)
 
         print("← Received final ACK")
         print(f"[✓] Connection established with {client}")
-        self.handler(client, 2, segment.timestamp, segment.payload, segment.payloadlength)
+        self.call_handler(client, 2, segment.timestamp, segment.payload, segment.payloadlength)
     
-    def recv_buffer_controller(self, client):
-        client_buffer = self.recv_buffer[client]
+    def recv_buffer_controller(self, tcb):
+        client = tcb.remote
+        client_buffer = tcb.recv_buffer
         current_messagetype = 0
         current_timestamp = 0
         message_parts = [] 
@@ -261,23 +484,11 @@ class TCPServerSocket(TCPBaseSocket):
                 ends_with_null = True
 
         is_message_complete = current_payload_length == current_total_length
-        force_flush = self.recv_window_size[client] < 104 or (self.next_seq_num.get(client, 0) - self.send_base.get(client, 0) + 64) > self.recv_window_size[client]
+        mss = tcb.send_mss
+        force_flush = tcb.recv_window_size < TCPSegment.HEADER_SIZE + mss or (tcb.next_seq_num - tcb.send_base + mss) > tcb.recv_window_size
 
         if is_message_complete or ends_with_null or force_flush:
             full_payload = b''.join(message_parts)
-            self.recv_window_size[client] += current_payload_length
-            self.recv_buffer[client].clear() 
-            self.handler(client, current_messagetype, current_timestamp, full_payload, current_total_length)
-    
-    def delete_client(self, client):
-        self.remote_addr.remove(client)
-        self.send_base.pop(client, None)
-        self.next_seq_num.pop(client, None)
-        self.ack_num.pop(client, None)
-        self.recv_window_size.pop(client, None)
-        self.remote_window_size.pop(client, None)
-        self.unacked_segments.pop(client, None)
-        self.recv_buffer.pop(client, None)
-
-
-
+            self.recv_drained(tcb, current_payload_length)
+            tcb.recv_buffer.clear() 
+            self.call_handler(client, current_messagetype, current_timestamp, full_payload, current_total_length)
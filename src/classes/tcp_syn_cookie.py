@@ -0,0 +1,41 @@
+import hashlib
+import time
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+
+class SynCookies:
+    """Stateless SYN-ACKs. The options the client offered, a time slot and a keyed MAC of the client's address
+    and ISN make up our initial sequence number, so nothing is stored until the final ACK echoes it back.
+
+    Cookie layout, 63 bits so the sequence numbers after it never wrap:
+    MAC (32) | time slot (8) | peer MSS (16) | window scale (4) | option flags (3)"""
+    __slots__ = ('secret', 'period')
+
+    def __init__(self, period=SYN_COOKIE_PERIOD):
+        self.secret = os.urandom(16)  # new per server, cookies of an earlier run are forgeries
+        self.period = period          # seconds per time slot
+
+    def slot(self):
+        return int(time.monotonic() // self.period) & 0xFF
+
+    def mac(self, client, isn, slot, options):
+        data = f"{client[0]}:{client[1]}:{isn}:{slot}:{options}".encode()
+        return int.from_bytes(hashlib.blake2b(data, key=self.secret, digest_size=4).digest(), 'big')
+
+    def encode(self, client, isn, mss, scale, flags):
+        """Cookie for the SYN-ACK's seq_num"""
+        options = (mss & 0xFFFF) << 7 | (scale & 0xF) << 3 | (flags & 0x7)
+        slot = self.slot()
+        return self.mac(client, isn, slot, options) << 31 | slot << 23 | options
+
+    def decode(self, client, isn, cookie):
+        """(mss, scale, flags) the client offered, None for a forged cookie or one older than two slots"""
+        options = cookie & 0x7FFFFF
+        slot = (cookie >> 23) & 0xFF
+        if (self.slot() - slot) & 0xFF > 1 or cookie >> 31 != self.mac(client, isn, slot, options):
+            return None
+        return options >> 7, (options >> 3) & 0xF, options & 0x7
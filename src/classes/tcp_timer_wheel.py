@@ -0,0 +1,160 @@
+import math
+import threading
+import time
+import traceback
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+
+class TimerHandle:
+    """A callback scheduled on a TimerWheel, cancel() takes it out of its slot"""
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'tick', 'slot', 'wheel')
+
+    def __init__(self, when, callback, args, tick, wheel):
+        self.when = when            # monotonic time the callback is due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.tick = tick            # wheel tick the callback runs on, never before when
+        self.slot = None            # slot dict holding the handle, None once expired
+        self.wheel = wheel
+
+    def cancel(self):
+        self.cancelled = True
+        self.wheel.remove(self)
+
+class TimerWheel:
+    """Hierarchical timing wheel (Varghese & Lauck). Level 0 has one slot per tick, every level above
+    covers a whole turn of the level below per slot and is cascaded down as time reaches it.
+    Scheduling and cancelling are O(1) whatever the number of timers"""
+
+    def __init__(self, tick=TIMER_TICK, bits=TIMER_WHEEL_BITS, levels=TIMER_WHEEL_LEVELS):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.horizon = (1 << (bits * levels)) - 1     # furthest tick ahead a timer can be placed
+        self.wheels = [[{} for _ in range(1 << bits)] for _ in range(levels)] # slot: dict of handles
+        self.current = self.tick_of(time.monotonic()) # last tick expired
+        self.count = 0
+        self.lock = threading.Lock()                  # schedule and cancel come from any thread
+
+    def __len__(self):
+        return self.count
+
+    def tick_of(self, when):
+        return int(when / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        when = time.monotonic() + delay
+        timer = TimerHandle(when, callback, args, math.ceil(when / self.tick), self)
+        with self.lock:
+            self.place(timer)
+            self.count += 1
+        return timer
+
+    def remove(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                del timer.slot[timer]
+                timer.slot = None
+                self.count -= 1
+
+    def place(self, timer):
+        # Lowest level whose span still reaches the tick, called with the lock held
+        delta = timer.tick - self.current
+        if delta <= 0: # due already, runs on the next tick
+            timer.tick = self.current + 1
+            delta = 1
+        elif delta > self.horizon:
+            timer.tick = self.current + self.horizon
+            delta = self.horizon
+        level = 0
+        while delta >> (self.bits * (level + 1)):
+            level += 1
+        slot = self.wheels[level][(timer.tick >> (self.bits * level)) & self.mask]
+        slot[timer] = None
+        timer.slot = slot
+
+    def next_timeout(self):
+        """Seconds until the wheel must be advanced again, None without timers"""
+        with self.lock:
+            if not self.count:
+                return None
+            # Level 0 holds everything due within a turn, anything else is only due after a cascade
+            boundary = (self.current | self.mask) + 1
+            tick = self.current + 1
+            while tick < boundary and not self.wheels[0][tick & self.mask]:
+                tick += 1
+        return max(0.0, tick * self.tick - time.monotonic())
+
+    def expire(self):
+        """Take every timer due by now out of the wheel, in tick order"""
+        target = self.tick_of(time.monotonic())
+        due = []
+        with self.lock:
+            if not self.count:
+                self.current = max(self.current, target)
+                return due
+            while self.current < target:
+                self.current += 1
+                tick = self.current
+                # A level is cascaded when every level below it finished a turn
+                level = 1
+                while level < self.levels and not tick & ((1 << (self.bits * level)) - 1):
+                    index = (tick >> (self.bits * level)) & self.mask
+                    slot = self.wheels[level][index]
+                    self.wheels[level][index] = {}
+                    for timer in slot:
+                        self.place(timer)
+                    level += 1
+                index = tick & self.mask
+                slot = self.wheels[0][index]
+                if slot:
+                    self.wheels[0][index] = {}
+                    for timer in slot:
+                        timer.slot = None
+                    due.extend(slot)
+                    self.count -= len(slot)
+        return due
+
+class TimerService:
+    """A TimerWheel driven by its own thread. Callbacks run on that thread and must not block"""
+    default_service = None
+    default_lock = threading.Lock()
+
+    def __init__(self, name="timer-service"):
+        self.wheel = TimerWheel()
+        self.wakeup = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def default(cls):
+        # One service shared by every socket of the process
+        with cls.default_lock:
+            if cls.default_service is None:
+                cls.default_service = cls()
+            return cls.default_service
+
+    def call_later(self, delay, callback, *args):
+        timer = self.wheel.schedule(delay, callback, *args)
+        with self.wakeup:
+            self.wakeup.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                self.wakeup.wait(self.wheel.next_timeout())
+            for timer in self.wheel.expire():
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    print(f"[!] Error in timer callback {getattr(timer.callback, '__name__', timer.callback)}: {e}")
+                    traceback.print_exc()
@@ -0,0 +1,487 @@
+import time
+import threading
+import sys
+import os
+from abc import ABC, abstractmethod
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from .tcp_segment import *
+from .tcp_retransmission import *
+from .tcp_congestion import *
+from .tcp_reassembly import *
+from .tcp_connection import *
+from helper.constants import *
+from helper.utils import *
+
+class TCPTransport:
+    """Sender and receiver of every TCPConnection, shared by the threaded sockets and the asyncio endpoints.
+    Subclasses bring the datagram socket, the timers and the way waiters are woken up"""
+
+    def __init__(self, mss=DEFAULT_MSS, congestion_control=DEFAULT_CONGESTION_CONTROL, delayed_ack=True):
+        # Segment size
+        self.mss = mss                                          # payload size advertised in the handshake
+        self.recv_size = TCPSegment.HEADER_SIZE + mss           # largest datagram a peer may send us
+
+        # Window scaling
+        self.window_scale = 0                                   # shift applied to the windows we advertise
+        while (MAX_RECV_WINDOW >> self.window_scale) > 0xFFFF:
+            self.window_scale += 1
+
+        # Delayed ACKs
+        self.delayed_ack = delayed_ack                          # coalesce ACKs instead of one per data segment
+
+        # Connections, every per-peer field lives in its TCPConnection
+        self.connections = {}                                   # addr -> TCPConnection, each guarded by its own lock
+
+        # Congestion control
+        if congestion_control not in CONGESTION_CONTROLS:
+            raise ValueError(f"Unknown congestion control: {congestion_control}")
+        self.congestion_control = congestion_control            # algorithm used for new connections
+
+        # Send buffer, one preallocated bytearray per sending thread
+        self.send_buffers = threading.local()
+
+    def open_connection(self, remote, iss, irs, state):
+        """New TCB once both initial sequence numbers are known, replaces any earlier one of remote"""
+        self.close_connection(remote)
+        tcb = TCPConnection(remote, iss, irs, self.default_window(LEGACY_MSS), state)
+        self.connections[remote] = tcb
+        return tcb
+
+    def close_connection(self, remote, tcb=None):
+        """Drop all state of remote at once, only if it is still tcb when given.
+        Returns the closed TCPConnection, None if there was none"""
+        if tcb is None:
+            tcb = self.connections.get(remote)
+            if tcb is None:
+                return None
+        with tcb.lock:
+            if self.connections.get(remote) is not tcb:
+                return None
+            del self.connections[remote]
+            tcb.close()
+        self.on_state_change(tcb)
+        return tcb
+
+    def set_state(self, tcb, state):
+        tcb.state = state
+        self.on_state_change(tcb)
+
+    def send_control(self, tcb, segment):
+        """Send a SYN, FIN or FIN-ACK, resent with backoff until the peer's answer moves the connection on"""
+        self.stop_control(tcb)
+        tcb.control_segment = segment.pack()
+        tcb.control_retries = 0
+        self.send_datagram(tcb.control_segment, tcb.remote)
+        tcb.state_timer = self.call_later(tcb.rto.rto, self.resend_control, tcb, tcb.rto.rto)
+
+    def resend_control(self, tcb, interval):
+        with tcb.lock:
+            tcb.state_timer = None
+            if tcb.closed or tcb.control_segment is None:
+                return
+            tcb.control_retries += 1
+            if tcb.control_retries > MAX_CONTROL_RETRANSMISSIONS:
+                print(f"[!] {tcb.remote} did not answer in {tcb.state}, closing the connection")
+                self.drop_connection(tcb)
+                return
+            self.send_datagram(tcb.control_segment, tcb.remote)
+            interval = min(MAX_RTO, interval * 2)
+            tcb.state_timer = self.call_later(interval, self.resend_control, tcb, interval)
+
+    def repeat_control(self, tcb):
+        # The peer repeated its segment, so our answer to it got lost
+        if tcb.control_segment is not None:
+            self.send_datagram(tcb.control_segment, tcb.remote)
+
+    def stop_control(self, tcb):
+        # The peer answered, nothing left to resend
+        if tcb.state_timer is not None:
+            tcb.state_timer.cancel()
+            tcb.state_timer = None
+        tcb.control_segment = None
+
+    def enter_time_wait(self, tcb, final_ack):
+        # The final ACK may get lost, linger to repeat it when the FIN-ACK comes again
+        self.stop_control(tcb)
+        tcb.control_segment = final_ack.pack()
+        self.send_datagram(tcb.control_segment, tcb.remote)
+        self.set_state(tcb, TIME_WAIT)
+        tcb.state_timer = self.call_later(TIME_WAIT_DURATION, self.time_wait_done, tcb)
+
+    def time_wait_done(self, tcb):
+        # The close is complete
+        return self.close_connection(tcb.remote, tcb)
+
+    def drop_connection(self, tcb):
+        # The peer stopped answering the handshake, the close or our data, subclasses tell the application
+        self.close_connection(tcb.remote, tcb)
+
+    def connection_memory(self):
+        # addr -> bytes held by that connection, see TCPConnection.memory
+        return {remote: tcb.memory() for remote, tcb in list(self.connections.items())}
+
+    def send_segment(self, segment: TCPSegment, remote): 
+        # print(f"Send to remote: {remote}")
+        buffer = getattr(self.send_buffers, "buffer", None)
+        if buffer is None or len(buffer) < segment.size():
+            buffer = bytearray(max(segment.size(), TCPSegment.HEADER_SIZE + 1024))
+            self.send_buffers.buffer = buffer
+        length = segment.pack_into(buffer)
+        self.send_datagram(memoryview(buffer)[:length], remote)
+
+    def negotiate_mss(self, tcb, peer_mss):
+        # Legacy peers advertise nothing and keep the original 64 byte payloads
+        tcb.send_mss = min(self.mss, peer_mss) if peer_mss else LEGACY_MSS
+        return tcb.send_mss
+
+    def get_mss(self, remote):
+        tcb = self.connections.get(remote)
+        return tcb.send_mss if tcb is not None else LEGACY_MSS
+
+    def default_window(self, mss):
+        return RECV_WINDOW_SEGMENTS * (TCPSegment.HEADER_SIZE + mss)
+
+    def handshake_options(self):
+        return TCPSegment.pack_options(self.mss, self.window_scale, OPT_WINDOW_SCALE | OPT_SACK_PERMITTED | OPT_PIGGYBACK_ACK)
+
+    def negotiate_window_scale(self, tcb, peer_scale, peer_flags):
+        # Scaling is only used when both sides offered it
+        if has_flag(peer_flags, OPT_WINDOW_SCALE):
+            tcb.send_wscale = peer_scale
+            tcb.recv_wscale = self.window_scale
+        else:
+            tcb.send_wscale = 0
+            tcb.recv_wscale = 0
+
+    def negotiate_ack_options(self, tcb, peer_flags):
+        # Legacy peers offer neither and keep plain cumulative ACKs on separate segments
+        tcb.sack_permitted = has_flag(peer_flags, OPT_SACK_PERMITTED)
+        tcb.piggyback_ack = has_flag(peer_flags, OPT_PIGGYBACK_ACK)
+
+    def init_recv_window(self, tcb, mss):
+        tcb.recv_window_limit = self.default_window(mss)
+        tcb.recv_window_size = tcb.recv_window_limit
+
+    def advertised_window(self, remote):
+        # Value of the 16 bit windowsize field, 0 without a connection
+        tcb = self.connections.get(remote)
+        return self.window_field(tcb) if tcb is not None else 0
+
+    def window_field(self, tcb):
+        return min(0xFFFF, max(0, tcb.recv_window_size) >> tcb.recv_wscale)
+
+    def peer_window(self, tcb, windowsize):
+        return windowsize << tcb.send_wscale
+
+    def recv_drained(self, tcb, length):
+        # The application took length bytes out of the receive buffer. Grow the buffer while the
+        # application drains at least half of it per round trip, so the sender is not window-limited.
+        tcb.recv_window_size += length
+        now = time.monotonic()
+        if tcb.drain_start is None:
+            tcb.drain_start = now
+        tcb.drained += length
+
+        interval = tcb.rto.srtt or AUTOTUNE_INTERVAL
+        if now - tcb.drain_start >= interval:
+            limit = tcb.recv_window_limit
+            max_limit = MAX_RECV_WINDOW if tcb.recv_wscale else 0xFFFF
+            drained_per_interval = tcb.drained * interval / (now - tcb.drain_start)
+            if drained_per_interval * 2 >= limit and limit < max_limit:
+                grown = min(limit * 2, max_limit)
+                tcb.recv_window_limit = grown
+                tcb.recv_window_size += grown - limit
+            tcb.drain_start, tcb.drained = now, 0
+
+    def get_congestion(self, tcb):
+        if tcb.congestion is None:
+            tcb.congestion = create_congestion_control(self.congestion_control, tcb.send_mss)
+        return tcb.congestion
+
+    def get_congestion_stats(self, remote):
+        # cwnd / ssthresh of one connection, for observation
+        tcb = self.connections[remote]
+        with tcb.lock:
+            return self.get_congestion(tcb).stats()
+
+    def window_space(self, tcb):
+        # The sender is limited by both the peer's window and the congestion window
+        window = min(tcb.remote_window_size, self.get_congestion(tcb).cwnd)
+        return window - (tcb.next_seq_num - tcb.send_base)
+
+    def send_chunk(self, tcb, chunk, payload_length, message_type):
+        next_seq = tcb.next_seq_num
+        flags, ack_num, window = self.piggyback(tcb)
+        segment = TCPSegment(
+            src_port=self.local_addr[1],
+            dest_port=tcb.remote[1],
+            seq_num=next_seq,
+            ack_num=ack_num,
+            flags=flags,
+            windowsize=window,
+            payload=chunk,
+            payloadlength=payload_length,
+            timestamp=current_timestamp(),
+            messagetype=message_type
+        )
+
+        self.transmit(tcb, next_seq, len(chunk), segment.pack())
+
+    def send_template(self, tcb, template, length):
+        # Broadcast segment, only the per-connection header fields are written and checksummed
+        next_seq = tcb.next_seq_num
+        flags, ack_num, window = self.piggyback(tcb)
+        self.transmit(tcb, next_seq, length, TCPSegment.patch(template, tcb.remote[1], next_seq, ack_num, flags, window))
+
+    def transmit(self, tcb, seq, length, data):
+        # Sending, the packed bytes are kept for retransmission
+        self.send_datagram(data, tcb.remote)
+        # print(f"[SEND] Sent segment {seq} to {tcb.remote}")
+
+        # Track unacked
+        if tcb.unacked_segments is None:
+            tcb.unacked_segments = RetransmissionQueue()
+        tcb.unacked_segments.push(InFlightSegment(seq, length, data, time.monotonic()))
+        self.start_retransmit_timer(tcb)
+
+        # Advance window
+        tcb.next_seq_num = seq + length
+
+    def handle_sender_data(self, segment, sender):
+        tcb = self.connections.get(sender)
+        if tcb is None:
+            return
+        if has_flag(segment.flags, FLAG_ACK): # piggybacked acknowledgement of our own data
+            self.receive_ack(segment, sender)
+
+        seq = segment.seq_num
+        payload = segment.payload
+        expected = tcb.ack_num
+        part = {
+            "seq_num": seq,
+            "message_type": segment.messagetype,
+            "timestamp": segment.timestamp,
+            "payload": payload,
+            "payload_length": segment.payloadlength
+        }
+
+        in_order = False
+        reassembly = tcb.reassembly
+        gap_filled = bool(reassembly)
+        if seq + len(payload) <= expected:
+            pass # retransmission of delivered data, only repeat the ACK
+        elif seq > expected:
+            # Out of order, keep it for later while it fits in the window. It lies inside the window we
+            # advertised and is reported by SACK, so it is only charged once the gap fills and it is delivered
+            if tcb.reassembly is None:
+                tcb.reassembly = ReassemblyBuffer()
+            if seq + len(payload) - expected <= tcb.recv_window_size:
+                tcb.reassembly.add(seq, len(payload), part)
+        else:
+            # Accept and update, then pull whatever the gap was holding back
+            tcb.recv_window_size -= len(payload) 
+            in_order = True
+            self.deliver_in_order(tcb, part)
+            if reassembly:
+                for buffered_seq, length, buffered in reassembly.pop_contiguous(tcb.ack_num):
+                    if buffered_seq + length > tcb.ack_num: # else a duplicate of delivered data
+                        tcb.recv_window_size -= length
+                        self.deliver_in_order(tcb, buffered)
+
+        # Duplicates, out-of-order data and segments filling a gap are acknowledged at once (RFC 5681)
+        immediate = not self.delayed_ack or not in_order or gap_filled
+        self.schedule_ack(tcb, segment.messagetype, len(payload) if in_order else 0, immediate)
+
+    def schedule_ack(self, tcb, message_type, length, immediate=False):
+        with tcb.lock:
+            if tcb.closed:
+                return
+            if tcb.pending_ack is None:
+                tcb.pending_ack = [0, message_type]
+            pending = tcb.pending_ack
+            pending[0] += length
+            pending[1] = message_type
+            mss = tcb.send_mss
+            window_update = tcb.recv_window_size - tcb.last_advertised >= 2 * mss
+            if immediate or window_update or pending[0] >= DELAYED_ACK_SEGMENTS * mss:
+                self.send_ack(tcb)
+            elif tcb.ack_timer is None:
+                tcb.ack_timer = self.call_later(DELAYED_ACK_TIMEOUT, self.flush_ack, tcb)
+
+    def flush_ack(self, tcb):
+        # Delayed ACK timer, nothing came along to coalesce with or ride on
+        with tcb.lock:
+            tcb.ack_timer = None
+            if tcb.pending_ack is not None:
+                self.send_ack(tcb)
+
+    def send_ack(self, tcb):
+        # Pure ACK for everything received so far, the caller holds tcb.lock
+        pending = tcb.pending_ack
+        tcb.pending_ack = None
+        self.cancel_ack_timer(tcb)
+        if tcb.closed: # connection already gone
+            return
+
+        # Report what is buffered past the gap so the sender only resends the holes
+        sack = b''
+        if tcb.sack_permitted and tcb.reassembly:
+            sack = TCPSegment.pack_sack_blocks(tcb.reassembly.sack_blocks(MAX_SACK_BLOCKS))
+
+        ack = TCPSegment(
+            src_port=self.local_addr[1],
+            dest_port=tcb.remote[1],
+            seq_num=0,
+            ack_num=tcb.ack_num,
+            flags=FLAG_ACK,
+            timestamp=current_timestamp(),
+            windowsize=self.window_field(tcb),
+            payloadlength=len(sack),
+            messagetype=pending[1] if pending else 1,
+            payload=sack
+        )
+        tcb.last_advertised = tcb.recv_window_size
+        self.send_segment(ack, tcb.remote)
+
+    def piggyback(self, tcb):
+        # (flags, ack_num, window) for an outgoing data segment, which carries the pending ACK when the peer reads it
+        if not tcb.piggyback_ack or tcb.closed:
+            return 0, 0, 0
+        with tcb.lock:
+            tcb.pending_ack = None
+            self.cancel_ack_timer(tcb)
+            tcb.last_advertised = tcb.recv_window_size
+            return FLAG_ACK | FLAG_PSH, tcb.ack_num, self.window_field(tcb)
+
+    def cancel_ack_timer(self, tcb):
+        timer = tcb.ack_timer
+        tcb.ack_timer = None
+        if timer is not None:
+            timer.cancel()
+    
+    def deliver_in_order(self, tcb, part):
+        # part starts at or before ack_num, only the new bytes go to the application
+        skip = tcb.ack_num - part["seq_num"]
+        if skip > 0:
+            part["payload"] = part["payload"][skip:]
+            tcb.recv_window_size += skip
+        tcb.ack_num = part["seq_num"] + skip + len(part["payload"])
+        tcb.recv_buffer.append(part)
+        self.recv_buffer_controller(tcb)
+
+    def receive_ack(self, seg, sender):
+        # print(f"[RECEIVE] Received from {sender} ACK: {seg.ack_num}")
+        tcb = self.connections.get(sender)
+        if tcb is None:
+            return
+        with tcb.lock:
+            send_base = tcb.send_base
+            if tcb.closed or seg.ack_num < send_base: # closed meanwhile, or a stale, reordered ACK
+                return
+            queue = tcb.unacked_segments
+            window = self.peer_window(tcb, seg.windowsize)
+            congestion = self.get_congestion(tcb)
+            pure_ack = seg.flags == FLAG_ACK # a pure ACK only ever carries SACK blocks as payload
+            sack = queue is not None and tcb.sack_permitted and pure_ack and seg.payload
+            newly_sacked = queue.mark_sacked(seg.sack_blocks()) if sack else 0
+
+            if seg.ack_num > send_base:
+                acked = queue.acknowledge(seg.ack_num) if queue else []
+                tcb.send_base = seg.ack_num
+                tcb.retransmit_count = 0
+                if acked and not acked[-1].retransmitted: # Karn's rule
+                    tcb.rto.sample(time.monotonic() - acked[-1].sent_at)
+                # restart the timer for whatever is still in flight
+                tcb.retransmit_deadline = tcb.rto.deadline()
+                flight_size = tcb.next_seq_num - seg.ack_num
+                if congestion.on_new_ack(seg.ack_num - send_base, seg.ack_num, flight_size):
+                    # partial ACK: the hole at send_base, unless a SACK driven resend covered it already
+                    hole = self.oldest_hole(tcb)
+                    if hole is not None and hole.retransmitted:
+                        hole = queue.next_hole() if sack else None
+                    self.retransmit(tcb, hole)
+            elif pure_ack and queue and (window <= tcb.remote_window_size or newly_sacked):
+                # Duplicate ACK: nothing new acknowledged while data is outstanding and the window did not
+                # grow, a window update is no loss signal. Fresh SACK blocks always report a later arrival.
+                flight_size = tcb.next_seq_num - send_base
+                if congestion.on_dup_ack(flight_size, tcb.next_seq_num):
+                    self.retransmit(tcb, self.oldest_hole(tcb)) # fast retransmit
+                elif sack and congestion.in_recovery:
+                    self.retransmit(tcb, queue.next_hole()) # one more hole per returning ACK
+            if seg.ack_num > send_base or pure_ack: # a resent data segment carries a stale window
+                tcb.remote_window_size = window
+            self.on_window_open(tcb)
+
+    def oldest_unacked(self, tcb):
+        queue = tcb.unacked_segments
+        return queue.oldest() if queue else None
+
+    def oldest_hole(self, tcb):
+        # Oldest segment the receiver has not SACKed, the oldest one overall without SACK
+        queue = tcb.unacked_segments
+        return (queue.first_unsacked() or queue.oldest()) if queue else None
+
+    def start_retransmit_timer(self, tcb):
+        # The timer runs while data is in flight, a running timer is not restarted by new data
+        with tcb.lock:
+            if tcb.retransmit_timer is None and not tcb.closed:
+                tcb.retransmit_deadline = tcb.rto.deadline()
+                tcb.retransmit_timer = self.call_later(tcb.rto.rto, self.on_retransmit_timeout, tcb)
+
+    def on_retransmit_timeout(self, tcb):
+        with tcb.lock:
+            tcb.retransmit_timer = None
+            oldest = self.oldest_unacked(tcb)
+            if oldest is None or tcb.closed: # everything got acknowledged
+                return
+
+            remaining = tcb.retransmit_deadline - time.monotonic()
+            if remaining > 0: # an ACK moved the deadline since the timer was armed
+                tcb.retransmit_timer = self.call_later(remaining, self.on_retransmit_timeout, tcb)
+                return
+
+            tcb.retransmit_count += 1
+            if tcb.retransmit_count > MAX_RETRANSMISSIONS:
+                print(f"[!] {tcb.remote} is not acknowledging, closing the connection")
+                self.drop_connection(tcb)
+                return
+
+            # Resend the oldest unacknowledged segment and back off
+            flight_size = tcb.next_seq_num - tcb.send_base
+            self.get_congestion(tcb).on_timeout(flight_size)
+            self.retransmit(tcb, self.oldest_hole(tcb))
+            tcb.rto.backoff()
+            tcb.retransmit_deadline = tcb.rto.deadline()
+            tcb.retransmit_timer = self.call_later(tcb.rto.rto, self.on_retransmit_timeout, tcb)
+
+    def retransmit(self, tcb, entry):
+        if entry is None:
+            return
+        entry.retransmitted = True
+        entry.sent_at = time.monotonic()
+        self.send_datagram(entry.data, tcb.remote)
+
+    @abstractmethod
+    def send_datagram(self, data, remote):
+        pass
+
+    @abstractmethod
+    def call_later(self, delay, callback, *args):
+        # Run callback after delay seconds, returns a handle with cancel()
+        pass
+
+    @abstractmethod
+    def on_state_change(self, tcb):
+        # tcb moved to another state or was closed
+        pass
+
+    @abstractmethod
+    def on_window_open(self, tcb):
+        # An ACK may have opened the send window of tcb, called with tcb.lock held
+        pass
+
+    @abstractmethod
+    def recv_buffer_controller(self, tcb):
+        pass
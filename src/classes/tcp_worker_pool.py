@@ -0,0 +1,123 @@
+import threading
+import time
+import traceback
+import sys
+import os
+from collections import deque
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+
+from helper.constants import *
+
+class SerialWorkerPool:
+    """Fixed set of worker threads. Tasks sharing a key run one at a time in submission order,
+    tasks with different keys run in parallel"""
+
+    def __init__(self, workers=WORKER_THREADS, max_queue_depth=WORKER_QUEUE_DEPTH, max_pending=WORKER_MAX_PENDING,
+                 name="worker"):
+        self.max_queue_depth = max_queue_depth      # tasks waiting per key
+        self.max_pending = max_pending              # tasks waiting over all keys
+        self.lock = threading.Lock()                # guards everything below
+        self.not_empty = threading.Condition(self.lock)
+        self.queues = {}                            # key -> deque of (fn, args, submitted_at), only while it has work
+        self.ready = deque()                        # keys with work and no worker on them, in arrival order
+        self.pending = 0
+        self.running = True
+
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.busy = 0
+        self.max_pending_seen = 0
+        self.max_depth_seen = 0
+        self.total_wait = 0.0                       # seconds tasks spent queued
+        self.max_wait = 0.0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run_worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) behind earlier tasks of key. Returns False when a queue limit is reached"""
+        with self.lock:
+            if not self.running:
+                return False
+            queue = self.queues.get(key)
+            depth = len(queue) if queue is not None else 0
+            if depth >= self.max_queue_depth or self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            if queue is None:
+                queue = self.queues[key] = deque()
+                self.ready.append(key) # no worker owns the key yet
+                self.not_empty.notify()
+            queue.append((fn, args, time.monotonic()))
+            self.submitted += 1
+            self.pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self.pending)
+            self.max_depth_seen = max(self.max_depth_seen, depth + 1)
+            return True
+
+    def run_worker(self):
+        while True:
+            with self.lock:
+                while not self.ready and self.running:
+                    self.not_empty.wait()
+                if not self.ready:
+                    return
+                key = self.ready.popleft() # this worker owns the key until its task is done
+                fn, args, submitted_at = self.queues[key].popleft()
+                self.pending -= 1
+                self.busy += 1
+                wait = time.monotonic() - submitted_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+            failed = False
+            try:
+                fn(*args)
+            except Exception as e:
+                failed = True
+                print(f"[!] Error in worker task {getattr(fn, '__name__', fn)} for {key}: {e}")
+                traceback.print_exc()
+
+            with self.lock:
+                self.busy -= 1
+                self.completed += 1
+                self.failed += failed
+                if self.queues[key]:
+                    self.ready.append(key) # back of the line, other keys get a turn
+                    self.not_empty.notify()
+                else:
+                    del self.queues[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": len(self.threads),
+                "busy": self.busy,
+                "pending": self.pending,
+                "active_keys": len(self.queues),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "max_pending": self.max_pending_seen,
+                "max_queue_depth": self.max_depth_seen,
+                "avg_wait_ms": self.total_wait / self.completed * 1000 if self.completed else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def shutdown(self, wait=True):
+        # Queued tasks still run, new ones are refused
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+        if wait:
+            for thread in self.threads:
+                if thread is not threading.current_thread():
+                    thread.join()
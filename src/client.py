@@ -1,4 +1,5 @@
 from classes.tcp_client import TCPClientSocket
+from classes.console_renderer import ConsoleRenderer
 from helper.constants import *
 from rand_ip import *
 
@@ -8,15 +9,20 @@ import time
 import os
 import traceback
 import sys
+from collections import deque
 
 class ChatClient:
-    def __init__(self, server_ip, server_port, local_ip="127.0.0.2", local_port=8932):
+    def __init__(self, server_ip, server_port, local_ip="127.0.0.2", local_port=8932, headless=False):
         self.server_addr = (server_ip, server_port)
         self.local_addr = (local_ip, local_port)
         self.name = "Unknown"
         self.tcp = None
         self.running = True
         self.chat_buffer = []
+        self.history = deque(maxlen=MAX_MESSAGES)  # chat lines, the newest one has id last_id
+        self.last_id = None                        # None until a snapshot or delta sets it
+        self.resyncing = False                     # history requested, deltas are ignored until the snapshot
+        self.console = ConsoleRenderer("JARKOM CHATROOM", prompt=">> ", headless=headless)
 
     def start(self):
         while True:
@@ -32,9 +38,10 @@ class ChatClient:
             print("Failed to connect to server")
             return
         self.name = name
-        threading.Thread(target=self.send_messages).start()
-        threading.Thread(target=self.receive_messages).start()
-        threading.Thread(target=self.send_heartbeats).start()
+        self.request_history()
+        threading.Thread(target=self.send_messages, daemon=True).start()
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+        threading.Thread(target=self.send_heartbeats, daemon=True).start()
         # threading.Thread(target=self.periodic_clear).start()
 
         while self.running:
@@ -43,7 +50,7 @@ class ChatClient:
     def periodic_clear(self):
         while self.running:
             time.sleep(5)
-            self.tcp.recv_buffer[self.server_addr].clear()
+            self.tcp.connections[self.server_addr].recv_buffer.clear()
 
     def send_messages(self):
         while self.running:
@@ -53,19 +60,67 @@ class ChatClient:
     def receive_messages(self):
         self.tcp.receive_message_tcp()
     
-    def handler(self, payload, payload_length):
-        if payload_length == 0:  # Termination message
+    def handler(self, payload, payload_length, message_type=1):
+        if payload_length == 0:  # Termination message, start() returns and the process exits
             self.running = False
-            print("\n[CLIENT] Server terminated the connection")
-            self.tcp.cleanup_connection()
+            if message_type == 3:
+                print("\n[CLIENT] Disconnected from the server")
+            else:
+                print("\n[CLIENT] Server terminated the connection")
+            self.tcp.close()
             return
             
         if (len(payload) == payload_length):
-            self.client_print(payload.decode())
+            self.handle_chat(message_type, payload)
         else:
-            self.add_to_chat_buffer(payload, payload_length)
-
-    def add_to_chat_buffer(self, payload, total_payload):
+            self.add_to_chat_buffer(payload, payload_length, message_type)
+
+    def request_history(self):
+        # Ask for a snapshot (type 10), which also tells the server this client understands deltas.
+        # Sent from its own thread, the receive worker must stay free to process ACKs.
+        self.resyncing = True
+        threading.Thread(target=self.tcp.send_data, args=(self.server_addr, b'', 10), daemon=True).start()
+
+    def handle_chat(self, message_type, payload):
+        text = payload.rstrip(b'\x00').decode()
+        if message_type == 1:  # Whole log, the server has not seen our history request yet
+            self.client_print(text)
+            return
+        if message_type == 9:  # Snapshot, replaces the history
+            self.history.clear()
+            self.last_id = None
+            self.resyncing = False
+        elif self.resyncing:
+            return  # the snapshot on its way has this delta too
+
+        for id, line in self.parse_lines(text):
+            if self.last_id is None:
+                self.last_id = id - 1
+            if id == self.last_id + 1:  # new line, the ring drops the oldest like the server does
+                self.history.append(line)
+                self.last_id = id
+            elif id <= self.last_id:  # edited line, e.g. a rename
+                index = id - (self.last_id - len(self.history) + 1)
+                if index >= 0:
+                    self.history[index] = line
+            else:
+                self.request_history()  # missed a delta
+                return
+        self.client_print('\n'.join(self.history))
+
+    def parse_lines(self, text):
+        # "<id> <length> <line>" entries separated by '\n', the length keeps a line break inside a line
+        lines = []
+        start = 0
+        while start < len(text):
+            id_end = text.index(' ', start)
+            length_end = text.index(' ', id_end + 1)
+            end = length_end + 1 + int(text[id_end + 1:length_end])
+            lines.append((int(text[start:id_end]), text[length_end + 1:end]))
+            start = end + 1
+        return lines
+
+    def add_to_chat_buffer(self, payload, total_payload, message_type=1):
         self.chat_buffer.append(payload)
         total_length = 0
         for i in range(len(self.chat_buffer)):
@@ -73,20 +128,18 @@ class ChatClient:
 
         if (total_length == total_payload):
             full_message = b''.join(self.chat_buffer)
-            self.client_print(full_message.decode())
+            self.handle_chat(message_type, full_message)
             self.chat_buffer = []
 
     def client_print(self, message):
-        os.system("cls" if os.name == "nt" else "clear")
-        print("---------------- JARKOM CHATROOM ----------------")
-        print(f"{message}\n", end="")
-        print("------------------------------------------------\n>> ", end="")
+        self.console.update(message.split('\n'))
     
     def send_heartbeats(self):
         while self.running:
             # print("Sending heartbeats")
             time.sleep(HEARTBEAT_SEND_INTERVAL)
-            self.tcp.network_heartbeat()
+            if self.running:
+                self.tcp.network_heartbeat()
 
 
 
@@ -104,7 +157,7 @@ if __name__ == "__main__":
     l_ip, port = address.split()
     l_port = int(port)
 
-    client = ChatClient(server_ip=s_ip, server_port=s_port, local_ip=l_ip, local_port=l_port)
+    client = ChatClient(server_ip=s_ip, server_port=s_port, local_ip=l_ip, local_port=l_port, headless="--headless" in sys.argv)
     try:
         client.start()
     except Exception as e:
@@ -17,6 +17,48 @@ HEARTBEAT_SEND_INTERVAL = 5 # seconds
 MAX_MESSAGES = 15
 SERVER_KILL_PASSWORD = "jarkomkomkom"
 
+# SEGMENT SIZES
+LEGACY_MSS = 64 # payload bytes per segment for peers that do not negotiate an MSS
+DEFAULT_MSS = 1400 # path-safe payload bytes per segment
+RECV_WINDOW_SEGMENTS = 5 # initial receive window, in full segments
+
+# RECEIVE WINDOW AUTO-TUNING
+MAX_RECV_WINDOW = 1 << 20 # bytes, needs window scaling above 65535
+AUTOTUNE_INTERVAL = 0.1 # seconds between drain-rate measurements when no RTT is known yet
+
+# CONGESTION CONTROL
+DEFAULT_CONGESTION_CONTROL = "reno" # "reno", "newreno" or "cubic"
+INITIAL_CWND_SEGMENTS = 4
+INITIAL_SSTHRESH = 1 << 30 # bytes, effectively unlimited until the first loss
+DUP_ACK_THRESHOLD = 3
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+# HANDSHAKE OPTION FLAGS
+OPT_WINDOW_SCALE = 0x01
+OPT_SACK_PERMITTED = 0x02
+OPT_PIGGYBACK_ACK = 0x04
+
+# DELAYED ACKS
+DELAYED_ACK_TIMEOUT = 0.04  # seconds an ACK may wait for more data or outgoing data to ride on
+DELAYED_ACK_SEGMENTS = 2    # full segments acknowledged by one ACK
+
+# SELECTIVE ACKNOWLEDGEMENTS
+MAX_SACK_BLOCKS = 4 # (left, right) blocks carried in the payload of a pure ACK
+
+# TIMESTAMPS
+TIMESTAMP_RESOLUTION = 1000 # ticks per second in the segment timestamp (milliseconds)
+
+# RETRANSMISSION (RFC 6298)
+INITIAL_RTO = 1.0 # seconds
+MIN_RTO = 0.2 # seconds
+MAX_RTO = 60.0 # seconds
+RTO_ALPHA = 1 / 8
+RTO_BETA = 1 / 4
+RTO_K = 4
+CLOCK_GRANULARITY = 0.001 # seconds
+MAX_RETRANSMISSIONS = 8 # expiries in a row before the connection is dropped
+
 DEFAULT_SERVER_IP = "127.0.0.1"
 DEFAULT_SERVER_PORT = 1234
 DEFAULT_CLIENT_IP = "127.0.0.2"
@@ -47,3 +89,56 @@ BRIGHT_WHITE_COLOR = "\033[97m"
 # Reset
 RESET = "\033[0m"
 
+# EVENT LOOP
+RECV_BATCH = 64 # datagrams read per readiness event
+
+# WORKER POOL
+WORKER_THREADS = 8          # threads running handlers and blocking sends
+CLIENT_WORKER_THREADS = 1   # a client has one connection, its segments run one at a time anyway
+WORKER_QUEUE_DEPTH = 256    # tasks waiting per connection before new ones are refused
+WORKER_MAX_PENDING = 10000  # tasks waiting over all connections
+
+# SHARDING
+SHARD_SHUTDOWN_TIMEOUT = 5.0 # seconds a shard gets to exit after the kill command
+
+# ASYNCIO TRANSPORT
+SOCKET_RECV_BUFFER = 4 << 20 # SO_RCVBUF requested for asyncio endpoints, the kernel may cap it
+
+# CHAT HISTORY
+CHAT_MESSAGE = 0      # record kinds, rendered with the author's current name and colour
+CHAT_JOIN = 1
+CHAT_LEAVE = 2
+CHAT_FAILED_KILL = 3
+
+# CONSOLE
+CONSOLE_FPS = 20 # redraws per second at most, updates in between are folded into the next frame
+
+# TIMERS
+TIMER_TICK = 0.01       # seconds per slot of the innermost timing wheel
+TIMER_WHEEL_BITS = 8    # 256 slots per wheel
+TIMER_WHEEL_LEVELS = 4  # 4 wheels reach 256^4 ticks ahead (over a year), later deadlines are clamped
+
+# CONNECTIONS
+TCB_MEMORY_BUDGET = 1024 # bytes an established connection with nothing buffered may hold, TCPConnection.memory()
+
+# CONNECTION STATES
+LISTEN = "LISTEN"
+SYN_SENT = "SYN_SENT"
+SYN_RECEIVED = "SYN_RECEIVED"
+ESTABLISHED = "ESTABLISHED"
+FIN_WAIT_1 = "FIN_WAIT_1"       # our FIN sent
+FIN_WAIT_2 = "FIN_WAIT_2"       # our FIN acknowledged, the peer may still send
+CLOSE_WAIT = "CLOSE_WAIT"       # peer's FIN received, we may still send
+LAST_ACK = "LAST_ACK"           # our FIN-ACK sent after the peer's FIN
+TIME_WAIT = "TIME_WAIT"         # final ACK sent, repeated if the FIN-ACK comes again
+CLOSED = "CLOSED"
+SENDING_STATES = (ESTABLISHED, CLOSE_WAIT)
+MAX_CONTROL_RETRANSMISSIONS = 5 # resends of a SYN, FIN or FIN-ACK before the connection is given up
+TIME_WAIT_DURATION = 1.0        # seconds, twice the lifetime we allow a segment on a LAN
+
+# SHUTDOWN
+DRAIN_TIMEOUT = 5.0             # seconds a shutting down server waits for clients to acknowledge what was sent to them
+
+# SYN FLOOD PROTECTION
+SYN_BACKLOG = 128               # half-open connections kept, further SYNs get a cookie or are dropped
+SYN_COOKIE_PERIOD = 64          # seconds per cookie time slot, a cookie is accepted for one to two slots
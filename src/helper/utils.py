@@ -1,14 +1,47 @@
-def calculate_checksum(data: bytes) -> int:
+import time
+
+from helper.constants import *
+
+def ones_complement_sum(data) -> int:
+    # Sum every big-endian 16-bit word of the buffer at once. Since 2^16 = 1 (mod 0xFFFF),
+    # the buffer read as one big integer is congruent to the sum of its words, so the
+    # end-around carry is folded a single time at the end instead of once per word.
+    value = int.from_bytes(data, "big")
+    total = value % 0xFFFF
     if len(data) % 2 == 1:
-        data += b'\x00'  # pad to even length
+        total = (total << 8) % 0xFFFF  # pad to even length, shifting the residue instead of the whole buffer
+    if total == 0 and value:
+        return 0xFFFF  # non-zero data never folds to +0
+    return total
+
+def ones_complement_add(*sums: int) -> int:
+    total = sum(sums)
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)  # wrap
+    return total
+
+def calculate_checksum(data: bytes) -> int:
+    return ~ones_complement_sum(data) & 0xFFFF
+
+def update_checksum(checksum: int, old_data: bytes, new_data: bytes, offset: int = 0) -> int:
+    # RFC 1624 (eqn. 3): HC' = ~(~HC + ~m + m'), m and m' being the old and new field value.
+    # offset is the position of the field inside the checksummed buffer, a field that starts
+    # on an odd byte lands in the low half of its first word.
+    if offset % 2 == 1:
+        old_data = b'\x00' + bytes(old_data)
+        new_data = b'\x00' + bytes(new_data)
+    old_sum = ones_complement_sum(old_data)
+    new_sum = ones_complement_sum(new_data)
+    return ~ones_complement_add(~checksum & 0xFFFF, ~old_sum & 0xFFFF, new_sum) & 0xFFFF
 
-    checksum = 0
-    for i in range(0, len(data), 2):
-        word = (data[i] << 8) + data[i + 1]  # big-endian
-        checksum += word
-        checksum = (checksum & 0xFFFF) + (checksum >> 16)  # wrap
+def current_timestamp() -> int:
+    return int(time.time() * TIMESTAMP_RESOLUTION)
 
-    return ~checksum & 0xFFFF
+def timestamp_to_time(timestamp: int) -> float:
+    # Seconds since the epoch, legacy peers still send whole seconds
+    if timestamp < 10 ** 11:
+        return timestamp
+    return timestamp / TIMESTAMP_RESOLUTION
 
 def has_flag(value: int, flag: int) -> bool:
     return (value & flag) == flag
@@ -17,4 +50,4 @@ def set_flag(value: int, flag: int) -> int:
     return value | flag
 
 def clear_flag(value: int, flag: int) -> int:
-    return value & ~flag
\ No newline at end of file
+    return value & ~flag
@@ -1,5 +1,8 @@
 from classes.tcp_server import TCPServerSocket
+from classes.chat_history import ChatHistory
+from classes.console_renderer import ConsoleRenderer
 from helper.constants import *
+from helper.utils import *
 import threading
 import time
 from datetime import datetime
@@ -7,14 +10,19 @@ import os
 import traceback
 import socket
 import random
+import sys
 
 class ChatServer:
-    def __init__(self, ip_address="128.0.0.1", port=1234):
+    def __init__(self, ip_address="128.0.0.1", port=1234, udp_socket=None, broker=None, headless=False):
         self.server_addr = (ip_address, port)
         self.tcp = None
+        self.udp_socket = udp_socket  # pre-configured socket, e.g. SO_REUSEPORT for a shard
+        self.broker = broker          # BrokerLink ordering chat room changes across shards, None when alone
+        self.shutting_down = False
+        self.console = ConsoleRenderer("SERVER CONSOLE", headless=headless)
         self.momentary_buffer = {}  # {addr -> [{messagetype, timestamp, byte, total_length}]}
-        self.chat_room = []         # List of messages in the chat room
-        self.clients = {}           # {addr: {'name': name, 'heartbeat': time, 'color': color}}
+        self.history = ChatHistory() # Messages in the chat room, names and colours by author
+        self.clients = {}           # {addr: {'heartbeat': timeout timer, 'delta': bool, 'resync': bool}}
         self.lock = threading.Lock()
         self.all_colors = [BLACK_COLOR, RED_COLOR, GREEN_COLOR, YELLOW_COLOR, BLUE_COLOR, MAGENTA_COLOR, CYAN_COLOR,
             BRIGHT_BLACK_COLOR, BRIGHT_RED_COLOR,
@@ -24,63 +32,118 @@ class ChatServer:
 
 
     def start(self):
-        self.tcp = TCPServerSocket(self.server_addr[1], ip_address=self.server_addr[0], handler=self.handler)
+        self.tcp = TCPServerSocket(self.server_addr[1], ip_address=self.server_addr[0], udp_socket=self.udp_socket, handler=self.handler)
+        if self.broker is not None:
+            self.tcp.shutdown_handler = self.on_shutdown
+            self.broker.start(self.on_broker_event)
         self.tcp.listen()
         self.tcp.accept()
 
     # Update the handler method to handle termination messages
     def handler(self, client, type, timestamp, payload, total_payload):
+        # Handlers of different clients run in parallel on the server's worker pool
+        with self.lock:
+            self.handle_message(client, type, timestamp, payload, total_payload)
+
+    def handle_message(self, client, type, timestamp, payload, total_payload):
         if (type == 1):  # Message
             if (len(payload) == total_payload):
-                self.add_message(f"{self.clients[client]['color']}{self.clients[client]['name']} {RESET_COLOR} [{time.strftime('%H:%M:%S', time.localtime(timestamp))}]: {payload.decode()} ")
+                self.add_message(client, timestamp, payload)
             else:
                 self.add_to_momentary_buff(client, type, timestamp, payload, total_payload)
         elif (type == 2):  # Join
-            self.add_client(client, timestamp, payload.decode())
+            self.add_client(client, timestamp, self.single_line(payload.decode()))
         elif (type == 3):  # Leave
             self.remove_client(client, timestamp)
         elif (type == 4):
             self.handle_heartbeat(client)
         elif (type == 5):
-            decode = payload.decode()
+            decode = payload.rstrip(b'\x00').decode()
             if (decode.startswith("!change")):
-                new_name = decode[len("!change "):].strip()
-                old_name = self.clients[client]['name']
-                self.clients[client]['name'] = new_name
-                for i, line in enumerate(self.chat_room):
-                    if old_name in line:
-                        self.chat_room[i] = line.replace(old_name, new_name)
-                self.send_chat()
-                self.server_print()
+                new_name = self.single_line(decode[len("!change "):]).strip()
+                self.dispatch_event(("rename", client, new_name))
+        elif (type == 10):  # History request of a delta client, sent on join and when it sees a gap
+            if client in self.clients:
+                self.clients[client]['delta'] = True
+                self.send_snapshot(client)
         elif (type == 7):  #failed kill signal
-            self.add_message(f"{RED_COLOR}SERVER [{time.strftime('%H:%M:%S', time.localtime(timestamp))}]: Nice try {self.clients[client]['name']}... {RESET_COLOR}")
+            self.dispatch_event(("failed_kill", client, timestamp))
 
 
     def remove_client(self, client, timestamp):
-        name = self.clients[client]['name']
-        self.add_message(f"{GREEN_COLOR}SERVER [{time.strftime('%H:%M:%S', time.localtime(timestamp))}]: {name} has left the chat!{RESET_COLOR}")
+        # Dropped first, the leave broadcast does not go to the client that left
         if client in self.clients:
+            self.clients[client]['heartbeat'].cancel()
             del self.clients[client]
+        self.dispatch_event(("leave", client, timestamp))
         if client in self.momentary_buffer:
             del self.momentary_buffer[client]
         
 
     def add_client(self, client, timestamp, name):
-        if (self.used_colors == self.all_colors):
+        if (len(self.used_colors) >= len(self.all_colors)):
             self.used_colors = []  
         available_color = [color for color in self.all_colors if color not in self.used_colors]
         random_color = random.choice(available_color)
         self.used_colors.append(random_color)
-        self.clients[client] = {'name': name, 'heartbeat': HEARTBEAT_INTERVAL, 'color': random_color}
-        if client not in self.clients:
-            threading.Thread(target=self.monitor_heartbeat, args=(client,), daemon=True).start()
-        self.add_message(f"{BRIGHT_GREEN_COLOR}SERVER [{time.strftime('%H:%M:%S', time.localtime(timestamp))}]: {name} has joined the chatroom!{RESET_COLOR}")
-
-    def add_message(self, message):
-        self.chat_room.append(message)
-        if len(self.chat_room) > MAX_MESSAGES:
-            self.chat_room.pop(0)
-        self.send_chat()
+        if client in self.clients: # joined again without leaving
+            self.clients[client]['heartbeat'].cancel()
+        heartbeat = self.tcp.call_later(HEARTBEAT_INTERVAL, self.heartbeat_timeout, client)
+        self.clients[client] = {'heartbeat': heartbeat, 'delta': False, 'resync': False}
+        self.dispatch_event(("join", client, name, random_color, timestamp))
+
+    def add_message(self, client, timestamp, payload):
+        self.dispatch_event(("message", client, timestamp, self.single_line(payload.rstrip(b'\x00').decode())))
+
+    def single_line(self, text):
+        # A chat line is one console line, line breaks a client sent become spaces
+        return ' '.join(text.splitlines())
+
+    def dispatch_event(self, event):
+        # A sharded server orders every chat room change through the broker, so all shards show the same room
+        if self.broker is not None:
+            self.broker.publish(event)
+        else:
+            self.apply_event(event)
+
+    def apply_event(self, event):
+        # Events name clients by address, every shard resolves it to the same author
+        kind = event[0]
+        if kind == "message":
+            changed = self.append_record(event[1], CHAT_MESSAGE, event[2], event[3])
+        elif kind == "join":
+            _, client, name, colour, timestamp = event
+            self.history.join(client, name, colour)
+            changed = self.append_record(client, CHAT_JOIN, timestamp)
+        elif kind == "leave":
+            changed = self.append_record(event[1], CHAT_LEAVE, event[2])
+            self.history.leave(event[1])
+        elif kind == "failed_kill":
+            changed = self.append_record(event[1], CHAT_FAILED_KILL, event[2])
+        elif kind == "rename":
+            changed = self.history.rename(event[1], event[2])
+        elif kind == "kill": # another shard got the kill command
+            self.shutting_down = True
+            self.tcp.handle_killing_signal_ack()
+            return
+        self.send_chat(changed)
+
+    def append_record(self, client, kind, timestamp, text=""):
+        # ids of the new record, none when the client already left
+        author = self.history.author_of(client)
+        if author is None:
+            return []
+        return [self.history.append(author, kind, timestamp, text).id]
+
+    def on_broker_event(self, event):
+        with self.lock:
+            self.apply_event(event)
+
+    def on_shutdown(self):
+        # Kill command on this shard, take the other shards down too
+        if not self.shutting_down:
+            self.shutting_down = True
+            self.broker.publish(("kill",)) # the link is flushed when the shard exits
     
     def add_to_momentary_buff(self, client, type, timestamp, payload, total_payload):
         if client not in self.momentary_buffer:
@@ -108,72 +171,76 @@ class ChatServer:
         # print(f"Total payload: {total_payload}")
         if accumulated_length >= total_payload:
             full_message = b''.join(current_buffer_parts)
-            name = self.clients[client]['name']
-            self.add_message(f"{self.clients[client]['color']}{name}{RESET_COLOR} [{time.strftime('%H:%M:%S', time.localtime(timestamp))}]: {full_message.decode()}")
+            self.add_message(client, timestamp, full_message)
             self.momentary_buffer[client] = []
     
-    def send_chat(self):
-        chat_log = '\n'.join(self.chat_room)
-        for client_addr in self.clients:
-            threading.Thread(target=self.tcp.send_data, args=(client_addr, chat_log.encode(), 1), daemon=True).start()
+    def encode_lines(self, ids):
+        # "<id> <length> <line>" per chat line still in the room, oldest first. The length in characters
+        # frames the line, so the client never has to guess where it ends.
+        entries = []
+        for record in (self.history.get(id) for id in ids):
+            if record is not None:
+                line = self.history.render(record)
+                entries.append(f"{record.id} {len(line)} {line}")
+        return '\n'.join(entries).encode()
+
+    def send_chat(self, changed):
+        # Delta clients get the new or edited lines only, clients without delta support the whole log
+        legacy = [addr for addr, info in self.clients.items() if not info['delta']]
+        delta = [addr for addr, info in self.clients.items() if info['delta'] and not info['resync']]
+        skipped = []
+        if legacy:
+            # A full send queue skips this update for that client, the next log has it
+            skipped += self.tcp.broadcast(legacy, self.history.render_log().encode(), 1)
+        if delta and changed:
+            # A delta client that misses one is sent a snapshot instead of the next delta
+            for client_addr in self.tcp.broadcast(delta, self.encode_lines(changed), 8):
+                self.clients[client_addr]['resync'] = True
+                skipped.append(client_addr)
+        for client_addr, info in self.clients.items():
+            if info['resync'] and client_addr not in skipped:
+                self.send_snapshot(client_addr)
+        for client_addr in skipped:
+            print(f"[!] Send queue to {client_addr} is full, skipping chat log update")
         self.server_print()
+
+    def send_snapshot(self, client):
+        snapshot = self.encode_lines(self.history.ids())
+        self.clients[client]['resync'] = not self.tcp.workers.submit(client, self.tcp.send_data, client, snapshot, 9)
     
     def server_print(self):
-        os.system("cls" if os.name == "nt" else "clear")
-        print("---------------- SERVER CONSOLE ----------------")
-        for message in self.chat_room:
-            print(message)
-        print("------------------------------------------------")
+        self.console.update(self.history.render(record) for record in self.history)
     
-    def monitor_heartbeat(self, client):
-        while client in self.clients:
-            time.sleep(1) 
-            self.clients[client]['heartbeat'] -= 1
-            # print(f"{client} ({self.clients[client]['name']}) heartbeats: {self.clients[client]['heartbeat']}")
-
-            if self.clients[client]['heartbeat'] <= 0:
-                print(f"Client {client} is kicked out")
-                self.tcp.delete_client(client)
-                del self.clients[client]
-                break
+    def heartbeat_timeout(self, client):
+        # Runs on the protocol timer thread, the kick waits for the client's handlers instead
+        self.tcp.workers.submit(client, self.kick_client, client)
+
+    def kick_client(self, client):
+        with self.lock:
+            info = self.clients.get(client)
+            if info is None or info['heartbeat'].when > time.monotonic(): # left, or a heartbeat came in meanwhile
+                return
+            print(f"Client {client} is kicked out")
+            self.tcp.cleanup_connection(client)
+            self.remove_client(client, current_timestamp())
 
     def handle_heartbeat(self, client):
+        # One timer per client, pushed back on every heartbeat
         if client in self.clients:
-            self.clients[client]['heartbeat'] = HEARTBEAT_INTERVAL
-
-    def monitor_clients(self):
-        while True:
-            time.sleep(1)
-            with self.lock:
-                for addr, info in list(self.clients.items()):
-                    if time.time() - info['last_heartbeat'] > HEARTBEAT_INTERVAL:
-                        self.remove_client(addr, f"{info['name']} was AFK and has been kicked!")
-
-    def monitor_clients(self):
-        while True:
-            time.sleep(1)
-            with self.lock:
-                for addr, info in list(self.clients.items()):
-                    if time.time() - info['last_heartbeat'] > HEARTBEAT_INTERVAL:
-                        self.remove_client(addr, f"{info['name']} was AFK and has been kicked!")
-
-    def disconnect(self):
-        self.is_running = False
-        print("\033[92m[SERVER] Disconnecting...\033[0m")
-        self.udp.close()
+            self.clients[client]['heartbeat'].cancel()
+            self.clients[client]['heartbeat'] = self.tcp.call_later(HEARTBEAT_INTERVAL, self.heartbeat_timeout, client)
 
 if __name__ == "__main__":
     host = "0.0.0.0"
     port = DEFAULT_SERVER_PORT
 
-    server = ChatServer(host, port)
+    server = ChatServer(host, port, headless="--headless" in sys.argv)
     try:
         server.start()
     except Exception as e:
         print(f"[SERVER] Error: {e}")
         # traceback.print_exc()
     finally:
-        server.tcp.handle_killing_signal_ack()
         if (server.tcp):
-            server.tcp.udp.close()
+            server.tcp.handle_killing_signal_ack()
             print("[SERVER] Server socket closed.")
@@ -0,0 +1,112 @@
+from server import ChatServer
+from helper.constants import *
+import multiprocessing
+import threading
+import socket
+import sys
+import os
+
+class BrokerLink:
+    """A shard's end of the ChatBroker: publish chat room changes, apply them in broker order"""
+
+    def __init__(self, shard_id, outbox, inbox):
+        self.shard_id = shard_id
+        self.outbox = outbox    # shard -> broker, shared by every shard
+        self.inbox = inbox      # broker -> this shard
+        self.closed = False     # set by flush, events published later are dropped
+
+    def publish(self, event):
+        if not self.closed:
+            self.outbox.put((self.shard_id, event))
+
+    def flush(self):
+        # Make sure published events left the process before it exits
+        self.closed = True
+        self.outbox.close()
+        self.outbox.join_thread()
+
+    def start(self, callback):
+        threading.Thread(target=self.listen, args=(callback,), daemon=True).start()
+
+    def listen(self, callback):
+        while True:
+            callback(self.inbox.get())
+
+class ChatBroker:
+    """Relays chat room changes between shard processes, every shard applies them in the same order"""
+
+    def __init__(self, shards):
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue() for _ in range(shards)]
+
+    def link(self, shard_id):
+        return BrokerLink(shard_id, self.outbox, self.inboxes[shard_id])
+
+    def run(self):
+        # Returns once a shard reports the kill command
+        while True:
+            shard_id, event = self.outbox.get()
+            for i, inbox in enumerate(self.inboxes):
+                if event[0] == "kill" and i == shard_id:
+                    continue # already shutting down
+                inbox.put(event)
+            if event[0] == "kill":
+                return
+
+def reuseport_socket():
+    # UDP socket sharing its port with the other shards, None where SO_REUSEPORT is unavailable
+    if not hasattr(socket, "SO_REUSEPORT"):
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def run_shard(shard_id, host, port, link):
+    # The kernel hashes each client address to one shard, which owns all TCPServerSocket state for it
+    # Shards share the terminal, only the first one draws the console
+    server = ChatServer(host, port, udp_socket=reuseport_socket(), broker=link, headless=shard_id != 0)
+    print(f"[SHARD {shard_id}] pid {os.getpid()}")
+    try:
+        server.start()
+    except Exception as e:
+        print(f"[SHARD {shard_id}] Error: {e}")
+    finally:
+        if server.tcp:
+            server.tcp.handle_killing_signal_ack()
+        link.flush() # connections are drained, nothing publishes any more
+
+def run_sharded(host, port, shards):
+    probe = reuseport_socket()
+    if probe is None:
+        print("[SERVER] SO_REUSEPORT is not available, running a single process")
+        ChatServer(host, port).start()
+        return
+    probe.close()
+
+    broker = ChatBroker(shards)
+    processes = []
+    for shard_id in range(shards):
+        process = multiprocessing.Process(target=run_shard, args=(shard_id, host, port, broker.link(shard_id)), daemon=True)
+        process.start()
+        processes.append(process)
+    print(f"[SERVER] {shards} shards listening on {(host, port)}")
+
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.join(SHARD_SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+
+if __name__ == "__main__":
+    host = "0.0.0.0"
+    port = DEFAULT_SERVER_PORT
+    shards = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+
+    run_sharded(host, port, shards)